@@ -3,29 +3,140 @@ Actions: contains all the functions used to compose the low-high level
 actions for any agent programs that use these functions.
 """
 
+import functools
 import os
+import re
+import threading
 import openai
-from typing import List, Tuple
-from collections import deque
-import pinecone
+from concurrent.futures import Future
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from context_packer import ContextPacker
+from embedding_batcher import EmbeddingBatcher
+from embedding_cache import EmbeddingCache
+from result_history import Entry, ResultHistory
+from retrieval_cache import RetrievalCache
+from task_dedup import TaskDedupIndex
+from task_queue import TaskQueue, score_task
+from task_store import Task, TaskStore
+from vector_store import LocalVectorStore, Match
+from write_behind import Record, WriteBehindBuffer
+
+# vector store setup, VECTOR_STORE_BACKEND is one of "none", "local" (the
+# in-process vector store) or "pinecone", the backend is created on first use
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "none")
+USE_PINECONE = VECTOR_STORE_BACKEND == "pinecone"
+USE_LOCAL_VECTOR_STORE = VECTOR_STORE_BACKEND == "local"
 
 # pincone setup
-USE_PINECONE = False  # flag to set pincone usage on or off (default: False)
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT")
 PINECONE_TABLE = os.getenv("PINECONE_TABLE")
 
-# Create Pinecone index
+# Pinecone index
 DIMENSION = 1536
 METRIC = "cosine"
 POD_TYPE = "p1"
-if USE_PINECONE and PINECONE_TABLE not in pinecone.list_indexes():
-    pinecone.create_index(
-        PINECONE_TABLE, dimension=DIMENSION, metric=METRIC, pod_type=POD_TYPE
-    )
 
-# Init Pinecone
-pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
+# the index of each backend, created by get_index
+local_index: Optional[LocalVectorStore] = None
+pinecone_index = None
+# write versions of the pinecone namespaces, counting the upserts of this process
+pinecone_versions: Dict[str, int] = {}
+pinecone_versions_lock = threading.Lock()
+
+# retrieval cache setup, memoizes the context query per write version of the
+# index, new results are merged into the memoized matches instead of requerying
+RETRIEVAL_CACHE = True  # flag to set the retrieval cache on or off
+retrieval_cache = RetrievalCache()
+
+# task dependencies setup, lets task creation record "depends on" markers
+TRACK_TASK_DEPENDENCIES = False  # flag to set dependency tracking on or off
+DEPENDS_ON_PATTERN = re.compile(
+    r"\s*[\(\[]\s*depends on:?\s*([\d,\s]*)[\)\]]\s*$", re.I
+)
+
+# incremental prioritization setup, keeps the task list in a priority queue
+# where only new tasks are scored and the whole list is only re-prioritized
+# every FULL_PRIORITIZATION_INTERVAL loops or when too many tasks are new
+INCREMENTAL_PRIORITIZATION = False  # flag to set incremental prioritization on or off
+FULL_PRIORITIZATION_INTERVAL = 10
+FULL_PRIORITIZATION_DRIFT = 0.5  # share of new tasks that triggers a full pass
+LLM_SCORE_NEW_TASKS = False  # score new tasks with GPT instead of locally
+
+# task deduplication setup, drops new tasks repeating pending or completed ones
+DEDUPLICATE_TASKS = True  # flag to set task deduplication on or off
+DEDUPLICATION_THRESHOLD = 0.7  # shingle similarity above which tasks are duplicates
+
+# context packing setup, token budget of the context interpolated in each prompt
+CONTEXT_TOKEN_BUDGETS = {
+    "task_execution": 1000,
+    "task_creation": 1000,
+    "task_stop_or_not": 1000,
+}
+context_packer = ContextPacker()
+
+# result history setup, keeps the last RESULT_HISTORY_WINDOW results in memory,
+# spills the older ones to disk (disabled by an empty path) and folds them into
+# a rolling summary that is part of the context
+RESULT_HISTORY = False  # flag to set the result history on or off
+RESULT_HISTORY_WINDOW = 20
+RESULT_HISTORY_BATCH = 5  # number of results evicted, and summarized, at once
+RESULT_HISTORY_PATH = os.getenv("RESULT_HISTORY_PATH", "")
+RESULT_SUMMARY_BUDGET = 300  # token budget of the rolling summary
+LLM_SUMMARY = False  # summarize evicted results with GPT instead of extractively
+
+# bound on the number of pending tasks, the lowest priority ones beyond it are
+# dropped after task creation, 0 for no bound
+MAX_PENDING_TASKS = 0
+
+# embedding cache setup, the disk tier is enabled by setting the path of an
+# SQLite file, kept in memory only by default
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+embedding_cache = EmbeddingCache(path=EMBEDDING_CACHE_PATH or None)
+
+# embedding requests from concurrent callers are coalesced into batched calls
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_BATCH_WAIT = 0.01  # seconds to wait for more requests to coalesce
+
+# write-behind setup, task results are embedded and upserted in batches by a
+# background worker instead of on the critical path of task execution; the
+# results not written yet are still part of the retrieved context
+WRITE_BEHIND = True  # flag to set write-behind on or off
+WRITE_BEHIND_BATCH_SIZE = 32
+WRITE_BEHIND_MAX_AGE = 1.0  # seconds a result waits at most before it is written
+
+
+def vector_store_enabled() -> bool:
+    """Check whether task results are stored in and retrieved from an index."""
+    return USE_LOCAL_VECTOR_STORE or USE_PINECONE
+
+
+def get_index():
+    """
+    Get the index used to store task results: the local vector store if it
+    is enabled, the pinecone index otherwise. Both expose the same
+    upsert/query surface. The backend is initialised on the first call, so
+    importing the actions has no side effects.
+    """
+    global local_index, pinecone_index
+    if USE_LOCAL_VECTOR_STORE:
+        if local_index is None:
+            local_index = LocalVectorStore(dimension=DIMENSION)
+        return local_index
+    if pinecone_index is None:
+        import pinecone
+
+        pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
+        if PINECONE_TABLE not in pinecone.list_indexes():
+            pinecone.create_index(
+                PINECONE_TABLE, dimension=DIMENSION, metric=METRIC, pod_type=POD_TYPE
+            )
+        pinecone_index = pinecone.Index(index_name=PINECONE_TABLE)
+    return pinecone_index
 
 
 task_creation_template = """
@@ -44,6 +155,11 @@ Third task
 
 Do not include anything else except the list in your response.
 """
+task_dependencies_template = """
+The new tasks will be given the ids {next_id}, {next_id_2}, ... in the order
+you list them. If a task can only be started after other tasks are completed,
+end its line with the ids of those tasks, like: Third task (depends on: {next_id}, {next_id_2})
+"""
 task_prioritization_template = """
 You are a task prioritization AI tasked with cleaning the formatting of
 and reprioritizing the following tasks: {task_names}. Consider the 
@@ -56,6 +172,17 @@ Do not remove any tasks. Return the result as a numbered list, like:
 Start the task list with number 1 and do not include anything else 
 except the list in your response.
 """
+task_scoring_template = """
+You are a task prioritization AI. Consider the ultimate objective of your
+team: {objective}. Rate the priority of each of the following new tasks
+from 1 (lowest) to 10 (highest): {task_names}.
+Return the result as a list with the id of each task and its rating, like:
+
+3. 7
+4. 2
+
+Do not include anything else except the list in your response.
+"""
 task_execution_template = """
 You are an AI that performs one task based on the following objective: 
 {objective}.\nTake into account these previously completed tasks: 
@@ -64,6 +191,14 @@ Make sure to respond with a detailed solution to the assigned task you
 have been given only, and do not address any other tasks or make any lists. 
 your response should be in paragraph form.
 """
+result_summary_template = """
+You are an AI that keeps a summary of the work done towards the following
+objective: {objective}. This is the summary so far: {summary}.
+Update it with these newly completed tasks and their results:
+{results}
+Keep the summary under {words} words and do not include anything else
+except the summary in your response.
+"""
 task_stop_or_not_template = """
 You are an AI that assess task completion for the following objective: 
 {objective}. Take into account these previously completed tasks: {context}.
@@ -82,18 +217,37 @@ def task_execution_prompt_builder(globals_: dict) -> str:
         globals_ (dict): The globals dictionary
 
     Returns:
-        str: The prompt for GPT task execution
+        str: The prompt for GPT task execution, or None when no task is pending
     """
     task_list = globals_["task_list"]
+    if not task_list:
+        # nothing to execute, creation runs again on the last result
+        return None
     task = task_list.popleft()
     globals_["current_task"] = task
 
     print("\033[92m\033[1m" + "\n***** NEXT TASK *****\n" + "\033[0m\033[0m")
     print(str(task["id"]) + ": " + task["name"])
 
-    context = get_context(globals_)
+    return build_task_execution_prompt(globals_, task)
+
+
+def build_task_execution_prompt(globals_: dict, task: dict) -> str:
+    """
+    This function builds and returns the execution prompt for a given task,
+    without touching the task list, so that several tasks can be executed
+    at once.
+
+    Args:
+        globals_ (dict): The globals dictionary
+        task (dict): The task to execute
+
+    Returns:
+        str: The prompt for GPT task execution
+    """
+    context = get_packed_context(globals_, CONTEXT_TOKEN_BUDGETS["task_execution"])
     return task_execution_template.format(
-        objective=globals_["objective"], task=globals_["current_task"], context=context
+        objective=globals_["objective"], task=task, context=context
     )
 
 
@@ -107,26 +261,41 @@ def task_execution_handler(response: str, globals_: dict) -> None:
         response (str): The GPT response from task execution
         globals_ (dict): The globals dictionary
     """
+    if response is None:
+        # no task was pending, see task_execution_prompt_builder
+        return "done"
     enriched_result = {
         "data": response
     }  # This is where you should enrich the result if needed
     globals_["result"] = enriched_result
+    if DEDUPLICATE_TASKS:
+        get_task_index(globals_).add(globals_["current_task"]["name"])
+    if RESULT_HISTORY:
+        get_result_history(globals_).add(
+            globals_["current_task"]["id"], globals_["current_task"]["name"], response
+        )
+    # the tasks executed since the last journal record, see StateJournal.track
+    executed = globals_.get("executed")
+    if executed is not None:
+        executed.append(
+            (globals_["current_task"]["id"], globals_["current_task"]["name"], response)
+        )
 
-    """Use Pinecone, not currently setup"""
+    """Use the vector store (local or Pinecone), not used by default"""
     id_ = globals_["current_task"]["id"]
     result_id = f"result_{id_}"
     vector = enriched_result["data"]  # extract the actual result from the dictionary
-    if USE_PINECONE:
-        index = pinecone.Index(index_name=PINECONE_TABLE)
-        index.upsert(
-            [
-                (
-                    result_id,
-                    get_ada_embedding(vector),
-                    {"task": globals_["current_task"]["name"], "result": response},
-                )
-            ]
+    if vector_store_enabled():
+        record = (
+            result_id,
+            vector,
+            {"task": globals_["current_task"]["name"], "result": response},
         )
+        if WRITE_BEHIND:
+            submit_embedding(vector)
+            result_writer.add(record, namespace=globals_.get("namespace", ""))
+        else:
+            upsert_results([record], namespace=globals_.get("namespace", ""))
 
     print("\033[93m\033[1m" + "\n***** TASK RESULT *****\n" + "\033[0m\033[0m")
     print(globals_["result"]["data"])
@@ -145,13 +314,58 @@ def task_creation_prompt_builder(globals_: dict) -> str:
     Returns:
         str: The prompt for GPT task creation
     """
-    incomplete_tasks = [t["name"] for t in globals_["task_list"]]
+    budget = CONTEXT_TOKEN_BUDGETS["task_creation"]
+    # the last result takes at most half of the budget, the tasks the rest
+    result = context_packer.truncate(globals_["result"]["data"], budget // 2)
+    budget -= context_packer.count(result)
+    if not TRACK_TASK_DEPENDENCIES:
+        incomplete_tasks = context_packer.pack(
+            (t["name"] for t in globals_["task_list"]), budget
+        )
+        return task_creation_template.format(
+            objective=globals_["objective"],
+            result=result,
+            task_description=globals_["current_task"].get("name", "default"),
+            incomplete_tasks=incomplete_tasks,
+        )
+    # show the task ids so that new tasks can depend on incomplete ones
+    incomplete_tasks = context_packer.pack(
+        (format_context_item(t) for t in globals_["task_list"]), budget
+    )
+    next_id = next_task_id(globals_)
     return task_creation_template.format(
         objective=globals_["objective"],
-        result=globals_["result"],
+        result=result,
         task_description=globals_["current_task"].get("name", "default"),
         incomplete_tasks=incomplete_tasks,
-    )
+    ) + task_dependencies_template.format(next_id=next_id, next_id_2=next_id + 1)
+
+
+def next_task_id(globals_: dict) -> int:
+    """Get the id the next created task will be given."""
+    if isinstance(globals_["task_list"], TaskQueue):
+        return globals_["task_list"].next_id
+    if len(globals_["task_list"]) > 0:
+        return globals_["task_list"][-1]["id"] + 1
+    return 1
+
+
+def parse_task_dependencies(task_name: str) -> Tuple[str, List[int]]:
+    """
+    Split a "(depends on: 1, 2)" marker off the end of a task name.
+
+    Args:
+        task_name (str): The task name, possibly ending with a marker
+
+    Returns:
+        Tuple[str, List[int]]: The task name without the marker and the ids
+        of the tasks it depends on
+    """
+    match = DEPENDS_ON_PATTERN.search(task_name)
+    if match is None:
+        return task_name, []
+    ids = [int(id_) for id_ in re.findall(r"\d+", match.group(1))]
+    return task_name[: match.start()], ids
 
 
 def task_creation_handler(response: str, globals_: dict):
@@ -168,15 +382,32 @@ def task_creation_handler(response: str, globals_: dict):
         str: The status of the task creation handler
 
     """
-    new_tasks = response.split("\n")
-    if len(globals_["task_list"]) > 0:
-        id_ = globals_["task_list"][-1]["id"] + 1
+    new_tasks = [name.strip() for name in response.split("\n") if name.strip()]
+    if DEDUPLICATE_TASKS:
+        new_tasks = deduplicate_tasks(new_tasks, globals_)
+    id_ = next_task_id(globals_)
+    task_list = [Task(id_ + i, task_name) for i, task_name in enumerate(new_tasks)]
+    if TRACK_TASK_DEPENDENCIES:
+        for task in task_list:
+            task["name"], depends_on = parse_task_dependencies(task["name"])
+            if depends_on:
+                task["depends_on"] = depends_on
+    if INCREMENTAL_PRIORITIZATION:
+        # insert the new tasks into the queue with a local score, their ids are stable
+        queue = get_task_queue(globals_)
+        for task in task_list:
+            queue.append(task, score_task(task["name"], globals_["objective"]))
+    elif not task_list:
+        # every new task was a duplicate, keep the pending ones instead
+        pass
+    elif globals_.get("speculated_task") is not None:
+        # pipelined planning: the task executed meanwhile stays pending
+        get_task_store(globals_).replace([globals_["speculated_task"]] + task_list)
     else:
-        id_ = 1
-    task_list = [
-        {"id": id_ + i, "name": task_name} for i, task_name in enumerate(new_tasks)
-    ]
-    globals_["task_list"] = deque(task_list)
+        # the new tasks replace the pending ones, in the same task store
+        get_task_store(globals_).replace(task_list)
+    if MAX_PENDING_TASKS:
+        trim_pending_tasks(globals_, MAX_PENDING_TASKS)
 
     print("\033[89m\033[1m" + "\nTASK LIST:" + "\033[0m\033[0m")
     for t in task_list:
@@ -185,6 +416,63 @@ def task_creation_handler(response: str, globals_: dict):
     return "done"
 
 
+def normalize_task_name(name: str) -> str:
+    """Normalize a task name to compare it: case, whitespace and final period."""
+    return " ".join(name.lower().split()).rstrip(".")
+
+
+def trim_pending_tasks(globals_: dict, max_tasks: int) -> None:
+    """Drop the lowest priority pending tasks beyond the first max_tasks."""
+    task_list = globals_["task_list"]
+    if isinstance(task_list, TaskStore):
+        task_list.truncate(max_tasks)
+        return
+    for task in list(task_list)[max_tasks:]:
+        task_list.remove(task)
+
+
+def get_task_index(globals_: dict) -> TaskDedupIndex:
+    """Get the deduplication index of the task names, creating it on first use."""
+    if "task_index" not in globals_:
+        globals_["task_index"] = TaskDedupIndex(threshold=DEDUPLICATION_THRESHOLD)
+    return globals_["task_index"]
+
+
+def deduplicate_tasks(new_tasks: List[str], globals_: dict) -> List[str]:
+    """
+    Drop the new tasks that are near duplicates of completed tasks or of each
+    other and, when the task list is kept across loops (incremental
+    prioritization), of pending tasks too.
+
+    Args:
+        new_tasks (List[str]): The names of the new tasks
+        globals_ (dict): The globals dictionary
+
+    Returns:
+        List[str]: The names of the new tasks that are not duplicates
+    """
+    task_index = get_task_index(globals_)
+    if INCREMENTAL_PRIORITIZATION:
+        # pending tasks stay queued, index the new ones alongside them
+        batch_index = task_index
+    else:
+        # pending tasks are replaced by the new ones, only dedupe the batch
+        batch_index = TaskDedupIndex(threshold=DEDUPLICATION_THRESHOLD)
+        if globals_.get("speculated_task") is not None:
+            batch_index.add(globals_["speculated_task"]["name"])
+    unique = []
+    for name in new_tasks:
+        duplicate = task_index.find_duplicate(name) or batch_index.find_duplicate(name)
+        if duplicate is not None:
+            print(
+                "\033[90m" + f"duplicate task dropped: {name} ({duplicate})" + "\033[0m"
+            )
+            continue
+        batch_index.add(name)
+        unique.append(name)
+    return unique
+
+
 def task_prioritization_prompt_builder(globals_: dict) -> str:
     """
     This function builds and returns the prompt for GPT task prioritization
@@ -197,9 +485,25 @@ def task_prioritization_prompt_builder(globals_: dict) -> str:
         str: The prompt for GPT task prioritization
     """
     task_list = globals_["task_list"]
+    if INCREMENTAL_PRIORITIZATION:
+        queue = get_task_queue(globals_)
+        if queue.needs_full_prioritization(
+            FULL_PRIORITIZATION_INTERVAL, FULL_PRIORITIZATION_DRIFT
+        ):
+            queue.pending_prioritization = "full"
+        elif LLM_SCORE_NEW_TASKS and queue.new_tasks():
+            queue.pending_prioritization = "scores"
+            task_names = [f"{t['id']}. {t['name']}" for t in queue.new_tasks()]
+            return task_scoring_template.format(
+                objective=globals_["objective"], task_names=task_names
+            )
+        else:
+            # the new tasks were already scored locally, no GPT call needed
+            queue.pending_prioritization = None
+            return None
     current_task = globals_["current_task"]
     task_names = [t["name"] for t in task_list]
-    current_task_id = int(current_task["id"]) + 1
+    current_task_id = int(current_task.get("id", 0)) + 1
     objective = globals_["objective"]
     return task_prioritization_template.format(
         task_names=task_names, objective=objective, starting_id=current_task_id
@@ -212,15 +516,19 @@ def task_prioritization_handler(response: str, globals_: dict):
     prioritization prompt built by the task prioritization prompt builder and
     prints the resultant GPT response that is re-prioritizing existing tasks.
     """
+    if INCREMENTAL_PRIORITIZATION:
+        return incremental_prioritization_handler(response, globals_)
     new_tasks = response.split("\n")
-    task_list = deque([])
+    task_list = []
     for task_string in new_tasks:
         task_parts = task_string.strip().split(".", 1)
         if len(task_parts) == 2:
             task_id = int(task_parts[0].strip())
             task_name = task_parts[1].strip()
-            task_list.append({"id": task_id, "name": task_name})
-    globals_["task_list"] = task_list
+            task_list.append(Task(task_id, task_name))
+    if TRACK_TASK_DEPENDENCIES:
+        carry_over_dependencies(globals_["task_list"], task_list)
+    get_task_store(globals_).replace(task_list)
     globals_["current_task"] = {}
     print("\033[94m\033[1m" + "\n***** RE-PRIORITIZED LIST *****\n" + "\033[0m\033[0m")
     for t in task_list:
@@ -228,28 +536,364 @@ def task_prioritization_handler(response: str, globals_: dict):
     return "done"
 
 
+def incremental_prioritization_handler(response: str, globals_: dict):
+    """
+    This function handles the GPT response to the prompt built by the task
+    prioritization prompt builder in incremental mode: a full numbered list
+    re-ranks the queue, a list of ratings only re-scores the new tasks and
+    no response means the local scores are kept.
+    """
+    queue = get_task_queue(globals_)
+    kind = queue.pending_prioritization
+    if kind == "full":
+        names = []
+        for task_string in response.split("\n"):
+            task_parts = task_string.strip().split(".", 1)
+            if len(task_parts) == 2:
+                names.append(task_parts[1].strip())
+        queue.reorder(names)
+    elif kind == "scores":
+        for task_string in response.split("\n"):
+            task_parts = task_string.strip().split(".", 1)
+            if len(task_parts) == 2:
+                try:
+                    rating = float(task_parts[1].strip())
+                    queue.set_score(int(task_parts[0].strip()), rating / 10)
+                except ValueError:
+                    continue
+    queue.mark_prioritized(full=kind == "full")
+    globals_["current_task"] = {}
+    print("\033[94m\033[1m" + "\n***** RE-PRIORITIZED LIST *****\n" + "\033[0m\033[0m")
+    for t in queue:
+        print(str(t["id"]) + ": " + t["name"])
+    return "done"
+
+
+def get_task_queue(globals_: dict) -> TaskQueue:
+    """Get the task queue, converting the task list on first use."""
+    if not isinstance(globals_["task_list"], TaskQueue):
+        globals_["task_list"] = TaskQueue(globals_["task_list"])
+    return globals_["task_list"]
+
+
+def get_task_store(globals_: dict) -> TaskStore:
+    """Get the task store, converting a task list deque on first use."""
+    if not isinstance(globals_["task_list"], TaskStore):
+        globals_["task_list"] = TaskStore(globals_["task_list"])
+    return globals_["task_list"]
+
+
+def carry_over_dependencies(old_tasks: Iterable[Task], new_tasks: List[Task]) -> None:
+    """
+    Re-attach the dependencies of tasks to their re-numbered counterparts
+    after re-prioritization, matching tasks by name. Dependencies on tasks
+    that can no longer be found are dropped.
+    """
+    new_ids = {}
+    new_tasks_by_name = {t["name"]: t for t in new_tasks}
+    for task in old_tasks:
+        if task["name"] in new_tasks_by_name:
+            new_ids[task["id"]] = new_tasks_by_name[task["name"]]["id"]
+    for task in old_tasks:
+        new_task = new_tasks_by_name.get(task["name"])
+        depends_on = [
+            new_ids[id_] for id_ in task.get("depends_on", []) if id_ in new_ids
+        ]
+        if new_task is not None and depends_on:
+            new_task["depends_on"] = depends_on
+
+
 def get_ada_embedding(text):
     text = text.replace("\n", " ")
-    return openai.Embedding.create(input=[text], model="text-embedding-ada-002")[
-        "data"
-    ][0]["embedding"]
+    return embedding_cache.get_or_compute(
+        text, EMBEDDING_MODEL, embedding_batcher.embed
+    )
+
+
+def create_embeddings(texts: List[str]) -> List[List[float]]:
+    """Embed a batch of texts with a single request to the embeddings endpoint."""
+    data = openai.Embedding.create(input=texts, model=EMBEDDING_MODEL)["data"]
+    return [item["embedding"] for item in sorted(data, key=lambda x: x["index"])]
+
+
+embedding_batcher = EmbeddingBatcher(
+    create_embeddings,
+    max_batch_size=EMBEDDING_BATCH_SIZE,
+    max_wait=EMBEDDING_BATCH_WAIT,
+)
+
+
+def get_ada_embeddings(texts: List[str]) -> List[List[float]]:
+    """Embed texts, with a single request for all the ones not cached."""
+    texts = [text.replace("\n", " ") for text in texts]
+    embeddings = [embedding_cache.get(text, EMBEDDING_MODEL) for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        computed = create_embeddings([texts[i] for i in missing])
+        for i, embedding in zip(missing, computed):
+            embedding_cache.put(texts[i], EMBEDDING_MODEL, embedding)
+            embeddings[i] = embedding
+    return embeddings
+
+
+# the embeddings of the results queued in the write-behind buffer, by text,
+# submitted when a result is queued and shared by pending_matches and
+# upsert_results so that each result is embedded once
+pending_embeddings: Dict[str, Future] = {}
+pending_embeddings_lock = threading.Lock()
+
+
+def submit_embedding(text: str) -> None:
+    """Start embedding a result queued in the write-behind buffer."""
+    text = text.replace("\n", " ")
+    if embedding_cache.get(text, EMBEDDING_MODEL) is not None:
+        return
+    with pending_embeddings_lock:
+        if text not in pending_embeddings:
+            pending_embeddings[text] = embedding_batcher.submit(text)
+
+
+def get_pending_embeddings(
+    texts: List[str], release: bool = False
+) -> List[List[float]]:
+    """
+    Embed queued results, waiting for the embeddings submitted when they
+    were queued and embedding the others, like the ones that failed.
+
+    Args:
+        texts (List[str]): The texts of the results
+        release (bool): Whether to forget the submitted embeddings, once the
+            results are written
+
+    Returns:
+        List[List[float]]: The embeddings of the texts
+    """
+    texts = [text.replace("\n", " ") for text in texts]
+    with pending_embeddings_lock:
+        futures = [pending_embeddings.get(text) for text in texts]
+    embeddings: List[Optional[List[float]]] = [None] * len(texts)
+    for i, future in enumerate(futures):
+        if future is None:
+            continue
+        try:
+            embeddings[i] = future.result()
+        except Exception:  # pylint: disable=broad-except
+            continue
+        # a result being written stays pending, its lookups now hit the cache
+        embedding_cache.put(texts[i], EMBEDDING_MODEL, embeddings[i])
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        computed = get_ada_embeddings([texts[i] for i in missing])
+        for i, embedding in zip(missing, computed):
+            embeddings[i] = embedding
+    if release:
+        with pending_embeddings_lock:
+            for text in texts:
+                pending_embeddings.pop(text, None)
+    return embeddings
+
+
+def upsert_results(records: List[Record], namespace: str = "") -> None:
+    """
+    Embed task results and upsert them into the index in one call.
+
+    Args:
+        records (List[Record]): The results, as (id, text, metadata)
+        namespace (str): The namespace of the agent
+    """
+    embeddings = get_pending_embeddings([text for _, text, _ in records], release=True)
+    vectors = [
+        (id_, embedding, metadata)
+        for (id_, _, metadata), embedding in zip(records, embeddings)
+    ]
+    if USE_LOCAL_VECTOR_STORE:
+        version = get_index().upsert(vectors, namespace=namespace)["version"]
+    else:
+        get_index().upsert(vectors, namespace=namespace)
+        with pinecone_versions_lock:
+            version = pinecone_versions.get(namespace, 0) + 1
+            pinecone_versions[namespace] = version
+    if RETRIEVAL_CACHE:
+        retrieval_cache.merge(namespace, version, vectors)
+
+
+def get_index_version(namespace: str = "") -> int:
+    """Get the write version of a namespace of the index."""
+    if USE_LOCAL_VECTOR_STORE:
+        return get_index().get_version(namespace)
+    with pinecone_versions_lock:
+        return pinecone_versions.get(namespace, 0)
+
+
+result_writer = WriteBehindBuffer(
+    upsert_results,
+    max_batch_size=WRITE_BEHIND_BATCH_SIZE,
+    max_age=WRITE_BEHIND_MAX_AGE,
+)
+
+
+def flush_results(timeout: Optional[float] = None) -> bool:
+    """
+    Write the task results queued by the write-behind buffer, to call
+    before an agent stops so that no result is lost.
+
+    Args:
+        timeout (Optional[float]): The maximum seconds to wait
+
+    Returns:
+        bool: Whether every result was written in time
+    """
+    return result_writer.flush(timeout)
+
+
+def pending_matches(query_embedding: List[float], namespace: str = "") -> List[Match]:
+    """
+    Score the task results not written to the index yet against a query,
+    so that an agent retrieves its own latest results.
+
+    Args:
+        query_embedding (List[float]): The embedding of the query
+        namespace (str): The namespace of the agent
+
+    Returns:
+        List[Match]: The pending results, with their cosine similarity
+    """
+    records = result_writer.pending(namespace)
+    if not records:
+        return []
+    vectors = np.array(
+        get_pending_embeddings([text for _, text, _ in records]), np.float32
+    )
+    query = np.asarray(query_embedding, np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    norms[norms == 0] = 1.0
+    scores = vectors @ query / norms
+    return [
+        Match(id_, float(score), metadata)
+        for (id_, _, metadata), score in zip(records, scores)
+    ]
+
+
+def get_result_history(globals_: dict) -> ResultHistory:
+    """Get the result history of the agent, creating it on first use."""
+    if "result_history" not in globals_:
+        summarizer = None
+        if LLM_SUMMARY:
+            summarizer = functools.partial(summarize_results, globals_["objective"])
+        globals_["result_history"] = ResultHistory(
+            window=RESULT_HISTORY_WINDOW,
+            batch=RESULT_HISTORY_BATCH,
+            path=RESULT_HISTORY_PATH or None,
+            namespace=globals_.get("namespace", ""),
+            summarizer=summarizer,
+            summary_budget=RESULT_SUMMARY_BUDGET,
+            packer=context_packer,
+        )
+    return globals_["result_history"]
+
+
+def summarize_results(objective: str, summary: str, entries: List[Entry]) -> str:
+    """
+    Fold evicted results into the rolling summary with GPT.
+
+    Args:
+        objective (str): The objective of the agent
+        summary (str): The summary so far
+        entries (List[Entry]): The evicted results
+
+    Returns:
+        str: The new summary, within the summary token budget
+    """
+    # imported here so that the actions do not depend on the LLM client
+    from llm_client import openai_call
+
+    results = "\n".join(
+        f"{task}: {context_packer.truncate(result, 100)}" for _, task, result in entries
+    )
+    prompt = result_summary_template.format(
+        objective=objective,
+        summary=summary or "(empty)",
+        results=results,
+        words=RESULT_SUMMARY_BUDGET * 3 // 4,
+    )
+    response = openai_call(prompt, max_tokens=RESULT_SUMMARY_BUDGET)
+    return context_packer.truncate(response.strip(), RESULT_SUMMARY_BUDGET)
 
 
 def get_context(globals_: dict) -> List[Tuple[str]]:
     """
     Get the current context (task list) from the dictionary state variable, globals_
     """
-    """Use Pinecone, not currently setup"""
-    if USE_PINECONE:
+    if RESULT_HISTORY:
+        # the recent results and the summary of the older ones come first
+        history = get_result_history(globals_).context_items()
+        return history + list(get_task_context(globals_))
+    return get_task_context(globals_)
+
+
+def get_task_context(globals_: dict) -> List[Tuple[str]]:
+    """
+    Get the tasks of the context: the tasks whose results are the most
+    relevant to the objective or, without a vector store, the pending tasks.
+    """
+    """Use the vector store (local or Pinecone), not used by default"""
+    if vector_store_enabled():
         query = globals_["objective"]
-        query_embedding = get_ada_embedding(query)
-        index = pinecone.Index(index_name=PINECONE_TABLE)
-        results = index.query(query_embedding, top_k=5, include_metadata=True)
-        sorted_results = sorted(results.matches, key=lambda x: x.score, reverse=True)
+        namespace = globals_.get("namespace", "")
+        version = get_index_version(namespace)
+        cached = None
+        if RETRIEVAL_CACHE:
+            cached = retrieval_cache.get(namespace, query, 5, version)
+        if cached is not None:
+            query_embedding, matches = cached.embedding, list(cached.matches)
+        else:
+            query_embedding = get_ada_embedding(query)
+            index = get_index()
+            results = index.query(
+                query_embedding,
+                top_k=5,
+                include_metadata=True,
+                namespace=namespace,
+            )
+            matches = list(results.matches)
+            if RETRIEVAL_CACHE:
+                retrieval_cache.put(
+                    namespace, query, 5, version, query_embedding, matches
+                )
+        pending = pending_matches(query_embedding, namespace) if WRITE_BEHIND else []
+        if pending:
+            # a pending result replaces the stored version of the same id
+            pending_ids = {match.id for match in pending}
+            matches = [match for match in matches if match.id not in pending_ids]
+            matches += pending
+        sorted_results = sorted(matches, key=lambda x: x.score, reverse=True)[:5]
         return [(str(item.metadata["task"])) for item in sorted_results]
     return globals_["task_list"]
 
 
+def format_context_item(item) -> str:
+    """Format a context item, a task or a retrieved task name, as a line."""
+    if isinstance(item, (Task, dict)):
+        return f"{item['id']}. {item['name']}"
+    return str(item)
+
+
+def get_packed_context(globals_: dict, budget: int) -> str:
+    """
+    Get the current context packed into a token budget, keeping the items
+    in the order they are ranked by get_context (priority or relevance).
+
+    Args:
+        globals_ (dict): The globals dictionary
+        budget (int): The maximum number of tokens of the context
+
+    Returns:
+        str: The context, one item per line
+    """
+    items = (format_context_item(item) for item in get_context(globals_))
+    return context_packer.pack(items, budget)
+
+
 def task_stop_or_not_prompt_builder(globals_: dict) -> str:
     """
     This function builds and returns the task stop or not prompt for GPT
@@ -262,7 +906,7 @@ def task_stop_or_not_prompt_builder(globals_: dict) -> str:
     Returns:
         str: The prompt for GPT task stop or not
     """
-    context = get_context(globals_)
+    context = get_packed_context(globals_, CONTEXT_TOKEN_BUDGETS["task_stop_or_not"])
     return task_stop_or_not_template.format(
         objective=globals_["objective"], context=context
     )
@@ -275,7 +919,7 @@ def task_stop_or_not_handler(response: str, globals_: dict) -> None:
     the resultant GPT response that is reasoning about the objective
     completeness when the user stops the agent loop.
     """
-    globals_["keep_going"] = response.strip().lower() != "yes"
+    globals_["keep_going"] = response.strip().lower().rstrip(".") != "yes"
     print("\033[94m\033[1m" + "\n*****TASK CONTINUATION*****\n" + "\033[0m\033[0m")
     print(globals_["keep_going"])
     return "done" if globals_["keep_going"] else "stop"
@@ -1,41 +1,97 @@
+import functools
+import os
 import sys
 from threading import Thread
-
-# AEA dependencies
-from aea_ledger_ethereum import EthereumCrypto
-from aea.aea_builder import AEABuilder
-from aea.crypto.helpers import PRIVATE_KEY_PATH_SCHEMA, create_private_key
+from typing import Optional
 
 # agent_babyagi dependencies
 # build_fsm_and_skill builds the skill we add to the AEA
 # create_memory creates the shared state used by the AEA to move between actions
-from agent_babyagi import build_fsm_and_skill, create_memory
-
-# Create a dummy private key for the AEA wallet
-PRIVATE_KEY_FILE = PRIVATE_KEY_PATH_SCHEMA.format(EthereumCrypto.identifier)
-create_private_key(EthereumCrypto.identifier, PRIVATE_KEY_FILE)
+from agent_babyagi import (
+    build_fsm_and_skill,
+    create_memory,
+    resume_state,
+    set_shared_state,
+)
+from actions import flush_results
+from state_journal import STATE_JOURNAL_PATH, open_journal
+
+# the ledger of the AEA wallet, its crypto plugin is imported on first use
+LEDGER_ID = os.getenv("AEA_LEDGER_ID", "ethereum")
+
+# flag to run the LLM calls of the states off the AEA's main loop, so that its
+# other behaviours, handlers and connections keep running in the meantime
+NON_BLOCKING_STATES = True
+
+
+def get_private_key_file(
+    ledger_id: str = LEDGER_ID, private_key_file: Optional[str] = None
+) -> str:
+    """
+    Get the private key file of the AEA wallet, creating a dummy key the
+    first time it is needed instead of on every import.
 
+    Args:
+        ledger_id (str): the ledger of the wallet
+        private_key_file (Optional[str]): the key file, None for the default one
 
-def build_aea(first_task: str, objective: str):
+    Returns:
+        str: the path of the private key file
+    """
+    from aea.crypto.helpers import PRIVATE_KEY_PATH_SCHEMA, create_private_key
+
+    if private_key_file is None:
+        private_key_file = PRIVATE_KEY_PATH_SCHEMA.format(ledger_id)
+    if not os.path.exists(private_key_file):
+        create_private_key(ledger_id, private_key_file)
+    return private_key_file
+
+
+def build_aea(
+    first_task: str,
+    objective: str,
+    private_key_file: Optional[str] = None,
+    journal_path: str = STATE_JOURNAL_PATH,
+    namespace: str = "",
+):
     """Build the AEA with the babyagi skill.
 
     Args:
         first_task (str): the first task to be completed by the agent
         objective (str): the objective of the agent
+        private_key_file (Optional[str]): the key file of the AEA, None for
+            the default one
+        journal_path (str): the state journal of the agent, empty for none
+        namespace (str): the vector store namespace of the agent's results
 
     Returns:
         AEA: the AEA with the babyagi skill
     """
+    # the aea builder pulls in the crypto plugins, import it on first use
+    from aea.aea_builder import AEABuilder
+
     # instantiate the aea builder
     builder = AEABuilder()
     # set the aea name
     builder.set_name("baby_agi")
     # create the shared state object that serves as memory for the actions of the AEA
-    memory = create_memory(first_task, objective)
+    # it is restored from the journal of an interrupted run, if any
+    journal, memory, last_state, last_event = open_journal(
+        journal_path,
+        first_task,
+        objective,
+        functools.partial(create_memory, namespace=namespace),
+    )
     # add the AEA's private key
-    builder.add_private_key(EthereumCrypto.identifier, PRIVATE_KEY_FILE)
+    private_key_file = get_private_key_file(LEDGER_ID, private_key_file)
+    builder.add_private_key(LEDGER_ID, private_key_file)
     # add the babyagi skill
-    _, skill = build_fsm_and_skill(memory)
+    _, skill = build_fsm_and_skill(
+        memory,
+        resume_state(last_state, last_event),
+        journal,
+        non_blocking=NON_BLOCKING_STATES,
+    )
     # add the skill to the AEA
     builder.add_component_instance(skill)
     # Create our AEA
@@ -45,8 +101,8 @@ def build_aea(first_task: str, objective: str):
 
     # Set the AEA's agent context
     skill.skill_context.set_agent_context(my_aea.context)
-    # update the shared state of the AEA with the memory object we created above
-    skill.skill_context.shared_state.update(memory)
+    # make the memory object we created above the shared state of the AEA
+    set_shared_state(my_aea.context, memory)
     return my_aea
 
 
@@ -60,16 +116,23 @@ def run(first_task: str, objective: str):
 
     # Build AEA-GPT
     my_aea = build_aea(first_task, objective)
+    if not my_aea.context.shared_state["keep_going"]:
+        # the journaled run already stopped, there is nothing to resume
+        return
 
     # Set the AEA running in a different thread
+    t = Thread(target=my_aea.start)
+    t.start()
     try:
-        t = Thread(target=my_aea.start)
-        t.start()
+        t.join()
     except KeyboardInterrupt:
         # Shut down the AEA
         my_aea.stop()
         t.join()
         t = None
+    finally:
+        # store the task results still queued for the vector store
+        flush_results()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,9 @@
 import sys
 import os
+import contextvars
 import openai
-from collections import deque
-from typing import List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
 from dotenv import load_dotenv
 
 # AEA dependencies
@@ -16,6 +17,7 @@ from aea.context.base import AgentContext
 
 # import functions used to build the agent's actions
 from actions import (
+    flush_results,
     task_creation_prompt_builder,
     task_creation_handler,
     task_prioritization_prompt_builder,
@@ -25,6 +27,12 @@ from actions import (
     task_stop_or_not_prompt_builder,
     task_stop_or_not_handler,
 )
+from agent_state import AgentState
+from llm_client import openai_call
+from pipeline import PipelinedLoop
+from state_journal import STATE_JOURNAL_PATH, StateJournal, open_journal
+from task_scheduler import TaskScheduler
+from telemetry import TELEMETRY_PORT, telemetry
 
 load_dotenv()
 
@@ -36,6 +44,12 @@ openai.api_key = OPENAI_API_KEY
 # flag to stop the procedure
 STOP_PROCEDURE = False
 
+# flag to execute all the ready tasks of the task list at once
+PARALLEL_EXECUTION = False
+
+# flag to overlap creation/prioritization with the next task execution
+PIPELINED = False
+
 # action types definition, each action type makes two function calls: builder & handler
 # the initial action type is execution of the first task
 initial = "task_execution_1"
@@ -60,11 +74,25 @@ action_types = {
         "prompt_builder": task_stop_or_not_prompt_builder,
         "handler": task_stop_or_not_handler,
     },
+    # pipelined mode: creation and prioritization overlapped with execution
+    "task_pipelined": {
+        "prompt_builder": task_execution_prompt_builder,
+        "handler": task_execution_handler,
+    },
 }
 
 # State Machine Definition
+# pipelined loop, each state plans for the last result while executing the next task
+if PIPELINED:
+    transitions = {
+        "task_execution_1": {"done": "task_pipelined"},
+        "task_pipelined": {"done": "task_pipelined"},
+    }
+    if STOP_PROCEDURE:
+        transitions["task_pipelined"] = {"done": "task_stop_or_not"}
+        transitions["task_stop_or_not"] = {"done": "task_pipelined", "stop": None}
 # Ending states, adds the option to stop the procedure and execute task_stop_or_not
-if STOP_PROCEDURE:
+elif STOP_PROCEDURE:
     transitions = {
         "task_execution_1": {"done": "task_creation"},
         "task_creation": {"done": "task_execution_2"},
@@ -86,56 +114,112 @@ class SimpleStateBehaviour(State):
     def act(self) -> None:
         """
         Act implementation.
+
+        A non blocking state runs its action in a worker thread: the first act
+        submits it and returns, the next ones poll it until it is done, so the
+        agent's main loop keeps handling messages in the meantime.
         """
-        # get the action type
-        action_type = action_types[self.name]
-        # get the prompt builder for the action type
-        builder_ = action_type["prompt_builder"]
-        # build the prompt using the shared state from the Agent's context
-        prompt = builder_(self.context.shared_state)
-        # use the prompt above to input into GPT to get the response
-        response = self.openai_call(prompt)
-        # get the handler for the action type
-        handler_ = action_type["handler"]
-        # get the event to trigger from the handler
-        event_to_trigger = handler_(response, self.context.shared_state)
+        if not self.non_blocking:
+            self.finish(self.run())
+            return
+        if self._running is None:
+            # clear the event of the last visit, the state is not done yet
+            self._event = None
+            self._running = self.executor.submit(
+                contextvars.copy_context().run, self.run
+            )
+            return
+        if self._running.done():
+            running, self._running = self._running, None
+            self.finish(running.result())
+
+    # whether the action runs in the worker thread, set by build_fsm_and_skill
+    non_blocking = False
+
+    # the worker thread of the non blocking states, the FSM runs one at a time
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-state")
+
+    # the action running in the worker thread, if any
+    _running: Optional[Future] = None
+
+    def finish(self, event_to_trigger: Optional[str]) -> None:
+        """Journal the state and set the event that makes it done."""
+        self.record(event_to_trigger)
         self.executed = True
         self._event = event_to_trigger
 
-    @staticmethod
-    def openai_call(
-        prompt: str,
-        use_gpt4: bool = False,
-        temperature: float = 0.5,
-        max_tokens: int = 200,
-    ):
-        if use_gpt4:
-            messages = [{"role": "user", "content": prompt}]
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                n=1,
-                stop=None,
-            )
-            return response.choices[0].message.content.strip()
-        response = openai.Completion.create(
-            engine="text-davinci-003",
-            prompt=prompt,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        )
-        return response.choices[0].text.strip()
+    def run(self) -> Optional[str]:
+        """
+        Run the action of the state.
+
+        Returns:
+            Optional[str]: the event to trigger
+        """
+        # get the action type
+        action_type = action_types[self.name]
+        # record the timings and token usage of each phase of the state
+        with telemetry.action(self.name) as record:
+            # get the prompt builder for the action type
+            builder_ = action_type["prompt_builder"]
+            # build the prompt using the shared state from the Agent's context
+            with record.phase("build"):
+                prompt = builder_(self.context.shared_state)
+            # use the prompt above to input into GPT to get the response, builders
+            # return no prompt when the action needs no GPT call
+            with record.phase("llm"):
+                response = self.openai_call(prompt) if prompt is not None else None
+            # get the handler for the action type
+            handler_ = action_type["handler"]
+            # get the event to trigger from the handler
+            with record.phase("handler"):
+                event_to_trigger = handler_(response, self.context.shared_state)
+            record.event = event_to_trigger
+        return event_to_trigger
+
+    # the LLM call is shared with the other runners, see llm_client
+    openai_call = staticmethod(openai_call)
+
+    # the journal of the shared state, set by build_fsm_and_skill
+    journal: Optional[StateJournal] = None
+
+    def record(self, event_to_trigger: Optional[str]) -> None:
+        """Append the changes of the state to the journal, if any."""
+        if self.journal is not None:
+            self.journal.record(self.name, event_to_trigger, self.context.shared_state)
 
     def is_done(self) -> bool:
         """Get is done."""
         return self._event is not None
 
 
+class ParallelExecutionStateBehaviour(SimpleStateBehaviour):
+    """Execution state running every ready task of the task list at once."""
+
+    task_scheduler = TaskScheduler()
+
+    def run(self) -> Optional[str]:
+        """
+        Run the action of the state.
+        """
+        # execute the ready tasks and commit their results to the shared state
+        return self.task_scheduler.execute_ready(
+            self.context.shared_state, self.openai_call
+        )
+
+
+class PipelinedStateBehaviour(SimpleStateBehaviour):
+    """State running creation and prioritization alongside the next execution."""
+
+    pipeline = PipelinedLoop(openai_call)
+
+    def run(self) -> Optional[str]:
+        """
+        Run the action of the state.
+        """
+        # plan for the last result while speculatively executing the head task
+        return self.pipeline.step(self.context.shared_state)
+
+
 # instantiate FSMBehaviour class for use in constructing the agent's FSM transitions
 class MyFSMBehaviour(FSMBehaviour):
     def setup(self):
@@ -150,20 +234,41 @@ class MyFSMBehaviour(FSMBehaviour):
 def create_memory(
     first_task: str,
     objective: str,
-) -> dict:
-    """Create the shared memory."""
-    memory = {
-        "objective": objective,
-        "task_list": deque([]),
-        "current_task": {},
-        "result": {"data": first_task},
-        "keep_going": True,
-    }
-    memory["task_list"].append({"id": 1, "name": first_task})
-    return memory
+    namespace: str = "",
+) -> AgentState:
+    """Create the shared memory, its results in a namespace of the vector store."""
+    return AgentState(
+        objective, first_task=first_task, result=first_task, namespace=namespace
+    )
+
+
+def set_shared_state(agent_context: AgentContext, memory: dict) -> None:
+    """
+    Make memory the shared state of an agent context, instead of copying its
+    keys into the context's plain dict, so that an AgentState keeps its type.
+    """
+    # the context has no setter for its shared state
+    agent_context._shared_state = memory  # pylint: disable=protected-access
 
 
-def build_fsm_and_skill(memory: dict) -> tuple[MyFSMBehaviour, Skill]:
+def resume_state(last_state: Optional[str], last_event: Optional[str]) -> Optional[str]:
+    """
+    Get the state to start from, after the last journaled state and event,
+    or None when the journaled run already stopped.
+    """
+    if last_state is None:
+        return initial
+    if last_event == "stop":
+        return None
+    return transitions.get(last_state, {}).get(last_event) or initial
+
+
+def build_fsm_and_skill(
+    memory: dict,
+    initial_state: Optional[str] = initial,
+    journal: Optional[StateJournal] = None,
+    non_blocking: bool = False,
+) -> tuple[MyFSMBehaviour, Skill]:
     """
     Build the FSM object and the Skill object. The FSM is built by loading
     all the Simple state behaviours and their respective transition
@@ -176,6 +281,11 @@ def build_fsm_and_skill(memory: dict) -> tuple[MyFSMBehaviour, Skill]:
 
     Args:
         memory (dict): the agent's shared state
+        initial_state (Optional[str]): the state to start from, to resume a
+            journaled run, None for an FSM that is already done
+        journal (Optional[StateJournal]): the journal recording each state
+        non_blocking (bool): whether the states run their action in a worker
+            thread instead of the agent's main loop
 
     Returns:
         tuple[MyFSMBehaviour, Skill]: the FSM object and the Skill object
@@ -202,7 +312,7 @@ def build_fsm_and_skill(memory: dict) -> tuple[MyFSMBehaviour, Skill]:
     )
     # set the agent context
     skill_context.set_agent_context(agent_context)
-    skill_context.shared_state.update(memory)
+    set_shared_state(agent_context, memory)
     # create the FSM object
     fsm = MyFSMBehaviour(name="babyAGI-loop", skill_context=skill_context)
 
@@ -210,8 +320,16 @@ def build_fsm_and_skill(memory: dict) -> tuple[MyFSMBehaviour, Skill]:
     for key in action_types.keys():
         if key not in transitions:
             continue
-        behaviour = SimpleStateBehaviour(name=key, skill_context=skill_context)
-        is_initial = key == initial
+        if key == "task_pipelined":
+            state_class = PipelinedStateBehaviour
+        elif PARALLEL_EXECUTION and key.startswith("task_execution"):
+            state_class = ParallelExecutionStateBehaviour
+        else:
+            state_class = SimpleStateBehaviour
+        behaviour = state_class(name=key, skill_context=skill_context)
+        behaviour.journal = journal
+        behaviour.non_blocking = non_blocking
+        is_initial = key == initial_state
         fsm.register_state(str(behaviour.name), behaviour, initial=is_initial)
         for event, target_behaviour_name in transitions[key].items():
             fsm.register_transition(str(behaviour.name), target_behaviour_name, event)
@@ -230,10 +348,12 @@ class BabyAGI(Agent):
         identity: Identity,
         memory: dict,
         connections: List[Connection] = None,
+        initial_state: Optional[str] = initial,
+        journal: Optional[StateJournal] = None,
     ):
         """Initialise the agent."""
         super().__init__(identity, connections)
-        fsm, _ = build_fsm_and_skill(memory)
+        fsm, _ = build_fsm_and_skill(memory, initial_state, journal)
         self.fsm = fsm
 
     def act(self):
@@ -262,8 +382,14 @@ def run(first_task: str, objective: str):
         objective (str): the objective of the agent
     """
 
-    # Create the agent's shared state object
-    memory = create_memory(first_task, objective)
+    # Create the agent's shared state object, or restore it from the journal
+    journal, memory, last_state, last_event = open_journal(
+        STATE_JOURNAL_PATH, first_task, objective, create_memory
+    )
+    initial_state = resume_state(last_state, last_event)
+    if initial_state is None:
+        # the journaled run already stopped, there is nothing to resume
+        return
 
     # Create an identity for the agent
     identity = Identity(
@@ -272,8 +398,17 @@ def run(first_task: str, objective: str):
 
     print("\033[89m\033[1m" + "\n===== Agent babyAGI ONLINE =====" + "\033[0m\033[0m")
 
+    # serve the per-state metrics for Prometheus to scrape
+    if TELEMETRY_PORT:
+        telemetry.serve(TELEMETRY_PORT)
+
     # Create our Agent (without connections)
-    my_agent = BabyAGI(identity, memory)
+    my_agent = BabyAGI(
+        identity,
+        memory,
+        initial_state=initial_state,
+        journal=journal,
+    )
 
     # Set the agent running in a different thread
     try:
@@ -281,6 +416,9 @@ def run(first_task: str, objective: str):
     except KeyboardInterrupt:
         # Shut down the agent
         my_agent.stop()
+    finally:
+        # store the task results still queued for the vector store
+        flush_results()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+"""
+Agent state: a typed replacement for the globals dict of an agent, with its
+fields in slots and its tasks in a task store, that keeps the dict interface
+the actions and runners use.
+"""
+
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, Union
+
+from task_store import Task, TaskStore
+
+
+class AgentState(MutableMapping):
+    """
+    The state of an agent: its objective, pending tasks, current task, last
+    result and whether it keeps going, plus the namespace of its results.
+
+    The fields are attributes, and also the keys of a dict view, so
+    state["task_list"] is state.task_list. Keys that are not fields (like
+    the task deduplication index the actions add) are kept in a dict.
+    """
+
+    __slots__ = (
+        "objective",
+        "task_list",
+        "current_task",
+        "result",
+        "keep_going",
+        "namespace",
+        "_extra",
+    )
+
+    # the fields of the dict view
+    FIELDS = __slots__[:-1]
+
+    def __init__(
+        self,
+        objective: str,
+        first_task: str = "",
+        result: str = "",
+        namespace: str = "",
+    ) -> None:
+        """
+        Initialise the state.
+
+        Args:
+            objective (str): the objective of the agent
+            first_task (str): the first task, none if empty
+            result (str): the initial result
+            namespace (str): the vector store namespace of the results
+        """
+        self.objective = objective
+        self.task_list: Union[TaskStore, Any] = TaskStore()
+        if first_task:
+            self.task_list.append(Task(1, first_task))
+        self.current_task: Union[Task, dict] = {}
+        self.result: dict = {"data": result}
+        self.keep_going = True
+        self.namespace = namespace
+        self._extra: Dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        """Get a field or an extra key."""
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return self._extra[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        """Set a field or an extra key."""
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        """Delete an extra key, fields cannot be deleted."""
+        if key in self.FIELDS:
+            raise KeyError(f"cannot delete the field {key}")
+        del self._extra[key]
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the fields and the extra keys."""
+        yield from self.FIELDS
+        yield from self._extra
+
+    def __len__(self) -> int:
+        """Get the number of fields and extra keys."""
+        return len(self.FIELDS) + len(self._extra)
+
+    def __repr__(self) -> str:
+        """Get the representation of the dict view."""
+        return f"AgentState({dict(self)!r})"
@@ -0,0 +1,338 @@
+"""
+Benchmark: drives each runner against the local mock OpenAI server for a
+number of loops and reports throughput, per-state latency percentiles,
+framework overhead (time not spent waiting on the LLM) and peak RSS as JSON.
+With --startup, reports the cold start of each runner instead: the time
+from spawning a fresh process to the end of its first LLM call.
+
+The LLM is mocked, but tiktoken downloads its encoding the first time it
+is used, so the first run needs network access unless TIKTOKEN_CACHE_DIR
+points to a directory that already holds it. Later runs use that cache.
+
+python benchmark.py --runner all --iterations 20 --latency "lognormal:0.2,0.3"
+python benchmark.py --runner all --startup
+"""
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+# keep the runners offline and free of on-disk state
+os.environ.setdefault("OPENAI_API_KEY", "mock")
+os.environ["EMBEDDING_CACHE_PATH"] = ""
+os.environ["LLM_CACHE_MODE"] = "off"
+
+from mock_openai_server import MockOpenAIServer  # noqa: E402
+
+FIRST_TASK = "develop a task list"
+OBJECTIVE = "solve world hunger"
+# the state whose handler ends a loop of every runner
+LOOP_STATE = "task_prioritization"
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Get the q-th percentile (0-100) of a list of values, nearest rank."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class LoopRecorder:
+    """
+    Records the latency of every state of a runner, by wrapping the prompt
+    builders and handlers of its action types, and the time spent waiting
+    on the LLM client. Signals `done` after the given number of loops.
+    """
+
+    def __init__(self, iterations: int) -> None:
+        """
+        Initialise the recorder.
+
+        Args:
+            iterations (int): the number of loops to record
+        """
+        self.iterations = iterations
+        self.loops = 0
+        self.llm_time = 0.0
+        self.llm_requests = 0
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.done = threading.Event()
+        self._started = threading.local()
+        self._lock = threading.Lock()
+
+    def instrument(self, action_types: dict) -> None:
+        """Wrap the builder and handler of each action type of a runner."""
+        for name, action in action_types.items():
+            action["prompt_builder"] = self._wrap_builder(action["prompt_builder"])
+            action["handler"] = self._wrap_handler(name, action["handler"])
+
+    def instrument_llm(self, client) -> None:
+        """Wrap the blocking completion call of an LLM client."""
+        complete = client.complete
+
+        def timed_complete(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return complete(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.llm_time += time.perf_counter() - start
+                    self.llm_requests += 1
+
+        client.complete = timed_complete
+
+    def _wrap_builder(self, builder: Callable) -> Callable:
+        """Record the start of a state when its prompt is built."""
+
+        def timed_builder(globals_: dict):
+            self._started.value = time.perf_counter()
+            return builder(globals_)
+
+        return timed_builder
+
+    def _wrap_handler(self, name: str, handler: Callable) -> Callable:
+        """Record the latency of a state when its handler returns."""
+
+        def timed_handler(response, globals_: dict):
+            event = handler(response, globals_)
+            latency = time.perf_counter() - self._started.value
+            # task_execution_1/2 of the FSM are the same action
+            self.latencies[re.sub(r"_\d$", "", name)].append(latency)
+            if name == LOOP_STATE:
+                self.loops += 1
+                if self.loops >= self.iterations:
+                    globals_["keep_going"] = False
+                    self.done.set()
+            return event
+
+        return timed_handler
+
+
+def run_simple(recorder: LoopRecorder) -> None:
+    """Run the plain loop of simple_babyagi."""
+    import simple_babyagi
+
+    simple_babyagi.LOOP_DELAY = 0
+    recorder.instrument(simple_babyagi.action_types)
+    simple_babyagi.main(FIRST_TASK, OBJECTIVE)
+
+
+def _run_in_thread(start: Callable, stop: Callable, recorder: LoopRecorder) -> None:
+    """Start an agent in a thread and stop it once enough loops are recorded."""
+    thread = threading.Thread(target=start, daemon=True)
+    thread.start()
+    recorder.done.wait()
+    stop()
+    thread.join(timeout=10)
+
+
+def run_agent(recorder: LoopRecorder) -> None:
+    """Run the FSMBehaviour agent of agent_babyagi."""
+    import agent_babyagi
+    from aea.identity.base import Identity
+
+    recorder.instrument(agent_babyagi.action_types)
+    memory = agent_babyagi.create_memory(FIRST_TASK, OBJECTIVE)
+    identity = Identity(
+        name="baby_agi", address="my_address", public_key="my_public_key"
+    )
+    agent = agent_babyagi.BabyAGI(identity, memory)
+    _run_in_thread(agent.start, agent.stop, recorder)
+
+
+def run_aea(recorder: LoopRecorder) -> None:
+    """Run the full AEA of aea_babyagi."""
+    import aea_babyagi
+    import agent_babyagi
+
+    recorder.instrument(agent_babyagi.action_types)
+    my_aea = aea_babyagi.build_aea(FIRST_TASK, OBJECTIVE)
+    _run_in_thread(my_aea.start, my_aea.stop, recorder)
+
+
+RUNNERS = {"simple": run_simple, "agent": run_agent, "aea": run_aea}
+RUNNER_MODULES = {
+    "simple": "simple_babyagi",
+    "agent": "agent_babyagi",
+    "aea": "aea_babyagi",
+}
+
+
+def benchmark(
+    runner: str, iterations: int, latency: str, tasks_per_creation: int
+) -> dict:
+    """
+    Benchmark a runner in the current process.
+
+    Args:
+        runner (str): the runner name, a key of RUNNERS
+        iterations (int): the number of loops to run
+        latency (str): the mock LLM latency distribution
+        tasks_per_creation (int): the number of tasks per creation response
+
+    Returns:
+        dict: the benchmark report
+    """
+    import openai
+    from llm_client import llm_client
+
+    server = MockOpenAIServer(
+        latency=latency, tasks_per_creation=tasks_per_creation
+    ).start()
+    openai.api_base = server.url
+    recorder = LoopRecorder(iterations)
+    recorder.instrument_llm(llm_client)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        RUNNERS[runner](recorder)
+    wall_time = time.perf_counter() - start
+    server.stop()
+
+    overhead = wall_time - recorder.llm_time
+    return {
+        "runner": runner,
+        "iterations": recorder.loops,
+        "latency": latency,
+        "wall_time_sec": wall_time,
+        "iterations_per_sec": recorder.loops / wall_time,
+        "llm_requests": recorder.llm_requests,
+        "llm_wait_sec": recorder.llm_time,
+        "framework_overhead_sec": overhead,
+        "framework_overhead_per_iteration_ms": 1000 * overhead / max(recorder.loops, 1),
+        "states": {
+            name: {
+                "count": len(values),
+                "mean_ms": 1000 * sum(values) / len(values),
+                "p50_ms": 1000 * percentile(values, 50),
+                "p90_ms": 1000 * percentile(values, 90),
+                "p99_ms": 1000 * percentile(values, 99),
+            }
+            for name, values in recorder.latencies.items()
+        },
+        # kilobytes on Linux
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def first_call(runner: str) -> None:
+    """
+    Run a runner in this fresh process until its first LLM call returns,
+    then print the timings as JSON and exit. The LLM is the server at
+    OPENAI_API_BASE, started by the parent process.
+
+    Args:
+        runner (str): the runner name, a key of RUNNERS
+    """
+    start = time.perf_counter()
+    importlib.import_module(RUNNER_MODULES[runner])
+    imported = time.perf_counter()
+
+    from llm_client import llm_client
+
+    complete = llm_client.complete
+
+    def first_complete(*args, **kwargs):
+        complete(*args, **kwargs)
+        report = {
+            "import_sec": imported - start,
+            "first_llm_call_sec": time.perf_counter() - start,
+            "first_llm_call_ts": time.time(),
+        }
+        sys.__stdout__.write(json.dumps(report) + "\n")
+        sys.__stdout__.flush()
+        # the runner has no way to stop after one call
+        os._exit(0)
+
+    llm_client.complete = first_complete
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        RUNNERS[runner](LoopRecorder(iterations=1))
+
+
+def startup(runner: str, latency: str) -> dict:
+    """
+    Benchmark the cold start of a runner, in a new process.
+
+    Args:
+        runner (str): the runner name, a key of RUNNERS
+        latency (str): the mock LLM latency distribution
+
+    Returns:
+        dict: the startup report
+    """
+    server = MockOpenAIServer(latency=latency).start()
+    env = dict(os.environ, OPENAI_API_BASE=server.url)
+    command = [sys.executable, __file__, "--first-call", runner]
+    spawned = time.time()
+    process = subprocess.run(command, capture_output=True, text=True, env=env)
+    server.stop()
+    if process.returncode != 0:
+        return {"runner": runner, "error": process.stderr[-2000:]}
+    report = json.loads(process.stdout.splitlines()[-1])
+    return {
+        "runner": runner,
+        "latency": latency,
+        # interpreter start, imports and setup up to the first LLM response
+        "cold_start_sec": report.pop("first_llm_call_ts") - spawned,
+        **report,
+    }
+
+
+def main() -> None:
+    """Parse the arguments, run the benchmarks and write the reports."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runner", choices=[*RUNNERS, "all"], default="all")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--latency", default="const:0.05")
+    parser.add_argument("--tasks-per-creation", type=int, default=3)
+    parser.add_argument("--output", default="-", help="JSON file, - for stdout")
+    parser.add_argument("--startup", action="store_true", help="measure cold start")
+    parser.add_argument("--first-call", choices=RUNNERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.first_call:
+        first_call(args.first_call)
+        return
+    runners = list(RUNNERS) if args.runner == "all" else [args.runner]
+    if args.startup:
+        reports = [startup(runner, args.latency) for runner in runners]
+    elif args.runner == "all":
+        # one process per runner, so peak RSS and imports are not shared
+        reports = []
+        for runner in RUNNERS:
+            command = [sys.executable, __file__, "--runner", runner]
+            command += ["--iterations", str(args.iterations)]
+            command += ["--latency", args.latency]
+            command += ["--tasks-per-creation", str(args.tasks_per_creation)]
+            process = subprocess.run(command, capture_output=True, text=True)
+            if process.returncode != 0:
+                reports.append({"runner": runner, "error": process.stderr[-2000:]})
+                continue
+            reports.extend(json.loads(process.stdout))
+    else:
+        reports = [
+            benchmark(
+                args.runner, args.iterations, args.latency, args.tasks_per_creation
+            )
+        ]
+
+    output = json.dumps(reports, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
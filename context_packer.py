@@ -0,0 +1,109 @@
+"""
+Context packer: fills the context of a prompt template with as many ranked
+items as fit a token budget, so prompts stop growing with the task list.
+"""
+
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import tiktoken
+
+# model whose tokenizer is used to count tokens
+TOKENIZER_MODEL = "text-davinci-003"
+
+
+class ContextPacker:
+    """
+    Packs ranked text items into a token budget.
+
+    Items are taken in the given order (highest priority first) until the
+    budget is spent; the item that overflows it is truncated and the rest
+    are dropped. Token counts are cached per item text, so repacking a
+    mostly unchanged list only tokenizes the items that changed.
+    """
+
+    def __init__(
+        self, model: str = TOKENIZER_MODEL, max_cached_items: int = 65536
+    ) -> None:
+        """
+        Initialise the packer.
+
+        Args:
+            model (str): the model whose tokenizer is used
+            max_cached_items (int): the capacity of the token count cache
+        """
+        self.model = model
+        self.max_cached_items = max_cached_items
+        self._encoding: Optional[tiktoken.Encoding] = None
+        self._counts: "OrderedDict[str, int]" = OrderedDict()
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        """Get the tokenizer, loading it on first use."""
+        if self._encoding is None:
+            self._encoding = tiktoken.encoding_for_model(self.model)
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        """
+        Get the number of tokens of a text, from the cache if possible.
+
+        Args:
+            text (str): the text
+
+        Returns:
+            int: the number of tokens
+        """
+        tokens = self._counts.get(text)
+        if tokens is None:
+            tokens = len(self.encoding.encode(text))
+            self._counts[text] = tokens
+            if len(self._counts) > self.max_cached_items:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def truncate(self, text: str, budget: int) -> str:
+        """
+        Truncate a text to at most budget tokens.
+
+        Args:
+            text (str): the text
+            budget (int): the maximum number of tokens
+
+        Returns:
+            str: the text, or its longest prefix that fits the budget
+        """
+        if self.count(text) <= budget:
+            return text
+        if budget <= 1:
+            return ""
+        # keep a token for the ellipsis marking the truncation
+        tokens = self.encoding.encode(text)[: budget - 1]
+        return self.encoding.decode(tokens) + "..."
+
+    def pack(self, items: Iterable[str], budget: int, separator: str = "\n") -> str:
+        """
+        Join as many items as fit the budget, highest priority first.
+
+        Args:
+            items (Iterable[str]): the items, in priority order
+            budget (int): the maximum number of tokens
+            separator (str): the string joining the items
+
+        Returns:
+            str: the packed items
+        """
+        separator_tokens = self.count(separator) if separator else 0
+        packed = []
+        remaining = budget
+        for item in items:
+            cost = self.count(item) + (separator_tokens if packed else 0)
+            if cost > remaining:
+                remaining -= separator_tokens if packed else 0
+                truncated = self.truncate(item, remaining)
+                if truncated:
+                    packed.append(truncated)
+                break
+            packed.append(item)
+            remaining -= cost
+        return separator.join(packed)
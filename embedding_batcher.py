@@ -0,0 +1,126 @@
+"""
+Embedding batcher: coalesces concurrent embedding requests into batched
+calls to the embeddings endpoint and fans the vectors back out to callers.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import Callable, Dict, List, Optional, Tuple
+
+EmbedBatchFn = Callable[[List[str]], List[List[float]]]
+
+
+class EmbeddingBatcher:
+    """
+    A coalescing queue in front of a batched embedding function.
+
+    Callers block in `embed` while a background worker collects requests
+    until either max_batch_size texts are queued or max_wait seconds have
+    passed since the first one arrived, then issues a single batched call.
+    Identical texts within a batch are only sent once.
+    """
+
+    def __init__(
+        self,
+        embed_batch: EmbedBatchFn,
+        max_batch_size: int = 64,
+        max_wait: float = 0.01,
+    ) -> None:
+        """
+        Initialise the batcher.
+
+        Args:
+            embed_batch (EmbedBatchFn): embeds a list of texts, in order
+            max_batch_size (int): the maximum number of texts per call
+            max_wait (float): the coalescing window in seconds
+        """
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: "Queue[Tuple[str, Future]]" = Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+
+    def embed(self, text: str, timeout: Optional[float] = None) -> List[float]:
+        """
+        Embed a single text, sharing the underlying call with concurrent callers.
+
+        Args:
+            text (str): the text to embed
+            timeout (Optional[float]): the maximum time to wait in seconds
+
+        Returns:
+            List[float]: the embedding
+        """
+        return self.submit(text).result(timeout)
+
+    def submit(self, text: str) -> Future:
+        """
+        Queue a text for embedding.
+
+        Args:
+            text (str): the text to embed
+
+        Returns:
+            Future: resolves to the embedding of the text
+        """
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _ensure_worker(self) -> None:
+        """Start the background worker on first use."""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="embedding-batcher", daemon=True
+                )
+                self._worker.start()
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        """Block for the first request, then coalesce until the window closes."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        """Worker loop: collect a batch, embed it and resolve the futures."""
+        while True:
+            batch = self._collect()
+            unique: Dict[str, List[Future]] = {}
+            for text, future in batch:
+                if future.set_running_or_notify_cancel():
+                    unique.setdefault(text, []).append(future)
+            if not unique:
+                continue
+            texts = list(unique)
+            self.requests += len(batch)
+            self.batches += 1
+            try:
+                embeddings = self.embed_batch(texts)
+                if len(embeddings) != len(texts):
+                    # a short response would leave some callers waiting forever
+                    raise ValueError(
+                        f"expected {len(texts)} embeddings, got {len(embeddings)}"
+                    )
+            except Exception as e:  # pylint: disable=broad-except
+                for futures in unique.values():
+                    for future in futures:
+                        future.set_exception(e)
+                continue
+            for text, embedding in zip(texts, embeddings):
+                for future in unique[text]:
+                    future.set_result(embedding)
@@ -0,0 +1,159 @@
+"""
+Embedding cache: a two-tier, content-addressed cache for text embeddings, so
+the same text is only sent to the embeddings endpoint once, across restarts.
+"""
+
+import hashlib
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text before hashing: collapse whitespace and strip the ends."""
+    return " ".join(text.split())
+
+
+def cache_key(text: str, model: str) -> str:
+    """Get the content address of a text embedded with the given model."""
+    digest = hashlib.sha256()
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A bounded in-memory LRU in front of an SQLite table that survives
+    restarts and can be shared by several processes. Vectors are stored on
+    disk as packed float32 blobs.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_memory_items: int = 4096):
+        """
+        Initialise the cache.
+
+        Args:
+            path (Optional[str]): the SQLite file of the disk tier, or None
+                to only use the memory tier
+            max_memory_items (int): the capacity of the memory tier
+        """
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def connection(self) -> Optional[sqlite3.Connection]:
+        """Get the disk tier connection, opening it on first use."""
+        if self._connection is None and self.path is not None:
+            # wait for the writes of the other processes sharing the file
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(key TEXT PRIMARY KEY, model TEXT, vector BLOB)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        """Put an embedding in the memory tier, evicting the least recently used."""
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, text: str, model: str) -> Optional[List[float]]:
+        """
+        Get a cached embedding.
+
+        Args:
+            text (str): the embedded text
+            model (str): the embedding model
+
+        Returns:
+            Optional[List[float]]: the embedding, or None on a miss
+        """
+        key = cache_key(text, model)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+            if self.connection is not None:
+                row = self.connection.execute(
+                    "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    embedding = array("f", row[0]).tolist()
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+            self.misses += 1
+            return None
+
+    def put(self, text: str, model: str, embedding: List[float]) -> None:
+        """
+        Store an embedding in both tiers.
+
+        Args:
+            text (str): the embedded text
+            model (str): the embedding model
+            embedding (List[float]): the embedding
+        """
+        key = cache_key(text, model)
+        with self._lock:
+            self._remember(key, embedding)
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    (key, model, array("f", embedding).tobytes()),
+                )
+                self.connection.commit()
+
+    def get_or_compute(
+        self, text: str, model: str, compute: Callable[[str], List[float]]
+    ) -> List[float]:
+        """
+        Get a cached embedding, computing and storing it on a miss.
+
+        Args:
+            text (str): the text to embed
+            model (str): the embedding model
+            compute (Callable[[str], List[float]]): embeds the text on a miss
+
+        Returns:
+            List[float]: the embedding
+        """
+        embedding = self.get(text, model)
+        if embedding is None:
+            embedding = compute(text)
+            self.put(text, model, embedding)
+        return embedding
+
+    def stats(self) -> Dict[str, int]:
+        """Get the hit/miss counters of the cache."""
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+        }
+
+    def close(self) -> None:
+        """Close the disk tier connection."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
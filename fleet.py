@@ -0,0 +1,395 @@
+"""
+Fleet: runs objectives on N AEA worker processes, so that the CPU side of the
+agents (parsing, embedding math, the AEA framework) uses more than one core.
+
+Each worker has its own key and objective queue, and builds one AEA per
+objective, with a state journal and a vector store namespace of its own.
+The workers share the embedding and LLM response caches through SQLite
+files. The launcher restarts crashed workers, which resume their objective
+from its journal, aggregates their telemetry and reports the objectives
+completed per hour.
+
+python fleet.py --workers 4 "develop a task list" "solve world hunger" "cure cancer"
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from telemetry import TELEMETRY_PORT, Telemetry
+
+# directory of the workers' keys, the objectives' state journals and the caches
+FLEET_DIR = os.getenv("FLEET_DIR", "fleet")
+# the LLM response cache shared by the workers, a .db file for an SQLite table,
+# empty for llm_cache.db in the fleet directory
+FLEET_LLM_CACHE_PATH = os.getenv("FLEET_LLM_CACHE_PATH", "")
+# number of agent loops run per objective, 0 to run until the agent stops,
+# which needs the STOP_PROCEDURE of agent_babyagi
+FLEET_MAX_LOOPS = int(os.getenv("FLEET_MAX_LOOPS", "10"))
+# number of restarts of a worker before its objectives are marked failed
+FLEET_MAX_RESTARTS = int(os.getenv("FLEET_MAX_RESTARTS", "5"))
+# seconds between two telemetry reports of a worker
+FLEET_REPORT_INTERVAL = float(os.getenv("FLEET_REPORT_INTERVAL", "5"))
+
+# an objective: its id, first task and objective
+Objective = Tuple[int, str, str]
+
+
+def run_objective(
+    first_task: str,
+    objective: str,
+    private_key_file: str,
+    max_loops: int,
+    journal_path: str = "",
+    namespace: str = "",
+    poll_interval: float = 0.1,
+) -> None:
+    """
+    Run one objective on an AEA until the agent stops or max_loops loops ran.
+
+    Args:
+        first_task (str): the first task of the agent
+        objective (str): the objective of the agent
+        private_key_file (str): the key file of the AEA
+        max_loops (int): the number of loops to run, 0 for no limit
+        journal_path (str): the state journal of the objective, empty for none
+        namespace (str): the vector store namespace of the objective
+        poll_interval (float): seconds between two checks of the agent
+
+    Raises:
+        ValueError: if there is no loop limit and the agent never stops
+    """
+    import aea_babyagi
+    import agent_babyagi
+    from actions import flush_results
+    from telemetry import telemetry
+
+    if not max_loops and not agent_babyagi.STOP_PROCEDURE:
+        raise ValueError(
+            "max_loops is 0 and STOP_PROCEDURE is off, the objective would never end"
+        )
+
+    # a loop ends with a prioritization, or with a pipelined step
+    last_action = "task_prioritization"
+    if agent_babyagi.PIPELINED:
+        last_action = "task_execution"
+
+    def loops() -> float:
+        return telemetry.counters().get(("calls", last_action), 0)
+
+    my_aea = aea_babyagi.build_aea(
+        first_task, objective, private_key_file, journal_path, namespace
+    )
+    shared_state = my_aea.context.shared_state
+    start = loops()
+    thread = threading.Thread(target=my_aea.start, daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            if not shared_state.get("keep_going", True):
+                break
+            if max_loops and loops() - start >= max_loops:
+                break
+            time.sleep(poll_interval)
+    finally:
+        my_aea.stop()
+        thread.join()
+        flush_results()
+
+
+def worker_main(
+    worker_id: int,
+    objectives: multiprocessing.Queue,
+    events: multiprocessing.Queue,
+    fleet_dir: str,
+    run_id: str,
+    max_loops: int,
+    report_interval: float,
+) -> None:
+    """
+    Run the objectives of a worker's queue, one AEA at a time, until it gets
+    None. Progress and telemetry are reported as tuples on the events queue.
+
+    Args:
+        worker_id (int): the worker id
+        objectives (multiprocessing.Queue): the objectives of the worker
+        events (multiprocessing.Queue): the launcher's event queue
+        fleet_dir (str): the directory of the worker's key and journals
+        run_id (str): the id of the fleet run, in the objectives' journals
+            and namespaces
+        max_loops (int): the number of loops run per objective
+        report_interval (float): seconds between two telemetry reports
+    """
+    # configure the runner modules before they are imported
+    os.environ["LLM_CACHE_PATH"] = FLEET_LLM_CACHE_PATH or os.path.join(
+        fleet_dir, "llm_cache.db"
+    )
+    # the workers share the disk tier of the embedding cache, on by default
+    os.environ["EMBEDDING_CACHE_PATH"] = os.getenv(
+        "EMBEDDING_CACHE_PATH"
+    ) or os.path.join(fleet_dir, "embedding_cache.db")
+    from telemetry import telemetry
+
+    def report() -> None:
+        while True:
+            time.sleep(report_interval)
+            events.put(("telemetry", worker_id, telemetry.counters()))
+
+    threading.Thread(target=report, daemon=True).start()
+    private_key_file = os.path.join(fleet_dir, f"private_key_{worker_id}.txt")
+    while True:
+        item = objectives.get()
+        if item is None:
+            break
+        objective_id, first_task, objective = item
+        events.put(("started", worker_id, objective_id))
+        # a restarted worker resumes the objective from its journal, which
+        # is removed once the objective is finished
+        name = f"objective_{run_id}_{objective_id}"
+        journal_path = os.path.join(fleet_dir, name + ".jsonl")
+        try:
+            run_objective(
+                first_task, objective, private_key_file, max_loops, journal_path, name
+            )
+            error = None
+        except Exception as e:  # pylint: disable=broad-except
+            # a failing objective must not take down the worker
+            error = repr(e)
+        for path in (journal_path, journal_path + ".snapshot"):
+            if os.path.exists(path):
+                os.remove(path)
+        events.put(("finished", worker_id, objective_id, error))
+    events.put(("telemetry", worker_id, telemetry.counters()))
+
+
+class Worker:
+    """A worker process of the fleet, with its queue and its objectives."""
+
+    def __init__(self, id_: int) -> None:
+        """
+        Initialise the worker.
+
+        Args:
+            id_ (int): the worker id
+        """
+        self.id = id_
+        self.process: Optional[multiprocessing.Process] = None
+        self.queue: Optional[multiprocessing.Queue] = None
+        # the objectives given to the worker and not finished yet, in order
+        self.pending: Deque[Objective] = deque()
+        self.restarts = 0
+        # the last counters reported by the running process
+        self.counters: Dict[tuple, float] = {}
+
+
+class Fleet:
+    """
+    Supervises a fleet of worker processes running objectives.
+
+    Objectives are given to the worker with the fewest pending ones. A
+    worker that dies is started again with a new queue holding all its
+    pending objectives; the one it was running resumes from its state
+    journal. After max_restarts restarts the worker's objectives are
+    marked failed.
+    """
+
+    def __init__(
+        self,
+        workers: int = os.cpu_count() or 1,
+        fleet_dir: str = FLEET_DIR,
+        max_loops: int = FLEET_MAX_LOOPS,
+        max_restarts: int = FLEET_MAX_RESTARTS,
+        report_interval: float = FLEET_REPORT_INTERVAL,
+    ) -> None:
+        """
+        Initialise the fleet.
+
+        Args:
+            workers (int): the number of worker processes
+            fleet_dir (str): the directory of the workers' keys and journals
+            max_loops (int): the number of loops run per objective
+            max_restarts (int): the number of restarts of a worker
+            report_interval (float): seconds between two telemetry reports
+        """
+        self.fleet_dir = fleet_dir
+        self.max_loops = max_loops
+        self.max_restarts = max_restarts
+        self.report_interval = report_interval
+        self.workers = [Worker(id_) for id_ in range(workers)]
+        self.telemetry = Telemetry()
+        self.finished: Dict[int, Optional[str]] = {}
+        self._objectives: Dict[int, Objective] = {}
+        # spawned workers import the runner modules afresh, with their own config
+        self._context = multiprocessing.get_context("spawn")
+        self._events = self._context.Queue()
+        self._started: Optional[float] = None
+        # keeps the journals and namespaces of the objectives apart from the
+        # ones of other runs
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def submit(self, first_task: str, objective: str) -> int:
+        """
+        Queue an objective on the least busy worker.
+
+        Args:
+            first_task (str): the first task of the agent
+            objective (str): the objective of the agent
+
+        Returns:
+            int: the objective id
+        """
+        item = (len(self._objectives), first_task, objective)
+        self._objectives[item[0]] = item
+        worker = min(self.workers, key=lambda w: len(w.pending))
+        worker.pending.append(item)
+        if worker.queue is not None:
+            worker.queue.put(item)
+        return item[0]
+
+    def _start(self, worker: Worker) -> None:
+        """Start the process of a worker, with a queue of its pending objectives."""
+        worker.queue = self._context.Queue()
+        for item in worker.pending:
+            worker.queue.put(item)
+        worker.counters = {}
+        worker.process = self._context.Process(
+            target=worker_main,
+            args=(
+                worker.id,
+                worker.queue,
+                self._events,
+                self.fleet_dir,
+                self.run_id,
+                self.max_loops,
+                self.report_interval,
+            ),
+            name=f"fleet-worker-{worker.id}",
+            daemon=True,
+        )
+        worker.process.start()
+
+    def _handle(self, event: tuple) -> None:
+        """Apply an event reported by a worker."""
+        kind, worker_id = event[0], event[1]
+        worker = self.workers[worker_id]
+        if kind == "telemetry":
+            # the counters are cumulative, add what changed since the last report
+            counters = event[2]
+            delta = {
+                key: value - worker.counters.get(key, 0)
+                for key, value in counters.items()
+            }
+            self.telemetry.merge(delta)
+            worker.counters = counters
+        elif kind == "started":
+            print(f"worker {worker_id} started objective {event[2]}")
+        elif kind == "finished":
+            objective_id, error = event[2], event[3]
+            self.finished[objective_id] = error
+            worker.pending = deque(i for i in worker.pending if i[0] != objective_id)
+            status = "failed: " + error if error else "done"
+            print(f"worker {worker_id} finished objective {objective_id} ({status})")
+
+    def _supervise(self) -> None:
+        """Restart the workers that died with pending objectives."""
+        for worker in self.workers:
+            if worker.process is None or worker.process.is_alive():
+                continue
+            if not worker.pending:
+                continue
+            if worker.restarts >= self.max_restarts:
+                for objective_id, _, _ in worker.pending:
+                    self.finished[objective_id] = "worker kept crashing"
+                worker.pending.clear()
+                continue
+            worker.restarts += 1
+            print(f"worker {worker.id} died, restart {worker.restarts}")
+            self._start(worker)
+
+    def run(self) -> dict:
+        """
+        Start the workers and supervise them until every objective is finished.
+
+        Returns:
+            dict: the report of the run, see report
+        """
+        os.makedirs(self.fleet_dir, exist_ok=True)
+        self._started = time.perf_counter()
+        for worker in self.workers:
+            self._start(worker)
+        while len(self.finished) < len(self._objectives):
+            try:
+                self._handle(self._events.get(timeout=1))
+            except queue.Empty:
+                pass
+            self._supervise()
+        for worker in self.workers:
+            worker.queue.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=30)
+        # the last telemetry reports of the workers
+        while True:
+            try:
+                self._handle(self._events.get_nowait())
+            except queue.Empty:
+                break
+        return self.report()
+
+    def report(self) -> dict:
+        """Get the throughput of the fleet: the objectives completed per hour."""
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        completed = sum(error is None for error in self.finished.values())
+        return {
+            "workers": len(self.workers),
+            "objectives": len(self._objectives),
+            "completed": completed,
+            "failed": len(self.finished) - completed,
+            "restarts": sum(worker.restarts for worker in self.workers),
+            "seconds": elapsed,
+            "objectives_per_hour": completed * 3600 / elapsed if elapsed else 0.0,
+        }
+
+
+def run_fleet(
+    first_task: str, objectives: List[str], workers: int, max_loops: int
+) -> dict:
+    """Run objectives on a fleet of workers and get its report."""
+    fleet = Fleet(workers=workers, max_loops=max_loops)
+    for objective in objectives:
+        fleet.submit(first_task, objective)
+    if TELEMETRY_PORT:
+        fleet.telemetry.serve(TELEMETRY_PORT)
+    try:
+        return fleet.run()
+    finally:
+        fleet.telemetry.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("first_task")
+    parser.add_argument("objectives", nargs="+")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--max-loops", type=int, default=FLEET_MAX_LOOPS)
+    parser.add_argument(
+        "--scaling",
+        action="store_true",
+        help="run the objectives with 1, 2, 4, ... up to --workers workers",
+    )
+    args = parser.parse_args()
+    counts = [args.workers]
+    if args.scaling:
+        counts = [2**i for i in range(args.workers.bit_length()) if 2**i < args.workers]
+        counts.append(args.workers)
+    reports = [
+        run_fleet(args.first_task, args.objectives, count, args.max_loops)
+        for count in counts
+    ]
+    print(json.dumps(reports, indent=2))
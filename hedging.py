@@ -0,0 +1,147 @@
+"""
+Hedging: cuts the tail latency of LLM requests by sending a second, identical
+request when the first one has not returned after the usual latency of its
+action, and keeping whichever response arrives first.
+"""
+
+import bisect
+import math
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+
+class LatencyHistogram:
+    """
+    A histogram of latencies in log-spaced buckets, from min_seconds up with
+    each bucket growth times wider than the previous one.
+
+    The counts are halved every window samples, so the percentiles follow
+    the recent latencies instead of the whole history.
+    """
+
+    def __init__(
+        self,
+        min_seconds: float = 0.01,
+        max_seconds: float = 600.0,
+        growth: float = 1.2,
+        window: int = 200,
+    ) -> None:
+        """
+        Initialise the histogram.
+
+        Args:
+            min_seconds (float): the upper bound of the first bucket
+            max_seconds (float): the upper bound of the last bucket
+            growth (float): the ratio between two bucket bounds
+            window (int): the number of samples between two halvings
+        """
+        buckets = math.ceil(math.log(max_seconds / min_seconds, growth)) + 1
+        self.bounds: List[float] = [min_seconds * growth**i for i in range(buckets)]
+        self.counts: List[float] = [0.0] * buckets
+        self.total = 0.0
+        self.window = window
+        self._since_decay = 0
+
+    def observe(self, seconds: float) -> None:
+        """Add a latency sample."""
+        index = min(bisect.bisect_left(self.bounds, seconds), len(self.bounds) - 1)
+        self.counts[index] += 1
+        self.total += 1
+        self._since_decay += 1
+        if self._since_decay >= self.window:
+            self.counts = [count / 2 for count in self.counts]
+            self.total /= 2
+            self._since_decay = 0
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Get the latency below which a share q of the samples fall.
+
+        Args:
+            q (float): the share, in [0, 1]
+
+        Returns:
+            Optional[float]: the upper bound of the bucket of the percentile,
+            or None without samples
+        """
+        if self.total <= 0:
+            return None
+        target = q * self.total
+        seen = 0.0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.bounds[-1]
+
+
+class HedgingPolicy:
+    """
+    Decides when to hedge the requests of each action.
+
+    A request is hedged once it has been pending for longer than the given
+    percentile of its action's latency histogram, provided the action has
+    min_samples samples and the hedges sent stay under a share budget of
+    all the requests (plus a small burst).
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.9,
+        budget: float = 0.05,
+        min_samples: int = 20,
+        min_delay: float = 0.05,
+        burst: int = 2,
+    ) -> None:
+        """
+        Initialise the policy.
+
+        Args:
+            percentile (float): the latency percentile after which to hedge
+            budget (float): the maximum share of requests that are hedges
+            min_samples (int): the samples an action needs before hedging
+            min_delay (float): the minimum delay before a hedge, in seconds
+            burst (int): the hedges allowed over the budget
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.burst = burst
+        self.histograms: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.samples: Dict[str, int] = defaultdict(int)
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def delay(self, action: str) -> Optional[float]:
+        """
+        Count a request of an action and get how long to wait before hedging it.
+
+        Args:
+            action (str): the action the request belongs to
+
+        Returns:
+            Optional[float]: the delay in seconds, or None to not hedge
+        """
+        with self._lock:
+            self.requests += 1
+            if self.samples[action] < self.min_samples:
+                return None
+            threshold = self.histograms[action].percentile(self.percentile)
+        return max(threshold, self.min_delay)
+
+    def spend(self) -> bool:
+        """Take a hedge from the budget, if there is one left."""
+        with self._lock:
+            if self.hedges >= self.budget * self.requests + self.burst:
+                return False
+            self.hedges += 1
+            return True
+
+    def observe(self, action: str, seconds: float) -> None:
+        """Add the latency of a completed request of an action."""
+        with self._lock:
+            self.histograms[action].observe(seconds)
+            self.samples[action] += 1
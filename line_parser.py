@@ -0,0 +1,55 @@
+"""
+Line parser: splits a stream of completion chunks into complete lines as
+soon as each newline arrives, so list responses can be acted upon before
+the completion finishes.
+"""
+
+from typing import Iterable, Iterator, List
+
+
+class IncrementalLineParser:
+    """Buffers text chunks and emits every complete, non-blank line."""
+
+    def __init__(self) -> None:
+        """Initialise the parser."""
+        self._buffer = ""
+
+    def feed(self, chunk: str) -> List[str]:
+        """
+        Add a chunk of text.
+
+        Args:
+            chunk (str): the next chunk of the stream
+
+        Returns:
+            List[str]: the lines completed by the chunk, stripped
+        """
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split("\n")
+        return [line.strip() for line in lines if line.strip()]
+
+    def close(self) -> List[str]:
+        """
+        End the stream.
+
+        Returns:
+            List[str]: the last line, if the stream did not end with a newline
+        """
+        line, self._buffer = self._buffer.strip(), ""
+        return [line] if line else []
+
+
+def iter_lines(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Iterate over the complete lines of a stream of text chunks.
+
+    Args:
+        chunks (Iterable[str]): the chunks of the stream
+
+    Yields:
+        str: each non-blank line, stripped, as soon as it is complete
+    """
+    parser = IncrementalLineParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.close()
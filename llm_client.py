@@ -0,0 +1,613 @@
+"""
+LLM client: the single path used by every runner to call the OpenAI
+completion endpoints, with pooled keep-alive HTTP connections, client-side
+rate limiting, retries and a synchronous facade for the existing callers.
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Iterator,
+    Optional,
+    Tuple,
+)
+
+import aiohttp
+import openai
+
+from context_packer import ContextPacker
+from hedging import HedgingPolicy
+from model_router import Decision, ModelRouter, is_chat_model, load_routes
+from rate_limiter import RateLimiter, RequestSlot, backoff_delay
+from response_cache import ResponseCache, open_response_cache, request_key
+from telemetry import telemetry
+
+COMPLETION_MODEL = "text-davinci-003"
+CHAT_MODEL = "gpt-4"
+
+# connection pool and concurrency limits, shared by all agents in the process
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "16"))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv("LLM_KEEPALIVE_TIMEOUT", "30"))
+
+# quotas of the API key, 0 for none, and retries of failed requests
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "6"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "60"))
+
+# errors worth retrying, the rate limit ones also shrink the concurrency
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIConnectionError,
+)
+
+# hedging, a second request is sent when the first one is slower than the
+# LLM_HEDGE_PERCENTILE latency of its action, for at most LLM_HEDGE_BUDGET of
+# the requests
+LLM_HEDGING = os.getenv("LLM_HEDGING", "false").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.05"))
+
+# per-action model routing, the requests of each action get the model,
+# max_tokens and temperature of its route, from the default routes overridden
+# by the LLM_ROUTES_PATH JSON file; explicit arguments take precedence. Off,
+# every request goes to text-davinci-003 as before routing was added
+LLM_ROUTING = os.getenv("LLM_ROUTING", "false").lower() == "true"
+LLM_ROUTES_PATH = os.getenv("LLM_ROUTES_PATH", "")
+LLM_ROUTE_SLO_PERCENTILE = float(os.getenv("LLM_ROUTE_SLO_PERCENTILE", "0.9"))
+
+# response cache, LLM_CACHE_MODE is one of "off", "read_write" or "replay"
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.jsonl")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "0")) or None
+
+
+class LLMClient:
+    """
+    An asyncio client for the OpenAI completion endpoints.
+
+    All requests run on an event loop owned by the client, in a background
+    thread, so that the aiohttp connection pool and the concurrency limit
+    are shared by every caller: coroutines on other event loops and plain
+    threads through the synchronous `complete` facade.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        pool_size: int = LLM_POOL_SIZE,
+        keepalive_timeout: float = LLM_KEEPALIVE_TIMEOUT,
+        response_cache: Optional[ResponseCache] = None,
+        requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+        max_retries: int = LLM_MAX_RETRIES,
+        hedging: Optional[HedgingPolicy] = None,
+        router: Optional[ModelRouter] = None,
+    ) -> None:
+        """
+        Initialise the client.
+
+        Args:
+            max_concurrency (int): the maximum number of requests in flight,
+                the actual limit adapts to rate limits and latency below it
+            pool_size (int): the maximum number of pooled connections
+            keepalive_timeout (float): seconds an idle connection is kept open
+            response_cache (Optional[ResponseCache]): the cache consulted
+                before sending a request
+            requests_per_minute (float): the RPM quota, 0 for none
+            tokens_per_minute (float): the TPM quota, 0 for none
+            max_retries (int): the number of retries of a failed request
+            hedging (Optional[HedgingPolicy]): when to hedge slow requests,
+                None to never hedge them
+            router (Optional[ModelRouter]): the routes of the actions, None
+                to send every request to the completion model
+        """
+        self.response_cache = response_cache
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.hedging = hedging
+        self.router = router
+        self.limiter = RateLimiter(
+            requests_per_minute, tokens_per_minute, max_concurrency
+        )
+        self.retries = 0
+        self._packer = ContextPacker(max_cached_items=0)
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Get the client's event loop, starting its thread on first use."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="llm-client", daemon=True
+                )
+                self._thread.start()
+        return self._loop
+
+    def submit(self, coroutine: Coroutine) -> Future:
+        """Schedule a coroutine on the client's event loop."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get the pooled session, creating it on the client's loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _decide(
+        self,
+        use_gpt4: Optional[bool],
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+    ) -> Tuple[str, Decision]:
+        """
+        Get the action of the calling context and the settings of its request:
+        the route of the action unless use_gpt4 picks the model, with the
+        temperature and max_tokens given by the caller, if any.
+        """
+        action = telemetry.current_action()
+        if use_gpt4 is not None or self.router is None:
+            model = CHAT_MODEL if use_gpt4 else COMPLETION_MODEL
+            reason = "default" if use_gpt4 is None else "explicit"
+            decision = Decision(model, 200, 0.5, reason)
+        else:
+            decision = self.router.decide(action)
+        if temperature is not None:
+            decision = decision._replace(temperature=temperature)
+        if max_tokens is not None:
+            decision = decision._replace(max_tokens=max_tokens)
+        return action, decision
+
+    def _observe(self, action: str, model: str, seconds: float) -> None:
+        """Feed the latency of a request to the router."""
+        if self.router is not None:
+            self.router.observe(action, model, seconds)
+
+    async def _complete(
+        self,
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        action: str = "none",
+    ) -> Tuple[str, Optional[dict], bool, float]:
+        """
+        Run a completion request on the client's loop, through the cache.
+        Returns the text, the usage of the response, whether it was cached
+        and the latency of the request.
+        """
+        key = None
+        if self.response_cache is not None and self.response_cache.enabled:
+            key = request_key(model, prompt, temperature, max_tokens)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached, None, True, 0.0
+        start = time.perf_counter()
+        text, usage = await self._hedged(action, prompt, model, temperature, max_tokens)
+        seconds = time.perf_counter() - start
+        self._observe(action, model, seconds)
+        if key is not None:
+            self.response_cache.put(key, text)
+        return text, usage, False, seconds
+
+    async def _hedged(self, action: str, *request: Any) -> Tuple[str, Optional[dict]]:
+        """
+        Send a completion request and, if it is still pending after the delay
+        given by the hedging policy for its action, an identical one. The
+        first successful response wins and the other request is cancelled.
+        """
+        if self.hedging is None:
+            return await self._request(*request, action)
+
+        async def timed() -> Tuple[str, Optional[dict]]:
+            start = time.perf_counter()
+            result = await self._request(*request, action)
+            self.hedging.observe(action, time.perf_counter() - start)
+            return result
+
+        first = asyncio.ensure_future(timed())
+        delay = self.hedging.delay(action)
+        if delay is not None:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if not done and self.hedging.spend():
+                return await self._race(action, first, asyncio.ensure_future(timed()))
+        return await first
+
+    @staticmethod
+    async def _race(action: str, first: asyncio.Future, hedge: asyncio.Future) -> Any:
+        """Get the first successful result of a request and its hedge."""
+        pending = {first, hedge}
+        try:
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    if future.exception() is None:
+                        telemetry.record_hedge(action, won=future is hedge)
+                        return future.result()
+                if not pending:
+                    # both failed, raise the error of the last one
+                    raise done.pop().exception()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _estimate_tokens(self, prompt: str, max_tokens: int) -> int:
+        """Estimate the tokens a request counts against the TPM quota."""
+        if not self.limiter.limits_tokens:
+            return 0
+        return len(self._packer.encoding.encode(prompt)) + max_tokens
+
+    async def _retrying(
+        self,
+        estimated_tokens: int,
+        attempt: Callable[[RequestSlot], Awaitable[Any]],
+        key: str = "",
+    ) -> Any:
+        """
+        Run the attempts of a request, each in a rate limited slot, until one
+        returns or raises an error that is not in RETRYABLE_ERRORS. Failed
+        attempts are retried after a jittered exponential backoff. The key
+        (action and model) groups the latencies the concurrency adapts to.
+        """
+        for number in itertools.count():
+            try:
+                async with self.limiter.slot(estimated_tokens, key) as slot:
+                    try:
+                        return await attempt(slot)
+                    except openai.error.RateLimitError:
+                        slot.rate_limited = True
+                        raise
+            except RETRYABLE_ERRORS as e:
+                if number >= self.max_retries:
+                    raise
+                retry_after = (getattr(e, "headers", None) or {}).get("retry-after")
+                self.retries += 1
+                await asyncio.sleep(
+                    backoff_delay(
+                        number,
+                        LLM_BACKOFF_BASE,
+                        LLM_BACKOFF_CAP,
+                        float(retry_after) if retry_after else None,
+                    )
+                )
+
+    async def _create(
+        self,
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        stream: bool = False,
+    ) -> Any:
+        """Send a completion request over the pooled session."""
+        session = await self._get_session()
+        token = openai.aiosession.set(session)
+        try:
+            if is_chat_model(model):
+                return await openai.ChatCompletion.acreate(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    n=1,
+                    stop=None,
+                    stream=stream,
+                )
+            return await openai.Completion.acreate(
+                engine=model,
+                prompt=prompt,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=1,
+                frequency_penalty=0,
+                presence_penalty=0,
+                stream=stream,
+            )
+        finally:
+            openai.aiosession.reset(token)
+
+    async def _request(
+        self,
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        action: str = "none",
+    ) -> Tuple[str, Optional[dict]]:
+        """Send a completion request of an action, rate limited and retried."""
+        estimated_tokens = self._estimate_tokens(prompt, max_tokens)
+
+        async def attempt(slot: RequestSlot) -> Tuple[str, Optional[dict]]:
+            response = await self._create(prompt, model, temperature, max_tokens)
+            usage = response.get("usage")
+            if usage and estimated_tokens:
+                slot.actual_tokens = usage["total_tokens"]
+            if is_chat_model(model):
+                return response.choices[0].message.content.strip(), usage
+            return response.choices[0].text.strip(), usage
+
+        return await self._retrying(estimated_tokens, attempt, f"{action}/{model}")
+
+    async def _stream(
+        self,
+        prompt: str,
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        emit: Callable[[str], None],
+        action: str = "none",
+    ) -> Tuple[bool, float]:
+        """
+        Run a streamed completion request on the client's loop, emitting text.
+        Returns whether the response was cached and the latency of the
+        request. Failed requests are only retried until the first chunk is
+        emitted.
+        """
+        key = None
+        if self.response_cache is not None and self.response_cache.enabled:
+            key = request_key(model, prompt, temperature, max_tokens)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                emit(cached)
+                return True, 0.0
+        chunks = []
+        estimated_tokens = self._estimate_tokens(prompt, max_tokens)
+        chat = is_chat_model(model)
+        start = time.perf_counter()
+
+        async def attempt(slot: RequestSlot) -> None:
+            try:
+                response = await self._create(
+                    prompt, model, temperature, max_tokens, stream=True
+                )
+                async for chunk in response:
+                    choice = chunk.choices[0]
+                    text = choice.delta.get("content", "") if chat else choice.text
+                    if text:
+                        chunks.append(text)
+                        emit(text)
+            except RETRYABLE_ERRORS:
+                if chunks:
+                    # part of the response was emitted, it cannot be retried
+                    raise RuntimeError("completion stream interrupted") from None
+                raise
+            if estimated_tokens:
+                completion = "".join(chunks)
+                slot.actual_tokens = (
+                    estimated_tokens
+                    - max_tokens
+                    + len(self._packer.encoding.encode(completion))
+                )
+
+        await self._retrying(estimated_tokens, attempt, f"{action}/{model}")
+        seconds = time.perf_counter() - start
+        self._observe(action, model, seconds)
+        if key is not None:
+            self.response_cache.put(key, "".join(chunks).strip())
+        return False, seconds
+
+    def stream(
+        self,
+        prompt: str,
+        use_gpt4: Optional[bool] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+    ) -> Iterator[str]:
+        """
+        Get the completion of a prompt as a stream of text chunks, in the
+        calling thread.
+
+        Args:
+            prompt (str): the prompt
+            use_gpt4 (Optional[bool]): whether to use the chat model instead
+                of the completion model, None for the model of the route
+            temperature (Optional[float]): the sampling temperature, None for
+                the one of the route
+            max_tokens (Optional[int]): the maximum number of tokens to
+                generate, None for the one of the route
+
+        Yields:
+            str: the chunks of the completion text, as they arrive
+        """
+        action, decision = self._decide(use_gpt4, temperature, max_tokens)
+        chunks: Queue = Queue()
+        done = object()
+        text = []
+        future = self.submit(
+            self._stream(
+                prompt,
+                decision.model,
+                decision.temperature,
+                decision.max_tokens,
+                chunks.put,
+                action,
+            )
+        )
+        future.add_done_callback(lambda _: chunks.put(done))
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            text.append(chunk)
+            yield chunk
+        # raise the error that ended the stream, if any
+        cached, seconds = future.result()
+        self._record(prompt, decision, ("".join(text).strip(), None, cached, seconds))
+
+    async def acomplete(
+        self,
+        prompt: str,
+        use_gpt4: Optional[bool] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """
+        Get the completion of a prompt, from any event loop.
+
+        Args:
+            prompt (str): the prompt
+            use_gpt4 (Optional[bool]): whether to use the chat model instead
+                of the completion model, None for the model of the route
+            temperature (Optional[float]): the sampling temperature, None for
+                the one of the route
+            max_tokens (Optional[int]): the maximum number of tokens to
+                generate, None for the one of the route
+
+        Returns:
+            str: the stripped completion text
+        """
+        action, decision = self._decide(use_gpt4, temperature, max_tokens)
+        coroutine = self._complete(
+            prompt, decision.model, decision.temperature, decision.max_tokens, action
+        )
+        return self._record(prompt, decision, await self._await(coroutine))
+
+    def complete(
+        self,
+        prompt: str,
+        use_gpt4: Optional[bool] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """
+        Get the completion of a prompt, blocking the calling thread.
+
+        Args:
+            prompt (str): the prompt
+            use_gpt4 (Optional[bool]): whether to use the chat model instead
+                of the completion model, None for the model of the route
+            temperature (Optional[float]): the sampling temperature, None for
+                the one of the route
+            max_tokens (Optional[int]): the maximum number of tokens to
+                generate, None for the one of the route
+
+        Returns:
+            str: the stripped completion text
+        """
+        action, decision = self._decide(use_gpt4, temperature, max_tokens)
+        result = self.submit(
+            self._complete(
+                prompt,
+                decision.model,
+                decision.temperature,
+                decision.max_tokens,
+                action,
+            )
+        ).result()
+        return self._record(prompt, decision, result)
+
+    @staticmethod
+    def _record(
+        prompt: str,
+        decision: Decision,
+        result: Tuple[str, Optional[dict], bool, float],
+    ) -> str:
+        """
+        Attribute a completion and its routing decision to the current
+        action, in the caller's context.
+        """
+        text, usage, cached, seconds = result
+        telemetry.record_usage(decision.model, prompt, text, usage, cached)
+        if not cached:
+            telemetry.record_route(decision.model, decision.reason, seconds)
+        return text
+
+    async def _await(self, coroutine: Coroutine) -> Any:
+        """Await a coroutine on the client's loop from whichever loop is running."""
+        if asyncio.get_running_loop() is self.loop:
+            return await coroutine
+        return await asyncio.wrap_future(self.submit(coroutine))
+
+    def close(self) -> None:
+        """Close the pooled connections and stop the client's loop."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        loop.close()
+
+
+# the client shared by every runner in the process
+llm_client = LLMClient(
+    hedging=(
+        HedgingPolicy(percentile=LLM_HEDGE_PERCENTILE, budget=LLM_HEDGE_BUDGET)
+        if LLM_HEDGING
+        else None
+    ),
+    router=(
+        ModelRouter(load_routes(LLM_ROUTES_PATH), percentile=LLM_ROUTE_SLO_PERCENTILE)
+        if LLM_ROUTING
+        else None
+    ),
+    response_cache=open_response_cache(
+        LLM_CACHE_PATH or None,
+        mode=LLM_CACHE_MODE,
+        max_entries=LLM_CACHE_MAX_ENTRIES,
+        ttl=LLM_CACHE_TTL,
+    ),
+)
+
+
+def openai_call(
+    prompt: str,
+    use_gpt4: Optional[bool] = None,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+) -> str:
+    """Synchronous facade over the shared client, used by the runners."""
+    return llm_client.complete(prompt, use_gpt4, temperature, max_tokens)
+
+
+async def aopenai_call(
+    prompt: str,
+    use_gpt4: Optional[bool] = None,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+) -> str:
+    """Asynchronous counterpart of `openai_call`, for callers on an event loop."""
+    return await llm_client.acomplete(prompt, use_gpt4, temperature, max_tokens)
+
+
+def openai_stream(
+    prompt: str,
+    use_gpt4: Optional[bool] = None,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+) -> Iterator[str]:
+    """Streaming facade over the shared client, yielding text chunks."""
+    return llm_client.stream(prompt, use_gpt4, temperature, max_tokens)
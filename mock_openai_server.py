@@ -0,0 +1,296 @@
+"""
+Mock OpenAI server: a local HTTP stand-in for the OpenAI completion, chat
+and embedding endpoints, so the agents can be run and benchmarked offline
+by pointing `openai.api_base` at it.
+
+python mock_openai_server.py 8000 "lognormal:0.5,0.3"
+"""
+
+import ast
+import hashlib
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+
+EMBEDDING_DIMENSION = 1536
+
+# words new task names are generated from, one of each list per name
+TASK_WORDS = (
+    ("Research", "Survey", "Analyze", "Draft", "Estimate", "Compare", "Map", "Audit"),
+    ("crop yields", "food prices", "water access", "supply chains", "soil health"),
+    ("in", "across", "for", "around"),
+    ("coastal regions", "urban slums", "drylands", "river deltas", "highlands"),
+    ("by season", "over a decade", "per household", "under drought", "at scale"),
+)
+
+
+def stub_embedding(text: str, dimension: int = EMBEDDING_DIMENSION) -> List[float]:
+    """Get a deterministic pseudo-random embedding for a text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    return [rng.uniform(-1.0, 1.0) for _ in range(dimension)]
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    Parse a latency distribution, in seconds, from a spec like "none",
+    "const:0.2", "uniform:0.1,0.5" or "lognormal:0.4,0.5" (median, sigma).
+
+    Args:
+        spec (str): the distribution spec
+
+    Returns:
+        Callable[[], float]: samples a latency
+    """
+    kind, _, args = spec.partition(":")
+    params = [float(arg) for arg in args.split(",") if arg]
+    if kind == "none":
+        return lambda: 0.0
+    if kind == "const":
+        return lambda: params[0]
+    if kind == "uniform":
+        return lambda: random.uniform(params[0], params[1])
+    if kind == "lognormal":
+        median, sigma = params
+        return lambda: median * random.lognormvariate(0.0, sigma)
+    raise ValueError(f"unknown latency distribution {spec!r}")
+
+
+class MockOpenAIServer:
+    """
+    A threaded local server answering the OpenAI endpoints used by the agents.
+
+    Completions are generated from the prompt templates of the actions: a
+    creation prompt gets a list of new tasks, a prioritization prompt gets
+    its own tasks back as a numbered list, a stop-or-not prompt gets "no"
+    and anything else gets a paragraph. Every completion request sleeps for
+    a latency sampled from the configured distribution, and a share of them
+    can be failed with rate limit errors.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: str = "none",
+        tasks_per_creation: int = 3,
+        result_words: int = 60,
+        error_rate: float = 0.0,
+    ) -> None:
+        """
+        Initialise the server.
+
+        Args:
+            host (str): the host to bind to
+            port (int): the port to bind to, 0 picks a free one
+            latency (str): the completion latency distribution, see parse_latency
+            tasks_per_creation (int): the number of tasks in a creation response
+            result_words (int): the number of words of an execution response
+            error_rate (float): the share of completion requests answered
+                with a 429 rate limit error
+        """
+        self.latency = parse_latency(latency)
+        self.tasks_per_creation = tasks_per_creation
+        self.result_words = result_words
+        self.error_rate = error_rate
+        self.requests: Counter = Counter()
+        self.inputs: Counter = Counter()
+        self._task_counter = itertools.count(1)
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """Get the base url to use as `openai.api_base`."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def generate(self, prompt: str) -> str:
+        """Generate a plausible completion for a prompt of the actions."""
+        if "task creation AI" in prompt:
+            return "\n".join(self._task_name() for _ in range(self.tasks_per_creation))
+        if "Rate the priority" in prompt:
+            ids = re.findall(r"'(\d+)\.", prompt)
+            return "\n".join(f"{id_}. {random.randint(1, 10)}" for id_ in ids)
+        if "task prioritization AI" in prompt:
+            match = re.search(r"following tasks: (\[.*?\])\. Consider", prompt, re.S)
+            names = ast.literal_eval(match.group(1)) if match else []
+            return "\n".join(f"{i}. {name}" for i, name in enumerate(names, 1))
+        if "assess task completion" in prompt:
+            return "no"
+        return " ".join(["lorem"] * self.result_words)
+
+    def _task_name(self) -> str:
+        """Generate a new task name, distinct enough not to be deduplicated."""
+        rng = random.Random(next(self._task_counter))
+        return " ".join(rng.choice(words) for words in TASK_WORDS)
+
+    def completions(self, body: dict) -> dict:
+        """Answer a completion request."""
+        prompt = body["prompt"]
+        if isinstance(prompt, list):
+            prompt = prompt[0]
+        text = self.generate(prompt)
+        return {
+            "object": "text_completion",
+            "model": body.get("model", ""),
+            "choices": [{"text": text, "index": 0, "finish_reason": "stop"}],
+            "usage": self._usage(prompt, text),
+        }
+
+    def chat_completions(self, body: dict) -> dict:
+        """Answer a chat completion request."""
+        prompt = body["messages"][-1]["content"]
+        text = self.generate(prompt)
+        return {
+            "object": "chat.completion",
+            "model": body.get("model", ""),
+            "choices": [
+                {
+                    "message": {"role": "assistant", "content": text},
+                    "index": 0,
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": self._usage(prompt, text),
+        }
+
+    @staticmethod
+    def _usage(prompt: str, text: str) -> dict:
+        """Approximate the token usage of a completion, a token per 4 chars."""
+        prompt_tokens, completion_tokens = len(prompt) // 4, len(text) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def embeddings(self, body: dict) -> dict:
+        """Answer an embeddings request."""
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        self.inputs["embeddings"] += len(inputs)
+        return {
+            "object": "list",
+            "model": body.get("model", ""),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": stub_embedding(text)}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    def _route(self, path: str) -> Optional[Callable[[dict], dict]]:
+        """Get the answering method of an endpoint path."""
+        if path.endswith("/chat/completions"):
+            return self.chat_completions
+        if path.endswith("/completions"):
+            return self.completions
+        if path.endswith("/embeddings"):
+            return self.embeddings
+        return None
+
+    def _make_handler(self) -> type:
+        """Build the request handler class bound to this server."""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:  # pylint: disable=invalid-name
+                route = server._route(self.path)
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if route is None:
+                    self.send_error(404)
+                    return
+                server.requests[route.__name__] += 1
+                if route != server.embeddings and random.random() < server.error_rate:
+                    server.requests["rate_limited"] += 1
+                    self._rate_limited()
+                    return
+                payload = route(body)
+                if route != server.embeddings:
+                    time.sleep(server.latency())
+                if body.get("stream"):
+                    self._stream(payload)
+                    return
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _rate_limited(self) -> None:
+                """Send a rate limit error, as the API does."""
+                error = {"message": "Rate limit reached", "type": "requests"}
+                data = json.dumps({"error": error}).encode("utf-8")
+                self.send_response(429)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, payload: dict) -> None:
+                """Send a completion as server-sent events, a word per event."""
+                choice = payload["choices"][0]
+                chat = "message" in choice
+                text = choice["message"]["content"] if chat else choice["text"]
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for piece in re.findall(r"\S*\s*", text):
+                    if not piece:
+                        continue
+                    delta = {"delta": {"content": piece}} if chat else {"text": piece}
+                    event = {"object": payload["object"], "choices": [delta]}
+                    delta.update(index=0, finish_reason=None)
+                    self.wfile.write(b"data: " + json.dumps(event).encode() + b"\n\n")
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return Handler
+
+    def start(self) -> "MockOpenAIServer":
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        """Serve requests in the current thread."""
+        self._httpd.serve_forever()
+
+    def stop(self) -> None:
+        """Stop serving and release the socket."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    latency = sys.argv[2] if len(sys.argv) > 2 else "none"
+    mock = MockOpenAIServer(port=port, latency=latency)
+    print(f"Serving mock OpenAI API on {mock.url}")
+    try:
+        mock.serve_forever()
+    except KeyboardInterrupt:
+        print("\033[89m\033[1m" + "\n======== EXIT ========" + "\033[0m\033[0m")
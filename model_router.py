@@ -0,0 +1,178 @@
+"""
+Model router: picks the model, max_tokens and temperature of each LLM request
+from a table keyed by the action it belongs to, so that short checks go to a
+small fast model and task execution to a larger one, and falls back to
+another model while a route is slower than its latency SLO.
+"""
+
+import json
+import math
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, NamedTuple, Optional, Tuple
+
+# the (time, seconds) latencies of the last requests of an action to a model
+Latencies = Deque[Tuple[float, float]]
+
+
+class Route(NamedTuple):
+    """The request settings of an action."""
+
+    model: str
+    max_tokens: int = 200
+    temperature: float = 0.5
+    # the latency, in seconds at the router's percentile, above which the
+    # fallback model is used instead, 0 for no SLO
+    latency_slo: float = 0.0
+    fallback: str = ""
+
+
+class Decision(NamedTuple):
+    """The settings picked for a request, and why."""
+
+    model: str
+    max_tokens: int
+    temperature: float
+    # "route", "fallback" while the route is over its SLO, "probe" for the
+    # requests that keep measuring a route over its SLO, or "explicit"
+    reason: str
+
+
+# the routes of the action_types names, task_prefetch is an early execution
+DEFAULT_ROUTES = {
+    "task_execution": Route(
+        "text-davinci-003", 400, 0.7, latency_slo=20.0, fallback="gpt-3.5-turbo"
+    ),
+    "task_prefetch": Route(
+        "text-davinci-003", 400, 0.7, latency_slo=20.0, fallback="gpt-3.5-turbo"
+    ),
+    "task_creation": Route(
+        "gpt-3.5-turbo", 200, 0.5, latency_slo=10.0, fallback="text-davinci-003"
+    ),
+    "task_prioritization": Route(
+        "gpt-3.5-turbo", 300, 0.0, latency_slo=10.0, fallback="text-davinci-003"
+    ),
+    "task_stop_or_not": Route("gpt-3.5-turbo", 10, 0.0),
+}
+# the route of the requests made outside of an action, or of unknown actions
+DEFAULT_ROUTE = Route("text-davinci-003", 200, 0.5)
+
+
+def is_chat_model(model: str) -> bool:
+    """Check whether a model is served by the chat completions endpoint."""
+    return model.startswith("gpt-")
+
+
+def load_routes(path: Optional[str]) -> Dict[str, Route]:
+    """
+    Get the default routes, overridden by the ones of a JSON file mapping
+    action names to Route fields, like {"task_execution": {"model": "gpt-4"}}.
+
+    Args:
+        path (Optional[str]): the JSON file, None for the default routes
+
+    Returns:
+        Dict[str, Route]: the routes by action name
+    """
+    routes = dict(DEFAULT_ROUTES)
+    if path:
+        with open(path, "r", encoding="utf-8") as file:
+            for action, fields in json.load(file).items():
+                routes[action] = routes.get(action, DEFAULT_ROUTE)._replace(**fields)
+    return routes
+
+
+class ModelRouter:
+    """
+    Routes the requests of each action through a routing table.
+
+    The latencies of the last window requests are kept per action and
+    model, dropping the ones older than max_age seconds. While the latency
+    percentile of a route's model is above the route's SLO, over at least
+    min_samples latencies, its requests go to the fallback model, except
+    one every probe_interval seconds that still goes to the route's model
+    so that its latency is kept measured. A route recovers once its probes
+    are fast or its slow latencies have aged out.
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, Route],
+        default: Route = DEFAULT_ROUTE,
+        percentile: float = 0.9,
+        min_samples: int = 10,
+        window: int = 20,
+        max_age: float = 300.0,
+        probe_interval: float = 30.0,
+    ) -> None:
+        """
+        Initialise the router.
+
+        Args:
+            routes (Dict[str, Route]): the routes by action name
+            default (Route): the route of the other actions
+            percentile (float): the latency percentile compared to the SLOs
+            min_samples (int): the latencies a route needs before falling back
+            window (int): the number of latencies kept per action and model
+            max_age (float): the seconds a latency is kept
+            probe_interval (float): the seconds between two requests sent to
+                a route over its SLO
+        """
+        self.routes = routes
+        self.default = default
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_age = max_age
+        self.probe_interval = probe_interval
+        self.latencies: Dict[Tuple[str, str], Latencies] = defaultdict(
+            lambda: deque(maxlen=window)
+        )
+        self._last_probe: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def route(self, action: str) -> Route:
+        """Get the route of an action."""
+        return self.routes.get(action, self.default)
+
+    def _over_slo(self, action: str, route: Route, now: float) -> bool:
+        """Check whether a route is slower than its SLO, with the lock held."""
+        latencies = self.latencies[(action, route.model)]
+        while latencies and now - latencies[0][0] > self.max_age:
+            latencies.popleft()
+        if len(latencies) < self.min_samples:
+            return False
+        ordered = sorted(seconds for _, seconds in latencies)
+        rank = math.ceil(self.percentile * len(ordered)) - 1
+        return ordered[max(rank, 0)] > route.latency_slo
+
+    def decide(self, action: str) -> Decision:
+        """
+        Pick the settings of a request of an action.
+
+        Args:
+            action (str): the action the request belongs to
+
+        Returns:
+            Decision: the model, max_tokens and temperature, and the reason
+        """
+        route = self.route(action)
+        decision = Decision(route.model, route.max_tokens, route.temperature, "route")
+        if not route.latency_slo or not route.fallback:
+            return decision
+        now = time.monotonic()
+        with self._lock:
+            if not self._over_slo(action, route, now):
+                self._last_probe.pop(action, None)
+                return decision
+            # the first fallback starts the probe interval
+            last_probe = self._last_probe.setdefault(action, now)
+            if now - last_probe >= self.probe_interval:
+                self._last_probe[action] = now
+                return decision._replace(reason="probe")
+        return decision._replace(model=route.fallback, reason="fallback")
+
+    def observe(self, action: str, model: str, seconds: float) -> None:
+        """Add the latency of a completed request of an action to a model."""
+        with self._lock:
+            self.latencies[(action, model)].append((time.monotonic(), seconds))
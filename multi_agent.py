@@ -0,0 +1,440 @@
+"""
+Multi-agent runner: hosts many objectives in one process, on one event loop,
+sharing the pooled LLM client, the embedding cache and the vector store. A
+fair scheduler interleaves the steps of the agents, and new objectives can
+be submitted at runtime from another thread or over a local socket.
+
+python multi_agent.py --port 8765 "develop a task list" "solve world hunger"
+
+echo '{"first_task": "make a plan", "objective": "end poverty"}' | nc localhost 8765
+"""
+
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+# import functions used to build the agent's actions
+from actions import (
+    flush_results,
+    task_creation_prompt_builder,
+    task_creation_handler,
+    task_prioritization_prompt_builder,
+    task_prioritization_handler,
+    task_execution_prompt_builder,
+    task_execution_handler,
+    task_stop_or_not_prompt_builder,
+    task_stop_or_not_handler,
+)
+from agent_state import AgentState
+from llm_client import aopenai_call
+from state_journal import FIELDS, StateJournal, rebuild_derived_state
+from telemetry import TELEMETRY_PORT, telemetry
+
+load_dotenv()
+
+# flag to stop the procedure
+STOP_PROCEDURE = False
+
+# maximum number of agent steps in flight at once, across all agents
+MAX_ACTIVE_STEPS = int(os.getenv("MAX_ACTIVE_STEPS", "32"))
+
+# directory of the state journals of the agents, empty to disable journaling
+MULTI_AGENT_JOURNAL_DIR = os.getenv("MULTI_AGENT_JOURNAL_DIR", "")
+
+# the journaled fields of a hosted agent: its state, its scheduling and progress
+AGENT_FIELDS = FIELDS + ("weight", "max_loops", "loops", "error")
+
+# Definition of the action types, as in simple_babyagi
+action_types = {
+    "task_creation": {
+        "prompt_builder": task_creation_prompt_builder,
+        "handler": task_creation_handler,
+    },
+    "task_prioritization": {
+        "prompt_builder": task_prioritization_prompt_builder,
+        "handler": task_prioritization_handler,
+    },
+    "task_execution": {
+        "prompt_builder": task_execution_prompt_builder,
+        "handler": task_execution_handler,
+    },
+    "task_stop_or_not": {
+        "prompt_builder": task_stop_or_not_prompt_builder,
+        "handler": task_stop_or_not_handler,
+    },
+}
+
+# the states of one loop of an agent, in order
+loop_states = ["task_execution", "task_creation", "task_prioritization"]
+if STOP_PROCEDURE:
+    loop_states.append("task_stop_or_not")
+
+
+def create_memory(first_task: str, objective: str, namespace: str = "") -> AgentState:
+    """
+    Create the shared state of a hosted agent, like agent_babyagi.create_memory.
+    The namespace keeps its results apart from the other agents' in the
+    shared vector store.
+    """
+    return AgentState(
+        objective, first_task=first_task, result=first_task, namespace=namespace
+    )
+
+
+class HostedAgent:
+    """
+    An objective hosted by the runner, with its state and loop position.
+
+    The weight, loop limit, loop count and error are mirrored in the
+    agent's memory, so that they are journaled with it.
+    """
+
+    def __init__(
+        self, id_: str, memory: dict, weight: int = 1, max_loops: int = 0
+    ) -> None:
+        """
+        Initialise the agent.
+
+        Args:
+            id_ (str): the agent id
+            memory (dict): the agent's shared state
+            weight (int): the agent's share of the steps, relative to the others
+            max_loops (int): the number of loops to run, 0 to run until stopped
+        """
+        self.id = id_
+        self.memory = memory
+        self.weight = weight
+        self.max_loops = max_loops
+        self.loops = memory.get("loops", 0)
+        self.steps = 0
+        self.position = 0
+        self.running = False
+        self.done = False
+        self.error: Optional[str] = memory.get("error")
+        memory.update(weight=weight, max_loops=max_loops, loops=self.loops)
+        # smooth weighted round robin credit
+        self.credit = 0
+        self.journal: Optional[StateJournal] = None
+
+    @property
+    def state(self) -> str:
+        """Get the name of the next state of the agent."""
+        return loop_states[self.position]
+
+    def advance(self) -> None:
+        """Move to the next state, counting the loops."""
+        self.position = (self.position + 1) % len(loop_states)
+        if self.position == 0:
+            self.loops += 1
+            self.memory["loops"] = self.loops
+        self.done = self.finished()
+
+    def finished(self) -> bool:
+        """Check whether the agent failed, stopped or ran all its loops."""
+        if self.error is not None or not self.memory["keep_going"]:
+            return True
+        return bool(self.max_loops) and self.loops >= self.max_loops
+
+
+class MultiAgentRunner:
+    """
+    Runs the agents of many objectives concurrently in one event loop.
+
+    Every agent runs one state (build, LLM call, handler) at a time, and at
+    most max_active_steps states run at once across the agents. Free step
+    slots are handed out with smooth weighted round robin, so each agent
+    gets a share of the steps proportional to its weight and agents with
+    equal weights simply take turns. Builders and handlers run in worker
+    threads, so the event loop only waits on the LLM.
+    """
+
+    def __init__(
+        self,
+        max_active_steps: int = MAX_ACTIVE_STEPS,
+        journal_dir: str = MULTI_AGENT_JOURNAL_DIR,
+    ) -> None:
+        """
+        Initialise the runner.
+
+        Args:
+            max_active_steps (int): the maximum number of steps in flight
+            journal_dir (str): the directory of the agents' state journals,
+                empty to disable journaling
+        """
+        self.max_active_steps = max_active_steps
+        self.journal_dir = journal_dir
+        self.agents: Dict[str, HostedAgent] = {}
+        self._ids = itertools.count(1)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._stopping = False
+
+    def add(
+        self, first_task: str, objective: str, weight: int = 1, max_loops: int = 0
+    ) -> str:
+        """
+        Host a new objective, from the runner's loop.
+
+        Args:
+            first_task (str): the first task of the agent
+            objective (str): the objective of the agent
+            weight (int): the agent's share of the steps
+            max_loops (int): the number of loops to run, 0 to run until stopped
+
+        Returns:
+            str: the id of the new agent
+        """
+        id_ = f"agent_{next(self._ids)}"
+        memory = create_memory(first_task, objective, namespace=id_)
+        agent = HostedAgent(id_, memory, max(weight, 1), max_loops)
+        if self.journal_dir:
+            agent.journal = StateJournal(
+                os.path.join(self.journal_dir, id_ + ".jsonl"), fields=AGENT_FIELDS
+            )
+            agent.journal.reset()
+            agent.journal.track(memory)
+        self.agents[id_] = agent
+        print("\033[89m\033[1m" + f"\n=== {id_} ONLINE: {objective} ===" + "\033[0m")
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return id_
+
+    def submit(
+        self, first_task: str, objective: str, weight: int = 1, max_loops: int = 0
+    ) -> str:
+        """
+        Host a new objective, from any thread, while the runner is running.
+
+        Returns:
+            str: the id of the new agent
+        """
+        if self._loop is None:
+            return self.add(first_task, objective, weight, max_loops)
+        future = asyncio.run_coroutine_threadsafe(
+            self._add(first_task, objective, weight, max_loops), self._loop
+        )
+        return future.result()
+
+    def resume(self) -> List[str]:
+        """
+        Host again the agents journaled in journal_dir by a previous run, each
+        at the state after its last journaled one. The agents that failed,
+        stopped, ran all their loops or ran out of tasks are not resumed.
+
+        Returns:
+            List[str]: the ids of the resumed agents
+        """
+        if not self.journal_dir:
+            return []
+        os.makedirs(self.journal_dir, exist_ok=True)
+        resumed = []
+        paths = glob.glob(os.path.join(self.journal_dir, "agent_*.jsonl"))
+        for path in paths:
+            id_ = os.path.basename(path)[: -len(".jsonl")]
+            journal = StateJournal(path, fields=AGENT_FIELDS)
+            restored = journal.restore()
+            if restored is None:
+                continue
+            memory, last_state, _ = restored
+            agent = HostedAgent(
+                id_, memory, memory.get("weight", 1), memory.get("max_loops", 0)
+            )
+            if last_state in loop_states:
+                agent.position = (loop_states.index(last_state) + 1) % len(loop_states)
+            exhausted = agent.state == "task_execution" and not memory["task_list"]
+            if agent.finished() or exhausted:
+                journal.close()
+                continue
+            rebuild_derived_state(memory, journal)
+            agent.journal = journal
+            self.agents[id_] = agent
+            resumed.append(id_)
+        # new agents are numbered after every journaled one, finished or not
+        numbers = [
+            int(os.path.basename(path)[: -len(".jsonl")].rsplit("_", 1)[1])
+            for path in paths
+        ]
+        self._ids = itertools.count(max(numbers, default=0) + 1)
+        return resumed
+
+    async def _add(self, *args) -> str:
+        """Host a new objective, as a coroutine on the runner's loop."""
+        return self.add(*args)
+
+    def _pick(self) -> Optional[HostedAgent]:
+        """Pick the next agent to step, by smooth weighted round robin."""
+        ready = [a for a in self.agents.values() if not a.running and not a.done]
+        if not ready:
+            return None
+        total = 0
+        for agent in ready:
+            agent.credit += agent.weight
+            total += agent.weight
+        agent = max(ready, key=lambda a: a.credit)
+        agent.credit -= total
+        return agent
+
+    async def _step(self, agent: HostedAgent) -> None:
+        """Run the next state of an agent."""
+        name = agent.state
+        action_type = action_types[name]
+        memory = agent.memory
+        try:
+            if name == "task_execution" and not memory["task_list"]:
+                # nothing left to execute, the objective is exhausted
+                agent.done = True
+                return
+            with telemetry.action(name) as record:
+                with record.phase("build"):
+                    builder_ = action_type["prompt_builder"]
+                    prompt = await asyncio.to_thread(builder_, memory)
+                with record.phase("llm"):
+                    response = (
+                        await aopenai_call(prompt) if prompt is not None else None
+                    )
+                with record.phase("handler"):
+                    handler_ = action_type["handler"]
+                    record.event = await asyncio.to_thread(handler_, response, memory)
+            agent.steps += 1
+            agent.advance()
+            if agent.journal is not None:
+                agent.journal.record(name, record.event, memory)
+        except Exception as e:  # pylint: disable=broad-except
+            # one failing agent must not take down the others
+            agent.error = memory["error"] = repr(e)
+            agent.done = True
+            if agent.journal is not None:
+                agent.journal.record(name, "error", memory)
+            print("\033[91m\033[1m" + f"\n*** {agent.id} FAILED: {e!r} ***" + "\033[0m")
+        finally:
+            agent.running = False
+            self._wakeup.set()
+
+    async def run(self) -> None:
+        """Step the hosted agents until every one of them is done or stop is called."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        steps = set()
+        while not self._stopping:
+            while len(steps) < self.max_active_steps:
+                agent = self._pick()
+                if agent is None:
+                    break
+                agent.running = True
+                steps.add(asyncio.create_task(self._step(agent)))
+            if not steps and self._server is None:
+                break
+            self._wakeup.clear()
+            wakeup = asyncio.create_task(self._wakeup.wait())
+            done, _ = await asyncio.wait(
+                steps | {wakeup}, return_when=asyncio.FIRST_COMPLETED
+            )
+            wakeup.cancel()
+            steps -= done
+        if steps:
+            await asyncio.wait(steps)
+        self._loop = None
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765) -> None:
+        """
+        Accept new objectives on a local socket, one JSON object per line
+        with the keys first_task, objective and optionally weight and
+        max_loops. Each line is answered with {"id": ...} or {"error": ...}.
+
+        Args:
+            host (str): the host to bind to
+            port (int): the port to listen on
+        """
+
+        async def handle(reader, writer) -> None:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    id_ = self.add(
+                        request["first_task"],
+                        request["objective"],
+                        int(request.get("weight", 1)),
+                        int(request.get("max_loops", 0)),
+                    )
+                    reply = {"id": id_}
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {"error": repr(e)}
+                writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+                await writer.drain()
+            writer.close()
+
+        self._server = await asyncio.start_server(handle, host, port)
+
+    def stop(self) -> None:
+        """Stop scheduling new steps, from any thread; running steps finish."""
+
+        def stop() -> None:
+            self._stopping = True
+            if self._server is not None:
+                self._server.close()
+            self._wakeup.set()
+
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(stop)
+
+    def status(self) -> List[dict]:
+        """Get the progress of every hosted agent."""
+        return [
+            {
+                "id": agent.id,
+                "objective": agent.memory["objective"],
+                "weight": agent.weight,
+                "loops": agent.loops,
+                "steps": agent.steps,
+                "pending_tasks": len(agent.memory["task_list"]),
+                "done": agent.done,
+                "error": agent.error,
+            }
+            for agent in self.agents.values()
+        ]
+
+
+async def main(
+    first_task: str, objectives: List[str], port: int = 0, max_loops: int = 0
+) -> None:
+    runner = MultiAgentRunner()
+    resumed = []
+    for id_ in runner.resume():
+        resumed.append(runner.agents[id_].memory["objective"])
+        print("\033[89m\033[1m" + f"\n=== {id_} RESUMED ===" + "\033[0m\033[0m")
+    for objective in objectives:
+        # rerunning the command resumes its objectives instead of adding them again
+        if objective in resumed:
+            resumed.remove(objective)
+            continue
+        runner.add(first_task, objective, max_loops=max_loops)
+    if port:
+        await runner.serve(port=port)
+        print(f"Accepting objectives on 127.0.0.1:{port}")
+    if TELEMETRY_PORT:
+        telemetry.serve(TELEMETRY_PORT)
+    await runner.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("first_task")
+    parser.add_argument("objectives", nargs="*")
+    parser.add_argument("--port", type=int, default=0, help="objective socket port")
+    parser.add_argument("--max-loops", type=int, default=0)
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.first_task, args.objectives, args.port, args.max_loops))
+    except KeyboardInterrupt:
+        print("\033[89m\033[1m" + "\n======== EXIT ========" + "\033[0m\033[0m")
+        pass
+    finally:
+        # store the task results still queued for the vector store
+        flush_results()
@@ -0,0 +1,160 @@
+"""
+Pipeline: overlaps the task creation and prioritization of the last result
+with a speculative execution of the task at the head of the task list.
+"""
+
+import contextvars
+import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from actions import (
+    build_task_execution_prompt,
+    normalize_task_name,
+    task_creation_prompt_builder,
+    task_creation_handler,
+    task_prioritization_prompt_builder,
+    task_prioritization_handler,
+    task_execution_prompt_builder,
+    task_execution_handler,
+)
+from telemetry import telemetry
+
+
+class PipelinedLoop:
+    """
+    Runs one loop iteration as two concurrent stages: planning (creation then
+    prioritization, on a copy of the state) and the speculative execution of
+    the current head of the task list.
+
+    Planning replaces the pending tasks with the new ones, as the plain loop
+    does, but keeps the speculated task (the "speculated_task" key of the
+    planning state), so that the task list stays as short and the
+    speculated task survives it. Whatever else planning adds to the state,
+    like the deduplication index, is merged back.
+    Once planning returns, the speculative result is reconciled with the new
+    task list: it is kept when the re-prioritized head is the same task or,
+    with keep_if_pending (the default), when the task is still anywhere in
+    the list; otherwise it is discarded and the new head is executed. The
+    kept and discarded counts are reported to the telemetry.
+    """
+
+    def __init__(
+        self, llm_call: Callable[[str], str], keep_if_pending: bool = True
+    ) -> None:
+        """
+        Initialise the pipeline.
+
+        Args:
+            llm_call (Callable[[str], str]): gets the response to a prompt
+            keep_if_pending (bool): whether to keep a speculative result
+                whose task is still pending but no longer at the head
+        """
+        self.llm_call = llm_call
+        self.keep_if_pending = keep_if_pending
+        self.kept = 0
+        self.discarded = 0
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pipeline")
+
+    def _plan(self, planning: dict) -> None:
+        """Run task creation and prioritization on the planning state."""
+        with telemetry.action("task_creation") as record:
+            with record.phase("build"):
+                prompt = task_creation_prompt_builder(planning)
+            with record.phase("llm"):
+                response = self.llm_call(prompt)
+            with record.phase("handler"):
+                record.event = task_creation_handler(response, planning)
+        with telemetry.action("task_prioritization") as record:
+            with record.phase("build"):
+                prompt = task_prioritization_prompt_builder(planning)
+            with record.phase("llm"):
+                response = self.llm_call(prompt) if prompt is not None else None
+            with record.phase("handler"):
+                record.event = task_prioritization_handler(response, planning)
+
+    @property
+    def kept_ratio(self) -> float:
+        """Get the share of the speculative executions that were kept."""
+        total = self.kept + self.discarded
+        return self.kept / total if total else 0.0
+
+    def _take(self, globals_: dict, speculative: dict) -> Optional[dict]:
+        """
+        Remove and return the pending task matching the speculative one, by
+        name up to case, whitespace and the final period that prioritization
+        may change.
+        """
+        task_list = globals_["task_list"]
+        if not task_list:
+            return None
+        name = normalize_task_name(speculative["name"])
+        if normalize_task_name(task_list[0]["name"]) == name:
+            return task_list.popleft()
+        if self.keep_if_pending:
+            for task in task_list:
+                if normalize_task_name(task["name"]) == name:
+                    task_list.remove(task)
+                    return task
+        return None
+
+    def step(self, globals_: dict) -> str:
+        """
+        Run one pipelined iteration: plan for the last result while the head
+        task is executed, then commit the execution.
+
+        Args:
+            globals_ (dict): The globals dictionary
+
+        Returns:
+            str: the event of the execution handler
+        """
+        with telemetry.action("task_execution") as record:
+            record.event = self._step(globals_)
+        return record.event
+
+    def _step(self, globals_: dict) -> str:
+        """Run one pipelined iteration, see step."""
+        speculative = globals_["task_list"][0] if globals_["task_list"] else None
+        planning = dict(globals_)
+        planning["task_list"] = copy.copy(globals_["task_list"])
+        # the speculated task must survive planning for its result to be kept
+        planning["speculated_task"] = speculative
+        planned = self._pool.submit(self._plan, planning)
+
+        execution: Optional[Future] = None
+        if speculative is not None:
+            prompt = build_task_execution_prompt(globals_, speculative)
+            # the worker attributes its token usage to the execution action
+            execution = self._pool.submit(
+                contextvars.copy_context().run, self.llm_call, prompt
+            )
+
+        planned.result()
+        # the task list, the current task and any state planning created
+        for key, value in planning.items():
+            if key != "speculated_task" and globals_.get(key) is not value:
+                globals_[key] = value
+
+        task = self._take(globals_, speculative) if speculative is not None else None
+        if task is None:
+            # the head changed: discard the speculative result, run the new head;
+            # the speculative request is already sent, so its cost is paid anyway
+            if execution is not None:
+                self.discarded += 1
+                telemetry.record_speculation(kept=False)
+            if not globals_["task_list"]:
+                return "done"
+            prompt = task_execution_prompt_builder(globals_)
+            return task_execution_handler(self.llm_call(prompt), globals_)
+
+        self.kept += 1
+        telemetry.record_speculation(kept=True)
+        print("\033[92m\033[1m" + "\n***** NEXT TASK *****\n" + "\033[0m\033[0m")
+        print(str(task["id"]) + ": " + task["name"])
+        globals_["current_task"] = task
+        return task_execution_handler(execution.result(), globals_)
+
+    def shutdown(self) -> None:
+        """Wait for in-flight requests and release the worker threads."""
+        self._pool.shutdown(wait=True)
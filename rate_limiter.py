@@ -0,0 +1,246 @@
+"""
+Rate limiter: keeps the requests of every agent in the process under the
+OpenAI requests-per-minute and tokens-per-minute quotas, adapts the number
+of concurrent requests to the observed rate limits and latency (AIMD), and
+computes jittered exponential backoff delays for retries.
+"""
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at a per-minute rate.
+
+    Reservations are taken immediately and may drive the bucket into debt;
+    the caller then waits for the debt to be refilled. Requests are thus
+    served in reservation order, and a reservation can be corrected once
+    the actual cost is known.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None) -> None:
+        """
+        Initialise the bucket, full.
+
+        Args:
+            per_minute (float): the refill rate, 0 for an unlimited bucket
+            capacity (Optional[float]): the burst size, a minute's worth by default
+        """
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        """Add the tokens accrued since the last update."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take tokens from the bucket.
+
+        Args:
+            amount (float): the number of tokens
+
+        Returns:
+            float: the seconds to wait before the reservation is covered
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Give back (positive) or take (negative) tokens after the fact."""
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of requests in flight, adjusting the limit AIMD-style:
+    it grows by one every `limit` successful requests and is halved on a
+    rate limit error. It is also cut by a tenth when the recent latency
+    exceeds latency_tolerance times the long-run latency, a sign that the
+    extra concurrency only queues requests on the server. The latencies are
+    averaged per key (the action of the request), so that a mix of short
+    and long requests is not mistaken for saturation.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int = 1,
+        maximum: int = 64,
+        latency_tolerance: float = 2.0,
+    ) -> None:
+        """
+        Initialise the limiter.
+
+        Args:
+            initial (int): the initial limit
+            minimum (int): the lowest limit
+            maximum (int): the highest limit
+            latency_tolerance (float): the ratio of recent to long-run latency
+                above which the limit is cut
+        """
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        # the recent and long-run latency averages of each key
+        self._latencies: Dict[str, List[float]] = {}
+        self._condition: Optional[asyncio.Condition] = None
+
+    async def acquire(self) -> None:
+        """Wait for a free slot and take it."""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency: float, rate_limited: bool, key: str = "") -> None:
+        """
+        Free a slot and adjust the limit to the outcome of its request.
+
+        Args:
+            latency (float): the seconds the request took
+            rate_limited (bool): whether the request hit a rate limit
+            key (str): the kind of request, whose latencies are compared
+        """
+        self.in_flight -= 1
+        if rate_limited:
+            self.limit = max(self.minimum, self.limit / 2)
+        else:
+            recent, long_run = self._observe(key, latency)
+            if recent > self.latency_tolerance * long_run:
+                self.limit = max(self.minimum, self.limit * 0.9)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _observe(self, key: str, latency: float) -> Tuple[float, float]:
+        """Update and get the recent and long-run latency averages of a key."""
+        averages = self._latencies.get(key)
+        if averages is None:
+            averages = self._latencies[key] = [latency, latency]
+        else:
+            averages[0] += 0.3 * (latency - averages[0])
+            averages[1] += 0.02 * (latency - averages[1])
+        return averages[0], averages[1]
+
+
+class RequestSlot:
+    """The reservation of one request, settled with its actual usage."""
+
+    __slots__ = ("estimated_tokens", "actual_tokens", "rate_limited")
+
+    def __init__(self, estimated_tokens: int) -> None:
+        self.estimated_tokens = estimated_tokens
+        self.actual_tokens: Optional[int] = None
+        self.rate_limited = False
+
+
+class RateLimiter:
+    """
+    Combines the RPM and TPM buckets with the adaptive concurrency limit.
+    Every attempt of a request holds a slot from `slot` for its duration.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_concurrency: int = 8,
+        initial_concurrency: Optional[int] = None,
+    ) -> None:
+        """
+        Initialise the limiter.
+
+        Args:
+            requests_per_minute (float): the RPM quota, 0 for none
+            tokens_per_minute (float): the TPM quota, 0 for none
+            max_concurrency (int): the highest number of requests in flight
+            initial_concurrency (Optional[int]): the starting number of
+                requests in flight, the maximum by default
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        if initial_concurrency is None:
+            initial_concurrency = max_concurrency
+        self.concurrency = AdaptiveConcurrencyLimiter(
+            initial_concurrency, maximum=max_concurrency
+        )
+
+    @property
+    def limits_tokens(self) -> bool:
+        """Check whether requests need a token estimate."""
+        return self.tokens.rate > 0
+
+    @asynccontextmanager
+    async def slot(
+        self, estimated_tokens: int = 0, key: str = ""
+    ) -> AsyncIterator[RequestSlot]:
+        """
+        Wait until a request fits the quotas and the concurrency limit.
+
+        Args:
+            estimated_tokens (int): the prompt tokens plus the completion limit
+            key (str): the kind of request, see AdaptiveConcurrencyLimiter
+
+        Yields:
+            RequestSlot: set its actual_tokens and rate_limited before exiting
+        """
+        slot = RequestSlot(estimated_tokens)
+        delay = max(self.requests.reserve(1), self.tokens.reserve(estimated_tokens))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.concurrency.acquire()
+        start = time.monotonic()
+        try:
+            yield slot
+        finally:
+            if slot.actual_tokens is not None:
+                self.tokens.adjust(estimated_tokens - slot.actual_tokens)
+            await self.concurrency.release(
+                time.monotonic() - start, slot.rate_limited, key
+            )
+
+
+def backoff_delay(
+    attempt: int,
+    base: float = 1.0,
+    cap: float = 60.0,
+    retry_after: Optional[float] = None,
+) -> float:
+    """
+    Get the delay before a retry: exponential backoff with full jitter,
+    or the server's Retry-After when it is longer.
+
+    Args:
+        attempt (int): the number of the failed attempt, from 0
+        base (float): the delay scale in seconds
+        cap (float): the longest delay in seconds
+        retry_after (Optional[float]): the delay asked for by the server
+
+    Returns:
+        float: the seconds to wait
+    """
+    delay = random.uniform(0, min(cap, base * 2**attempt))
+    if retry_after is not None:
+        delay = max(delay, min(cap, retry_after))
+    return delay
@@ -0,0 +1,314 @@
+"""
+Response cache: a deterministic, on-disk cache of LLM responses keyed by the
+request parameters, with a replay mode that never calls the API. It is kept
+in a JSONL file or, to share it between processes, in an SQLite table.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# cache modes: "off" never caches, "read_write" serves hits and stores
+# misses, "replay" serves hits and raises CacheMissError on a miss
+CACHE_MODES = ("off", "read_write", "replay")
+
+
+class CacheMissError(Exception):
+    """Raised in replay mode when a request is not in the cache."""
+
+
+def request_key(model: str, prompt: str, temperature: float, max_tokens: int) -> str:
+    """Get the cache key of a request."""
+    payload = json.dumps([model, prompt, temperature, max_tokens])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    An append-only JSONL file of responses with an LRU memory front.
+
+    The file is indexed by key on first use; later lookups that miss the
+    memory front seek straight to the entry's offset. Entries older than
+    ttl seconds are treated as misses, and once the file holds more than
+    max_entries the newest live entries are compacted into a fresh file.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str],
+        mode: str = "read_write",
+        max_memory_items: int = 1024,
+        max_entries: int = 100_000,
+        ttl: Optional[float] = None,
+    ) -> None:
+        """
+        Initialise the cache.
+
+        Args:
+            path (Optional[str]): the JSONL file, or None to only cache in memory
+            mode (str): one of CACHE_MODES
+            max_memory_items (int): the capacity of the memory front
+            max_entries (int): the number of entries that triggers compaction
+            ttl (Optional[float]): the lifetime of an entry in seconds
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(f"unknown cache mode {mode!r}, expected {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_memory_items = max_memory_items
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Dict]" = OrderedDict()
+        self._offsets: Optional[Dict[str, int]] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Check whether the cache is used at all."""
+        return self.mode != "off"
+
+    def _index(self) -> Dict[str, int]:
+        """Get the key to file offset index, reading the file on first use."""
+        if self._offsets is None:
+            self._offsets = {}
+            if self.path is not None and os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    offset = f.tell()
+                    for line in iter(f.readline, b""):
+                        try:
+                            self._offsets[json.loads(line)["key"]] = offset
+                        except (ValueError, KeyError):
+                            pass  # a torn write at the end of the file
+                        offset = f.tell()
+        return self._offsets
+
+    def _read(self, offset: int) -> Dict:
+        """Read the entry stored at an offset of the file."""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def _expired(self, entry: Dict) -> bool:
+        """Check whether an entry has outlived the ttl."""
+        return self.ttl is not None and time.time() - entry["created"] > self.ttl
+
+    def _remember(self, entry: Dict) -> None:
+        """Put an entry in the memory front, evicting the least recently used."""
+        self._memory[entry["key"]] = entry
+        self._memory.move_to_end(entry["key"])
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get a cached response.
+
+        Args:
+            key (str): the request key
+
+        Returns:
+            Optional[str]: the response, or None on a miss in read_write mode
+
+        Raises:
+            CacheMissError: on a miss in replay mode
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None and key in self._index():
+                entry = self._read(self._offsets[key])
+                self._remember(entry)
+            if entry is not None and not self._expired(entry):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry["response"]
+            self.misses += 1
+        if self.mode == "replay":
+            raise CacheMissError(f"no cached response for request {key}")
+        return None
+
+    def put(self, key: str, response: str) -> None:
+        """
+        Store a response, appending it to the file.
+
+        Args:
+            key (str): the request key
+            response (str): the response
+        """
+        entry = {"key": key, "created": time.time(), "response": response}
+        with self._lock:
+            self._remember(entry)
+            if self.path is None:
+                return
+            offsets = self._index()
+            with open(self.path, "ab") as f:
+                offsets[key] = f.tell()
+                f.write(json.dumps(entry).encode("utf-8") + b"\n")
+            if len(offsets) > self.max_entries:
+                self._compact()
+
+    def _compact(self) -> None:
+        """Rewrite the file with the newest live entries, half of max_entries."""
+        with open(self.path, "rb") as f:
+            entries = {}
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                entries[entry["key"]] = entry
+        entries = [e for e in entries.values() if not self._expired(e)]
+        entries.sort(key=lambda e: e["created"])
+        entries = entries[-max(self.max_entries // 2, 1) :]
+        tmp_path = self.path + ".tmp"
+        offsets = {}
+        with open(tmp_path, "wb") as f:
+            for entry in entries:
+                offsets[entry["key"]] = f.tell()
+                f.write(json.dumps(entry).encode("utf-8") + b"\n")
+        os.replace(tmp_path, self.path)
+        self._offsets = offsets
+        self._memory = OrderedDict(
+            (key, entry) for key, entry in self._memory.items() if key in offsets
+        )
+
+    def stats(self) -> Dict[str, int]:
+        """Get the hit/miss counters of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+        }
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    A response cache in an SQLite table with an LRU memory front, that can be
+    shared by several processes: each one sees the responses the others
+    stored, where the JSONL file is only indexed once per process.
+
+    Entries older than ttl seconds are treated as misses, and once the table
+    holds more than max_entries the oldest entries are deleted, keeping half.
+    """
+
+    # number of stores between two checks of the table size
+    PRUNE_INTERVAL = 1024
+
+    def __init__(self, path: str, **kwargs) -> None:
+        """
+        Initialise the cache.
+
+        Args:
+            path (str): the SQLite file
+            kwargs: the options of ResponseCache
+        """
+        super().__init__(path, **kwargs)
+        self._connection = None
+        self._puts = 0
+
+    @property
+    def connection(self):
+        """Get the connection, opening it on first use."""
+        if self._connection is None:
+            # wait for the writes of the other processes sharing the file
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, created REAL, response TEXT)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get a cached response.
+
+        Args:
+            key (str): the request key
+
+        Returns:
+            Optional[str]: the response, or None on a miss in read_write mode
+
+        Raises:
+            CacheMissError: on a miss in replay mode
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                row = self.connection.execute(
+                    "SELECT created, response FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = {"key": key, "created": row[0], "response": row[1]}
+                    self._remember(entry)
+            if entry is not None and not self._expired(entry):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry["response"]
+            self.misses += 1
+        if self.mode == "replay":
+            raise CacheMissError(f"no cached response for request {key}")
+        return None
+
+    def put(self, key: str, response: str) -> None:
+        """
+        Store a response in the table.
+
+        Args:
+            key (str): the request key
+            response (str): the response
+        """
+        entry = {"key": key, "created": time.time(), "response": response}
+        with self._lock:
+            self._remember(entry)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                (key, entry["created"], response),
+            )
+            self._puts += 1
+            if self._puts % self.PRUNE_INTERVAL == 0:
+                self._prune()
+            self.connection.commit()
+
+    def _prune(self) -> None:
+        """Delete the oldest entries once the table holds more than max_entries."""
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY created LIMIT ?)",
+                (count - max(self.max_entries // 2, 1),),
+            )
+
+    def close(self) -> None:
+        """Close the connection."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def open_response_cache(path: Optional[str], **kwargs) -> ResponseCache:
+    """
+    Open the response cache stored at path: an SQLite table, that processes
+    can share, for a .db or .sqlite file and a JSONL file otherwise.
+
+    Args:
+        path (Optional[str]): the file, or None to only cache in memory
+        kwargs: the options of ResponseCache
+
+    Returns:
+        ResponseCache: the cache
+    """
+    if path is not None and path.endswith((".db", ".sqlite")):
+        return SQLiteResponseCache(path, **kwargs)
+    return ResponseCache(path, **kwargs)
@@ -0,0 +1,190 @@
+"""
+Result history: keeps the results of the executed tasks in a bounded window,
+spills the older ones to disk and folds them into a rolling summary, so a
+long-running agent holds a flat amount of memory and prompt context.
+"""
+
+import re
+import sqlite3
+import threading
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+from context_packer import ContextPacker
+
+# a result of the history: the task id, the task name and the result
+Entry = Tuple[int, str, str]
+
+# folds evicted entries into the summary: (summary, entries) -> new summary
+Summarizer = Callable[[str, List[Entry]], str]
+
+
+def first_sentence(text: str, max_chars: int = 200) -> str:
+    """Get the first sentence of a text, cut at max_chars."""
+    text = " ".join(text.split())
+    match = re.search(r"(?<=[.!?])\s", text)
+    sentence = text[: match.start()] if match else text
+    return sentence[:max_chars]
+
+
+class ResultHistory:
+    """
+    The results of an agent's executed tasks.
+
+    The last window results are kept in memory. Older ones are evicted by
+    batches: they are written to an SQLite table, when a path is given, and
+    folded into a summary by the summarizer. Without a summarizer the
+    summary is extractive: a line with the first sentence of each evicted
+    result, dropping the oldest lines to stay within summary_budget tokens.
+    """
+
+    def __init__(
+        self,
+        window: int = 20,
+        batch: int = 5,
+        path: Optional[str] = None,
+        namespace: str = "",
+        summarizer: Optional[Summarizer] = None,
+        summary_budget: int = 300,
+        packer: Optional[ContextPacker] = None,
+    ) -> None:
+        """
+        Initialise the history.
+
+        Args:
+            window (int): the number of results kept in memory
+            batch (int): the number of results evicted at once
+            path (Optional[str]): the SQLite file of evicted results, or None
+                to drop them once summarized
+            namespace (str): the namespace of the agent's results on disk
+            summarizer (Optional[Summarizer]): folds evicted results into the
+                summary, None for the extractive summary
+            summary_budget (int): the maximum number of tokens of the summary
+            packer (Optional[ContextPacker]): counts the tokens of the summary
+        """
+        self.window = window
+        self.batch = max(1, batch)
+        self.path = path
+        self.namespace = namespace
+        self.summarizer = summarizer
+        self.summary_budget = summary_budget
+        self.packer = packer or ContextPacker()
+        self.summary = ""
+        self.evicted = 0
+        self._recent: Deque[Entry] = deque()
+        self._summary_lines: Deque[str] = deque()
+        self._summary_tokens = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> Optional[sqlite3.Connection]:
+        """Get the disk connection, opening it on first use."""
+        if self._connection is None and self.path is not None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(namespace TEXT, task_id INTEGER, task TEXT, result TEXT)"
+            )
+            self._connection.commit()
+        return self._connection
+
+    def __len__(self) -> int:
+        """Get the number of results, in memory and evicted."""
+        return len(self._recent) + self.evicted
+
+    def add(self, task_id: int, task: str, result: str, spill: bool = True) -> None:
+        """
+        Add the result of an executed task, evicting the oldest results once
+        the window is full.
+
+        Args:
+            task_id (int): the task id
+            task (str): the task name
+            result (str): the result
+            spill (bool): whether to write the evicted results to disk, off
+                when replaying results that were already written
+        """
+        with self._lock:
+            self._recent.append((task_id, task, result))
+            if len(self._recent) <= self.window:
+                return
+            count = min(self.batch, len(self._recent))
+            evicted = [self._recent.popleft() for _ in range(count)]
+            self.evicted += count
+            if spill and self.connection is not None:
+                self.connection.executemany(
+                    "INSERT INTO results VALUES (?, ?, ?, ?)",
+                    [(self.namespace, *entry) for entry in evicted],
+                )
+                self.connection.commit()
+        # summarize outside the lock, the summarizer may call the LLM
+        if self.summarizer is not None:
+            self.summary = self.summarizer(self.summary, evicted)
+        else:
+            self._extract(evicted)
+
+    def _extract(self, evicted: List[Entry]) -> None:
+        """Fold evicted results into the extractive summary."""
+        for _, task, result in evicted:
+            line = f"{task}: {first_sentence(result)}"
+            self._summary_lines.append(line)
+            self._summary_tokens += self.packer.count(line)
+        while self._summary_lines and self._summary_tokens > self.summary_budget:
+            self._summary_tokens -= self.packer.count(self._summary_lines.popleft())
+        self.summary = "\n".join(self._summary_lines)
+
+    def state(self) -> dict:
+        """Get the in-memory state of the history, as JSON-serializable data."""
+        with self._lock:
+            return {
+                "recent": list(self._recent),
+                "summary": self.summary,
+                "summary_lines": list(self._summary_lines),
+                "evicted": self.evicted,
+            }
+
+    def load(self, state: dict) -> None:
+        """Restore the in-memory state of the history, as given by state."""
+        with self._lock:
+            self._recent = deque(tuple(entry) for entry in state["recent"])
+            self.summary = state["summary"]
+            self._summary_lines = deque(state["summary_lines"])
+            self._summary_tokens = sum(map(self.packer.count, self._summary_lines))
+            self.evicted = state["evicted"]
+
+    def recent(self) -> List[Entry]:
+        """Get the results kept in memory, newest first."""
+        return list(reversed(self._recent))
+
+    def get(self, task_id: int) -> Optional[str]:
+        """Get the result of a task, from memory or from disk."""
+        for id_, _, result in reversed(self._recent):
+            if id_ == task_id:
+                return result
+        if self.connection is None:
+            return None
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT result FROM results WHERE namespace = ? AND task_id = ? "
+                "ORDER BY rowid DESC LIMIT 1",
+                (self.namespace, task_id),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def context_items(self) -> List[str]:
+        """
+        Get the history as context items, most relevant first: the recent
+        task names, newest first, then the summary of the older ones.
+        """
+        items = [task for _, task, _ in self.recent()]
+        if self.summary:
+            items.append("Summary of earlier tasks: " + self.summary)
+        return items
+
+    def close(self) -> None:
+        """Close the disk connection."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,149 @@
+"""
+Retrieval cache: memoizes the matches of the context queries per write version
+of the index, so repeated lookups between two upserts neither re-embed the
+query nor re-query the index.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from vector_store import Match
+
+# a written vector: its id, values and metadata
+Vector = Tuple[str, List[float], Dict[str, Any]]
+
+
+class Retrieval(NamedTuple):
+    """A memoized query: the query embedding, and its matches at a version."""
+
+    version: int
+    embedding: List[float]
+    matches: List[Any]
+
+
+class RetrievalCache:
+    """
+    A bounded LRU of query matches keyed by (namespace, query, top_k).
+
+    An entry is valid for the write version of the namespace it was
+    retrieved at. When a write is reported with merge, the entries at the
+    previous version are brought up to date by scoring the written vectors
+    against their query embedding and merging them into their top-k, and
+    the other entries of the namespace, which missed a write, are dropped.
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        """
+        Initialise the cache.
+
+        Args:
+            max_entries (int): the maximum number of memoized queries
+        """
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str, int], Retrieval]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.merges = 0
+
+    def get(
+        self, namespace: str, query: str, top_k: int, version: int
+    ) -> Optional[Retrieval]:
+        """
+        Get the memoized matches of a query.
+
+        Args:
+            namespace (str): the namespace searched
+            query (str): the query text
+            top_k (int): the number of matches
+            version (int): the current write version of the namespace
+
+        Returns:
+            Optional[Retrieval]: the retrieval, or None if it is missing or stale
+        """
+        key = (namespace, query, top_k)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(
+        self,
+        namespace: str,
+        query: str,
+        top_k: int,
+        version: int,
+        embedding: List[float],
+        matches: List[Any],
+    ) -> None:
+        """
+        Memoize the matches of a query, retrieved at a write version.
+
+        Args:
+            namespace (str): the namespace searched
+            query (str): the query text
+            top_k (int): the number of matches
+            version (int): the write version the query was run at
+            embedding (List[float]): the query embedding
+            matches (List[Any]): the matches, sorted by descending score
+        """
+        key = (namespace, query, top_k)
+        with self._lock:
+            self._entries[key] = Retrieval(version, embedding, list(matches))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def merge(self, namespace: str, version: int, vectors: List[Vector]) -> None:
+        """
+        Apply a write to the memoized queries of a namespace.
+
+        Args:
+            namespace (str): the namespace written
+            version (int): the write version after the write
+            vectors (List[Vector]): the written vectors
+        """
+        if not vectors:
+            return
+        ids = {id_ for id_, _, _ in vectors}
+        values = np.asarray([values for _, values, _ in vectors], dtype=np.float32)
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        values = values / norms
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if key[0] != namespace or entry.version >= version:
+                    continue
+                # an updated match may now rank below vectors the entry never saw
+                if entry.version != version - 1 or any(
+                    match.id in ids for match in entry.matches
+                ):
+                    del self._entries[key]
+                    continue
+                query = np.asarray(entry.embedding, dtype=np.float32)
+                scores = values @ (query / (np.linalg.norm(query) or 1.0))
+                matches = entry.matches + [
+                    Match(id_, float(score), metadata)
+                    for (id_, _, metadata), score in zip(vectors, scores)
+                ]
+                matches.sort(key=lambda match: match.score, reverse=True)
+                self._entries[key] = entry._replace(
+                    version=version, matches=matches[: key[2]]
+                )
+                self.merges += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Get the hit/miss counters of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "merges": self.merges,
+            "entries": len(self._entries),
+        }
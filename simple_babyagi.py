@@ -8,11 +8,12 @@ import os
 import sys
 import openai
 import time
-from collections import deque
+from typing import Callable, Optional
 from dotenv import load_dotenv
 
 # import functions used to build the agent's actions
 from actions import (
+    flush_results,
     task_creation_prompt_builder,
     task_creation_handler,
     task_prioritization_prompt_builder,
@@ -22,6 +23,13 @@ from actions import (
     task_stop_or_not_prompt_builder,
     task_stop_or_not_handler,
 )
+from agent_state import AgentState
+from line_parser import iter_lines
+from llm_client import openai_call, openai_stream
+from pipeline import PipelinedLoop
+from state_journal import STATE_JOURNAL_PATH, open_journal
+from task_scheduler import TaskScheduler
+from telemetry import TELEMETRY_PORT, telemetry
 
 load_dotenv()
 
@@ -33,6 +41,18 @@ openai.api_key = OPENAI_API_KEY
 # flag to stop the procedure
 STOP_PROCEDURE = False
 
+# seconds to wait between two loops
+LOOP_DELAY = 1
+
+# flag to execute all the ready tasks of the task list at once
+PARALLEL_EXECUTION = False
+
+# flag to overlap creation/prioritization with the next task execution
+PIPELINED = False
+
+# flag to stream task creation and start executing new tasks as they arrive
+STREAMING = False
+
 # Definition of the action types for the simple agent
 action_types = {
     "task_creation": {
@@ -64,73 +84,132 @@ def executor(globals_: dict, agent_type: str) -> None:
     """
     # load the action type into "agent"
     agent = action_types[agent_type]
-    # build the prompt for the corresponding action type
-    builder_ = agent["prompt_builder"]
-    # create the corresponding prompt for GPT to execute the action
-    #  type "agent" and load it into "prompt"
-    prompt = builder_(globals_)
-    # call GPT with the corresponding "prompt" to execute the action
-    # and load the response from the "prompt" into "response"
-    response = openai_call(prompt)
-    # handle the response from GPT for the corresponding action type "agent"
-    handler_ = agent["handler"]
-    handler_(response, globals_)
-
+    # record the timings and token usage of each phase of the action
+    with telemetry.action(agent_type) as record:
+        # build the prompt for the corresponding action type
+        builder_ = agent["prompt_builder"]
+        # create the corresponding prompt for GPT to execute the action
+        #  type "agent" and load it into "prompt"
+        with record.phase("build"):
+            prompt = builder_(globals_)
+        # call GPT with the corresponding "prompt" to execute the action
+        # and load the response from the "prompt" into "response", builders
+        # return no prompt when the action needs no GPT call
+        with record.phase("llm"):
+            response = openai_call(prompt) if prompt is not None else None
+        # handle the response from GPT for the corresponding action type "agent"
+        handler_ = agent["handler"]
+        with record.phase("handler"):
+            record.event = handler_(response, globals_)
+
+
+def stream_executor(
+    globals_: dict, agent_type: str, on_line: Optional[Callable[[str], None]] = None
+) -> None:
+    """
+    execute an action using simple agent, streaming the GPT response and
+    handing each of its lines to on_line as soon as it is complete
 
-def main(first_task: str, objective: str):
-    # initialize the globals dictionary with "objective"
+    Args:
+        globals_ (dict): The globals dictionary
+        agent_type (str): The action type to execute
+        on_line (Optional[Callable[[str], None]]): called with each line
+    """
+    agent = action_types[agent_type]
+    with telemetry.action(agent_type) as record:
+        with record.phase("build"):
+            prompt = agent["prompt_builder"](globals_)
+        lines = []
+        with record.phase("llm"):
+            for line in iter_lines(openai_stream(prompt)):
+                lines.append(line)
+                if on_line is not None:
+                    on_line(line)
+        with record.phase("handler"):
+            record.event = agent["handler"]("\n".join(lines), globals_)
+
+
+def create_globals(first_task: str, objective: str) -> AgentState:
+    """Create the state of the simple agent."""
+    # initialize the globals state with "objective" and the first task
     # this is simple_agent's state variable which is used to keep track of
     # the task list, current task, and the objective so GPT can reason about them.
-    globals_ = {
-        "objective": objective,
-        "task_list": deque([]),
-        "current_task": {},
-        "result": {"data": ""},
-        "keep_going": True,
-    }
-    # add the first task to the task list
-    globals_["task_list"].append({"id": 1, "name": first_task})
+    # it is a typed state that can still be used as a dictionary
+    return AgentState(objective, first_task=first_task)
+
+
+def main(first_task: str, objective: str):
+    # create the state, or restore it from the journal of an interrupted run
+    journal, globals_, last_state, _ = open_journal(
+        STATE_JOURNAL_PATH, first_task, objective, create_globals
+    )
+
+    def checkpoint(state: str) -> None:
+        # append the changes of the last state to the journal
+        if journal is not None:
+            journal.record(state, None, globals_)
+
+    # the states of a loop, a resumed run starts after the last journaled one
+    states = ["task_execution", "task_creation", "task_prioritization"]
+    if STOP_PROCEDURE:
+        states.append("task_stop_or_not")
+    resume_at = (
+        (states.index(last_state) + 1) % len(states) if last_state in states else 0
+    )
 
     print("\033[89m\033[1m" + "\n=== Simple Loop babyAGI ONLINE ===" + "\033[0m\033[0m")
 
+    # serve the per-action metrics for Prometheus to scrape
+    if TELEMETRY_PORT:
+        telemetry.serve(TELEMETRY_PORT)
+
+    # scheduler used to execute independent tasks concurrently
+    task_scheduler = TaskScheduler() if PARALLEL_EXECUTION else None
+    # pipeline used to overlap planning with the next task execution
+    pipeline = PipelinedLoop(openai_call) if PIPELINED else None
+    if pipeline is not None and last_state is None:
+        executor(globals_, "task_execution")
+        checkpoint("task_execution")
+
     # simple agent loop
     while globals_["keep_going"]:
-        # execution
-        executor(globals_, "task_execution")
-        # creation
-        executor(globals_, "task_creation")
-        # re-prioritization
-        executor(globals_, "task_prioritization")
+        if pipeline is not None:
+            # creation and re-prioritization, overlapped with the next execution
+            if resume_at <= 2:
+                pipeline.step(globals_)
+                checkpoint("task_prioritization")
+        else:
+            # execution
+            if resume_at <= 0:
+                if task_scheduler is not None:
+                    task_scheduler.execute_ready(globals_, openai_call)
+                else:
+                    executor(globals_, "task_execution")
+                checkpoint("task_execution")
+            # creation, new tasks can start executing while it streams
+            if resume_at <= 1:
+                if STREAMING and task_scheduler is not None:
+                    stream_executor(
+                        globals_,
+                        "task_creation",
+                        lambda line: task_scheduler.prefetch(
+                            globals_, line, openai_call
+                        ),
+                    )
+                elif STREAMING:
+                    stream_executor(globals_, "task_creation")
+                else:
+                    executor(globals_, "task_creation")
+                checkpoint("task_creation")
+            # re-prioritization
+            if resume_at <= 2:
+                executor(globals_, "task_prioritization")
+                checkpoint("task_prioritization")
         if STOP_PROCEDURE:
             executor(globals_, "task_stop_or_not")
-        time.sleep(1)
-
-
-def openai_call(
-    prompt: str, use_gpt4: bool = False, temperature: float = 0.5, max_tokens: int = 200
-):
-    if not use_gpt4:
-        response = openai.Completion.create(
-            engine="text-davinci-003",
-            prompt=prompt,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-        )
-        return response.choices[0].text.strip()
-    else:
-        messages = [{"role": "user", "content": prompt}]
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            n=1,
-            stop=None,
-        )
-        return response.choices[0].message.content.strip()
+            checkpoint("task_stop_or_not")
+        resume_at = 0
+        time.sleep(LOOP_DELAY)
 
 
 if __name__ == "__main__":
@@ -140,3 +219,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("\033[89m\033[1m" + "\n======== EXIT ========" + "\033[0m\033[0m")
         pass
+    finally:
+        # store the task results still queued for the vector store
+        flush_results()
@@ -0,0 +1,319 @@
+"""
+State journal: makes an agent's state crash safe by appending, after every
+handler, only what the handler changed to a JSONL journal, with periodic
+compact snapshots. On startup the snapshot and the journal are replayed to
+resume the agent at the state it was about to run.
+"""
+
+import json
+import os
+from typing import Callable, List, Optional, Tuple
+
+import actions
+from agent_state import AgentState
+from result_history import Entry
+from task_store import Task, TaskStore
+
+# journal file of the agent state, empty to disable journaling
+STATE_JOURNAL_PATH = os.getenv("STATE_JOURNAL_PATH", "")
+# number of journaled steps between two snapshots
+JOURNAL_SNAPSHOT_INTERVAL = int(os.getenv("JOURNAL_SNAPSHOT_INTERVAL", "100"))
+# fsync every record, surviving power loss as well as crashes, at a cost
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "false").lower() == "true"
+
+# the fields of the state that are journaled, the others (like the task
+# deduplication index and the result history) are derived and rebuilt on
+# restore
+FIELDS = ("objective", "current_task", "result", "keep_going", "namespace")
+
+
+def encode(value):
+    """Encode the task records of the state as the task dicts they replace."""
+    if isinstance(value, Task):
+        return value.to_dict()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class StateJournal:
+    """
+    An append-only journal of the state transitions of one agent.
+
+    Each record holds the state that ran, its event and the fields it
+    changed. Changes are found by identity, since the handlers replace
+    the fields they change, so recording a step is a few comparisons. The
+    task list is recorded as the number of tasks taken off its head and the
+    tasks appended to it, which is the whole list when it was rebuilt.
+
+    Every snapshot_interval records the whole state is written to a
+    snapshot file, atomically, and the journal is started afresh.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        snapshot_interval: int = JOURNAL_SNAPSHOT_INTERVAL,
+        fsync: bool = JOURNAL_FSYNC,
+        fields: Tuple[str, ...] = FIELDS,
+    ) -> None:
+        """
+        Initialise the journal.
+
+        Args:
+            path (str): the journal file, the snapshot is path + ".snapshot"
+            snapshot_interval (int): the number of records between snapshots
+            fsync (bool): whether to fsync every record
+            fields (Tuple[str, ...]): the journaled fields of the state
+        """
+        self.path = path
+        self.fields = fields
+        self.snapshot_path = path + ".snapshot"
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.seq = 0
+        # names of the executed tasks, to rebuild the deduplication index
+        self.completed: List[str] = []
+        # on restore, the result history of the snapshot and the results of
+        # the tasks executed after it, to rebuild the result history
+        self.history: Optional[dict] = None
+        self.results: List[Entry] = []
+        self._since_snapshot = 0
+        self._file = None
+        self._seen: dict = {}
+        self._tasks: list = []
+
+    def _open(self):
+        """Get the journal file, opened for appending."""
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    def _remember(self, globals_: dict) -> None:
+        """Remember the journaled objects, to find the next changes by identity."""
+        self._seen = {field: globals_.get(field) for field in self.fields}
+        self._tasks = list(globals_["task_list"])
+
+    def _task_changes(self, tasks: list) -> dict:
+        """Get the changes of the task list since the last record."""
+        old = self._tasks
+        # the longest tail of the old list that the new list starts with,
+        # dropping every old task always matches
+        for dropped in range(len(old) + 1):
+            kept = len(old) - dropped
+            if len(tasks) >= kept and all(
+                a is b for a, b in zip(old[dropped:], tasks[:kept])
+            ):
+                break
+        changes = {}
+        if dropped:
+            changes["drop"] = dropped
+        if len(tasks) > kept:
+            changes["append"] = tasks[kept:]
+        return changes
+
+    def record(self, state: str, event: Optional[str], globals_: dict) -> None:
+        """
+        Append the changes of a handler to the journal.
+
+        Args:
+            state (str): the state that ran
+            event (Optional[str]): the event its handler returned
+            globals_ (dict): the state after the handler
+        """
+        self.seq += 1
+        entry = {"seq": self.seq, "state": state, "event": event}
+        for field in self.fields:
+            value, seen = globals_.get(field), self._seen.get(field)
+            if value is not seen and value != seen:
+                entry[field] = value
+        tasks = list(globals_["task_list"])
+        entry.update(self._task_changes(tasks))
+        # the tasks the execution handler ran since the last record, whatever
+        # the state: one, the ready ones of a parallel execution, or none
+        executed = globals_.get("executed")
+        if executed:
+            entry["executed"] = list(executed)
+            self.completed.extend(name for _, name, _ in executed)
+            del executed[:]
+        journal = self._open()
+        journal.write(json.dumps(entry, default=encode) + "\n")
+        journal.flush()
+        if self.fsync:
+            os.fsync(journal.fileno())
+        self._seen = {field: globals_.get(field) for field in self.fields}
+        self._tasks = tasks
+        self._since_snapshot += 1
+        if self._since_snapshot >= self.snapshot_interval:
+            self.snapshot(globals_, state, event)
+
+    def snapshot(self, globals_: dict, state: str, event: Optional[str]) -> None:
+        """
+        Write the whole state to the snapshot file and start a new journal.
+
+        Args:
+            globals_ (dict): the state
+            state (str): the last state that ran
+            event (Optional[str]): the event of its handler
+        """
+        snapshot = {
+            "seq": self.seq,
+            "state": state,
+            "event": event,
+            "fields": {
+                field: globals_[field] for field in self.fields if field in globals_
+            },
+            "tasks": list(globals_["task_list"]),
+            "completed": self.completed,
+        }
+        if "result_history" in globals_:
+            snapshot["result_history"] = globals_["result_history"].state()
+        temporary = self.snapshot_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, default=encode)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.snapshot_path)
+        # records up to seq are in the snapshot, the journal can be dropped
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._since_snapshot = 0
+
+    def restore(self) -> Optional[Tuple[AgentState, str, Optional[str]]]:
+        """
+        Replay the snapshot and the journal.
+
+        Returns:
+            Optional[Tuple[AgentState, str, Optional[str]]]: the state, the
+            last state that ran and its event, or None when there is nothing
+            to resume
+        """
+        globals_, tasks = {}, []
+        state, event = None, None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self.seq = snapshot["seq"]
+            state, event = snapshot["state"], snapshot["event"]
+            globals_.update(snapshot["fields"])
+            tasks = snapshot["tasks"]
+            self.completed = snapshot["completed"]
+            self.history = snapshot.get("result_history")
+        if os.path.exists(self.path):
+            with open(self.path, "rb+") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("torn record")
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a record torn by the crash, the last one: cut it
+                        # off so that new records are not appended after it
+                        f.truncate(offset)
+                        break
+                    offset += len(line)
+                    if entry["seq"] <= self.seq:
+                        continue
+                    self.seq = entry["seq"]
+                    state, event = entry["state"], entry["event"]
+                    for field in self.fields:
+                        if field in entry:
+                            globals_[field] = entry[field]
+                    tasks = tasks[entry.get("drop", 0) :] + entry.get("append", [])
+                    for id_, name, result in entry.get("executed", []):
+                        self.completed.append(name)
+                        self.results.append((id_, name, result))
+        if state is None:
+            return None
+        restored = AgentState(globals_.pop("objective", ""))
+        restored.update(globals_)
+        restored.task_list = TaskStore(tasks)
+        if restored.current_task:
+            restored.current_task = Task.from_dict(restored.current_task)
+        self._remember(restored)
+        self.track(restored)
+        return restored, state, event
+
+    @staticmethod
+    def track(globals_: dict) -> None:
+        """
+        Make the execution handler list the tasks it runs in the state, for
+        the next record to journal them as completed.
+        """
+        globals_["executed"] = []
+
+    def reset(self) -> None:
+        """Delete the journal and the snapshot, to start a new objective."""
+        self.close()
+        for path in (self.path, self.snapshot_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.seq = 0
+        self.completed = []
+        self.history = None
+        self.results = []
+        self._since_snapshot = 0
+        self._seen = {}
+        self._tasks = []
+
+    def close(self) -> None:
+        """Close the journal file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def open_journal(
+    path: str,
+    first_task: str,
+    objective: str,
+    create_state: Callable[[str, str], dict],
+) -> Tuple[Optional[StateJournal], dict, Optional[str], Optional[str]]:
+    """
+    Open the journal of an agent and restore its state if the journal is of
+    the same objective, or start the objective afresh.
+
+    Args:
+        path (str): the journal file, empty for no journal
+        first_task (str): the first task of the agent
+        objective (str): the objective of the agent
+        create_state (Callable[[str, str], dict]): creates a fresh state
+
+    Returns:
+        Tuple[Optional[StateJournal], dict, Optional[str], Optional[str]]:
+        the journal, the state, and the last state that ran and its event,
+        None when starting afresh
+    """
+    if not path:
+        return None, create_state(first_task, objective), None, None
+    journal = StateJournal(path)
+    restored = journal.restore()
+    if restored is not None and restored[0].get("objective") == objective:
+        globals_, state, event = restored
+        rebuild_derived_state(globals_, journal)
+        if not globals_["keep_going"]:
+            message = f"\n=== FINISHED after {state} (step {journal.seq}) ==="
+        else:
+            message = f"\n=== RESUMING after {state} (step {journal.seq}) ==="
+        print("\033[89m\033[1m" + message + "\033[0m\033[0m")
+        return journal, globals_, state, event
+    # the first record then holds the whole state, including the objective
+    journal.reset()
+    globals_ = create_state(first_task, objective)
+    journal.track(globals_)
+    return journal, globals_, None, None
+
+
+def rebuild_derived_state(globals_: dict, journal: StateJournal) -> None:
+    """Rebuild the state that is not journaled from a restored journal."""
+    if actions.DEDUPLICATE_TASKS:
+        index = actions.get_task_index(globals_)
+        for name in journal.completed:
+            index.add(name)
+    if actions.RESULT_HISTORY:
+        history = actions.get_result_history(globals_)
+        if journal.history is not None:
+            history.load(journal.history)
+        # the results evicted before the crash are already on disk
+        for entry in journal.results:
+            history.add(*entry, spill=False)
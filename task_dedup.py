@@ -0,0 +1,132 @@
+"""
+Task deduplication: an index over task names that finds exact and near
+duplicates (rephrasings) of a new task in sub-linear time, using MinHash
+signatures and locality-sensitive hashing.
+"""
+
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+# a Mersenne prime small enough for (a * x + b) to fit in 64 bits
+_PRIME = (1 << 31) - 1
+
+
+def dedup_key(name: str) -> str:
+    """Get the index key of a task name: its lower-case words, no list marker."""
+    name = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", name.lower())
+    return " ".join(re.findall(r"[a-z0-9]+", name))
+
+
+def shingles(text: str, size: int = 3) -> Set[int]:
+    """Get the hashed character shingles of a normalized text."""
+    if len(text) <= size:
+        return {zlib.crc32(text.encode("utf-8"))}
+    return {
+        zlib.crc32(text[i : i + size].encode("utf-8"))
+        for i in range(len(text) - size + 1)
+    }
+
+
+class TaskDedupIndex:
+    """
+    An index of task names answering "is this task a (near) duplicate?".
+
+    Exact duplicates are found through a set of normalized names. Near
+    duplicates are found through MinHash signatures of character shingles,
+    split into LSH bands: only names sharing a band bucket with the new
+    name are compared, by the Jaccard similarity of their shingles.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.7,
+        num_perm: int = 64,
+        bands: int = 16,
+        seed: int = 1,
+    ) -> None:
+        """
+        Initialise the index.
+
+        Args:
+            threshold (float): the Jaccard similarity above which two task
+                names are duplicates
+            num_perm (int): the number of MinHash permutations
+            bands (int): the number of LSH bands, dividing num_perm
+            seed (int): the seed of the permutations
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)
+        self._exact: Dict[str, str] = {}
+        self._shingles: List[Set[int]] = []
+        self._names: List[str] = []
+        self._buckets: List[Dict[bytes, List[int]]] = [
+            defaultdict(list) for _ in range(bands)
+        ]
+
+    def __len__(self) -> int:
+        """Get the number of indexed names."""
+        return len(self._names)
+
+    def _signature(self, items: Set[int]) -> np.ndarray:
+        """Get the MinHash signature of a set of shingle hashes."""
+        x = np.fromiter(items, dtype=np.uint64, count=len(items)) % _PRIME
+        hashes = (np.outer(x, self._a) + self._b) % _PRIME
+        return hashes.min(axis=0)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        """Get the bucket key of each band of a signature."""
+        return [
+            signature[i * self.rows : (i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+    def find_duplicate(self, name: str) -> Optional[str]:
+        """
+        Find an indexed name the given name duplicates.
+
+        Args:
+            name (str): the task name
+
+        Returns:
+            Optional[str]: the duplicated name, or None
+        """
+        normalized = dedup_key(name)
+        if normalized in self._exact:
+            return self._exact[normalized]
+        items = shingles(normalized)
+        candidates = set()
+        for band, key in enumerate(self._band_keys(self._signature(items))):
+            candidates.update(self._buckets[band].get(key, ()))
+        for i in candidates:
+            other = self._shingles[i]
+            if len(items & other) / len(items | other) >= self.threshold:
+                return self._names[i]
+        return None
+
+    def add(self, name: str) -> None:
+        """
+        Index a task name.
+
+        Args:
+            name (str): the task name
+        """
+        normalized = dedup_key(name)
+        if normalized in self._exact:
+            return
+        self._exact[normalized] = name
+        items = shingles(normalized)
+        position = len(self._names)
+        self._names.append(name)
+        self._shingles.append(items)
+        for band, key in enumerate(self._band_keys(self._signature(items))):
+            self._buckets[band][key].append(position)
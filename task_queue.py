@@ -0,0 +1,222 @@
+"""
+Task queue: a heap-backed replacement for the task list deque, with stable
+task ids, so tasks can be prioritized incrementally as they are created
+instead of re-prioritizing the whole list every loop.
+"""
+
+import heapq
+import itertools
+import re
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from task_store import Task
+
+
+def tokenize(text: str) -> set:
+    """Get the set of lower-cased words of a text."""
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def score_task(task_name: str, objective: str) -> float:
+    """
+    Cheap local priority score of a task in [0, 1]: the word overlap
+    (Jaccard index) between the task and the objective.
+
+    Args:
+        task_name (str): the task name
+        objective (str): the objective of the agent
+
+    Returns:
+        float: the score, higher runs earlier
+    """
+    task_words, objective_words = tokenize(task_name), tokenize(objective)
+    if not task_words or not objective_words:
+        return 0.0
+    return len(task_words & objective_words) / len(task_words | objective_words)
+
+
+class TaskQueue:
+    """
+    A priority queue of tasks exposing the subset of the deque interface
+    used by the actions (popleft, append, remove, iteration in priority
+    order, len and indexing).
+
+    Each task has a score in [0, 1] (higher runs earlier, ties run in
+    insertion order) and keeps its id for its whole life. Score changes
+    push a new heap entry and leave the old one to be skipped on pop.
+    """
+
+    def __init__(self, tasks: Iterable[dict] = ()) -> None:
+        """
+        Initialise the queue.
+
+        Args:
+            tasks (Iterable[dict]): initial tasks, in priority order
+        """
+        self._heap: List[Tuple[float, int, int]] = []
+        self._tasks: Dict[int, dict] = {}
+        self._entries: Dict[int, Tuple[float, int]] = {}
+        self._seq = itertools.count()
+        self.next_id = 1
+        # ids added since the last prioritization
+        self.new_ids: List[int] = []
+        self.added_since_full = 0
+        self.iterations_since_full = 0
+        # the kind of prioritization requested by the last prompt builder
+        self.pending_prioritization: Optional[str] = None
+        tasks = list(tasks)
+        for rank, task in enumerate(tasks):
+            self.append(task, score=1.0 - rank / len(tasks))
+        self.new_ids.clear()
+        self.added_since_full = 0
+
+    def __len__(self) -> int:
+        """Get the number of tasks."""
+        return len(self._tasks)
+
+    def __iter__(self) -> Iterator[dict]:
+        """Iterate over the tasks in priority order."""
+        entries = sorted((entry, id_) for id_, entry in self._entries.items())
+        return iter([self._tasks[id_] for _, id_ in entries])
+
+    def __getitem__(self, index: int) -> dict:
+        """Get a task by its position in priority order."""
+        if index == 0 and self._tasks:
+            self._drop_stale()
+            return self._tasks[self._heap[0][2]]
+        return list(self)[index]
+
+    def __copy__(self) -> "TaskQueue":
+        """Get a shallow copy of the queue, sharing the task dicts."""
+        queue = TaskQueue()
+        queue._heap = list(self._heap)
+        queue._tasks = dict(self._tasks)
+        queue._entries = dict(self._entries)
+        queue._seq = itertools.count(next(self._seq))
+        queue.next_id = self.next_id
+        queue.new_ids = list(self.new_ids)
+        queue.added_since_full = self.added_since_full
+        queue.iterations_since_full = self.iterations_since_full
+        return queue
+
+    def __repr__(self) -> str:
+        """Get the representation of the queue, like the one of a deque."""
+        return f"TaskQueue({list(self)!r})"
+
+    def _push(self, id_: int, score: float, seq: Optional[int] = None) -> None:
+        """Push a heap entry for a task, superseding its previous entry."""
+        seq = next(self._seq) if seq is None else seq
+        self._entries[id_] = (-score, seq)
+        heapq.heappush(self._heap, (-score, seq, id_))
+        # rebuild the heap once stale entries dominate it
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(key, seq, id_) for id_, (key, seq) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def _drop_stale(self) -> None:
+        """Pop the superseded entries off the top of the heap."""
+        while self._heap:
+            key, seq, id_ = self._heap[0]
+            if self._entries.get(id_) == (key, seq):
+                return
+            heapq.heappop(self._heap)
+
+    def add(self, name: str, score: float = 0.0) -> Task:
+        """
+        Create a task with the next id.
+
+        Args:
+            name (str): the task name
+            score (float): the priority score
+
+        Returns:
+            Task: the new task
+        """
+        task = Task(self.next_id, name)
+        self.append(task, score)
+        return task
+
+    def append(self, task: dict, score: float = 0.0) -> None:
+        """
+        Insert an existing task, keeping its id.
+
+        Args:
+            task (dict): the task
+            score (float): the priority score
+        """
+        self._tasks[task["id"]] = task
+        self.next_id = max(self.next_id, task["id"] + 1)
+        self.new_ids.append(task["id"])
+        self.added_since_full += 1
+        self._push(task["id"], score)
+
+    def popleft(self) -> dict:
+        """Remove and return the highest priority task."""
+        self._drop_stale()
+        if not self._heap:
+            raise IndexError("pop from an empty task queue")
+        _, _, id_ = heapq.heappop(self._heap)
+        del self._entries[id_]
+        return self._tasks.pop(id_)
+
+    def remove(self, task: dict) -> None:
+        """Remove a task, leaving its heap entry to be skipped."""
+        if self._tasks.get(task["id"]) is not task:
+            raise ValueError("task is not in the task queue")
+        del self._tasks[task["id"]]
+        del self._entries[task["id"]]
+
+    def get(self, id_: int) -> Optional[dict]:
+        """Get a task by id."""
+        return self._tasks.get(id_)
+
+    def set_score(self, id_: int, score: float) -> None:
+        """Change the priority score of a task, keeping its insertion order."""
+        if id_ in self._entries:
+            self._push(id_, score, seq=self._entries[id_][1])
+
+    def reorder(self, names: List[str]) -> None:
+        """
+        Apply a full prioritization: the tasks named in names are ranked in
+        that order, unknown names become new tasks and tasks that are not
+        named anymore are dropped, as the full re-prioritization did.
+
+        Args:
+            names (List[str]): the task names, in priority order
+        """
+        by_name = {task["name"]: task for task in self._tasks.values()}
+        kept = set()
+        for rank, name in enumerate(names):
+            score = 1.0 - rank / len(names)
+            task = by_name.get(name)
+            if task is None or task["id"] in kept:
+                task = self.add(name, score)
+            else:
+                self.set_score(task["id"], score)
+            kept.add(task["id"])
+        for id_ in [id_ for id_ in self._tasks if id_ not in kept]:
+            self.remove(self._tasks[id_])
+
+    def needs_full_prioritization(self, interval: int, drift: float) -> bool:
+        """
+        Check whether the whole queue should be re-prioritized: every
+        interval iterations, or when the share of tasks added since the
+        last full prioritization exceeds drift.
+        """
+        if self.iterations_since_full + 1 >= interval:
+            return True
+        return len(self) > 0 and self.added_since_full / len(self) > drift
+
+    def new_tasks(self) -> List[dict]:
+        """Get the pending tasks added since the last prioritization."""
+        return [self._tasks[id_] for id_ in self.new_ids if id_ in self._tasks]
+
+    def mark_prioritized(self, full: bool) -> None:
+        """Record the end of a prioritization step."""
+        if full:
+            self.iterations_since_full = 0
+            self.added_since_full = 0
+        else:
+            self.iterations_since_full += 1
+        self.new_ids.clear()
+        self.pending_prioritization = None
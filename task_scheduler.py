@@ -0,0 +1,160 @@
+"""
+Task scheduler: executes every task of the task list whose dependencies are
+met at once, instead of one task per loop, so the time spent on an
+objective scales with the longest chain of dependent tasks.
+"""
+
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import actions
+from actions import (
+    build_task_execution_prompt,
+    next_task_id,
+    normalize_task_name,
+    parse_task_dependencies,
+    task_execution_handler,
+)
+from telemetry import telemetry
+
+# maximum number of tasks executed concurrently by the scheduler
+MAX_PARALLEL_TASKS = 4
+
+
+class TaskScheduler:
+    """
+    Keeps the ready set of the task list and executes it concurrently.
+
+    A task is ready when none of the ids in its optional "depends_on" list
+    belong to a task that is still in the task list. Ready tasks are taken
+    in task list order, so the prioritization is respected, and their
+    results are committed to the shared state in that same order.
+    """
+
+    def __init__(self, max_parallel: int = MAX_PARALLEL_TASKS) -> None:
+        """
+        Initialise the scheduler.
+
+        Args:
+            max_parallel (int): the maximum number of tasks run at once
+        """
+        self.max_parallel = max_parallel
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_parallel, thread_name_prefix="task-scheduler"
+        )
+        # executions started before their task was added, by normalized name
+        self._prefetched: Dict[str, Future] = {}
+
+    def ready_tasks(self, task_list: deque) -> List[dict]:
+        """
+        Get the tasks of the task list that can be executed now.
+
+        Args:
+            task_list (deque): the pending tasks, in priority order
+
+        Returns:
+            List[dict]: at most max_parallel ready tasks, in priority order
+        """
+        pending = {t["id"] for t in task_list}
+        ready = []
+        for task in task_list:
+            if not pending.intersection(task.get("depends_on", [])):
+                ready.append(task)
+                if len(ready) == self.max_parallel:
+                    break
+        # break dependency cycles by running the head of the list
+        if not ready and task_list:
+            ready.append(task_list[0])
+        return ready
+
+    def execute_ready(self, globals_: dict, llm_call: Callable[[str], str]) -> str:
+        """
+        Execute the ready tasks concurrently and commit their results.
+
+        Args:
+            globals_ (dict): The globals dictionary
+            llm_call (Callable[[str], str]): gets the response to a prompt
+
+        Returns:
+            str: the event of the execution handler of the last task
+        """
+        with telemetry.action("task_execution") as record:
+            with record.phase("build"):
+                ready = self.ready_tasks(globals_["task_list"])
+                for task in ready:
+                    globals_["task_list"].remove(task)
+
+                print(
+                    "\033[92m\033[1m" + "\n***** NEXT TASKS *****\n" + "\033[0m\033[0m"
+                )
+                for task in ready:
+                    print(str(task["id"]) + ": " + task["name"])
+
+                # the workers attribute their token usage to this action
+                executions = [
+                    self._prefetched.pop(normalize_task_name(task["name"]), None)
+                    or self._pool.submit(
+                        contextvars.copy_context().run,
+                        llm_call,
+                        build_task_execution_prompt(globals_, task),
+                    )
+                    for task in ready
+                ]
+                # drop the prefetched executions of tasks that did not make it
+                pending = {
+                    normalize_task_name(t["name"]) for t in globals_["task_list"]
+                }
+                for name in [name for name in self._prefetched if name not in pending]:
+                    self._prefetched.pop(name).cancel()
+            with record.phase("llm"):
+                responses = [execution.result() for execution in executions]
+            event = "done"
+            with record.phase("handler"):
+                for task, response in zip(ready, responses):
+                    globals_["current_task"] = task
+                    event = task_execution_handler(response, globals_)
+            record.event = event
+        return event
+
+    def prefetch(
+        self, globals_: dict, task_line: str, llm_call: Callable[[str], str]
+    ) -> None:
+        """
+        Start executing a task as soon as its line of a streamed task creation
+        response arrives, before the task is added to the task list. The
+        result is used when the task is scheduled, matched by name up to
+        case, whitespace and the final period. Ids cannot be matched, since
+        prioritization renumbers the tasks; when it rewrites the name, the
+        prefetched result is missed and the task is executed as usual.
+
+        Args:
+            globals_ (dict): The globals dictionary
+            task_line (str): a line of the task creation response
+            llm_call (Callable[[str], str]): gets the response to a prompt
+        """
+        name = task_line.strip()
+        if actions.TRACK_TASK_DEPENDENCIES:
+            # a task that waits for others is not run early
+            name, depends_on = parse_task_dependencies(name)
+            if depends_on:
+                return
+        key = normalize_task_name(name)
+        if not key or key in self._prefetched:
+            return
+        if len(self._prefetched) >= self.max_parallel:
+            return
+        task = {"id": next_task_id(globals_) + len(self._prefetched), "name": name}
+        prompt = build_task_execution_prompt(globals_, task)
+        self._prefetched[key] = self._pool.submit(self._prefetch_call, llm_call, prompt)
+
+    @staticmethod
+    def _prefetch_call(llm_call: Callable[[str], str], prompt: str) -> str:
+        """Run a prefetched execution, recorded apart from the streamed creation."""
+        with telemetry.action("task_prefetch") as record, record.phase("llm"):
+            return llm_call(prompt)
+
+    def shutdown(self) -> None:
+        """Wait for running tasks and release the worker threads."""
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,207 @@
+"""
+Task store: compact task records and an array-backed task list, replacing
+the task dicts in a deque so that large task histories take less memory and
+the handlers update the task list in place instead of rebuilding it.
+"""
+
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+# compact the array once this many tasks were popped off its head
+_COMPACT_AT = 32
+
+
+class Task:
+    """
+    A task record with slots instead of a dict, with an interned name.
+
+    It keeps the dict interface used by the actions (task["name"],
+    task.get("depends_on", []), task["depends_on"] = ...) and compares and
+    prints like the dict it replaces, so the prompts it is formatted into
+    are unchanged.
+    """
+
+    __slots__ = ("id", "name", "depends_on")
+
+    # the keys of the dict view, in the order of the dict it replaces
+    KEYS = __slots__
+
+    # tasks compare by value like dicts, so they are not hashable either
+    __hash__ = None  # type: ignore
+
+    def __init__(  # pylint: disable=redefined-builtin
+        self, id: int, name: str, depends_on: Optional[List[int]] = None
+    ) -> None:
+        """
+        Initialise the task.
+
+        Args:
+            id (int): the task id
+            name (str): the task name
+            depends_on (Optional[List[int]]): the ids of the tasks it waits on
+        """
+        self.id = id
+        self.name = sys.intern(name)
+        self.depends_on = depends_on or None
+
+    @classmethod
+    def from_dict(cls, task: Union[dict, "Task"]) -> "Task":
+        """Get the task record of a task dict, or the record itself."""
+        if isinstance(task, Task):
+            return task
+        return cls(task["id"], task["name"], task.get("depends_on"))
+
+    def to_dict(self) -> dict:
+        """Get the task as a dict, without the unset keys."""
+        return {key: getattr(self, key) for key in self.KEYS if key in self}
+
+    def __contains__(self, key: str) -> bool:
+        """Check whether a key is set."""
+        return key in self.KEYS and getattr(self, key) is not None
+
+    def __getitem__(self, key: str):
+        """Get a field by key, like a dict."""
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value) -> None:
+        """Set a field by key, like a dict."""
+        if key not in self.KEYS:
+            raise KeyError(key)
+        if key == "name":
+            value = sys.intern(value)
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        """Get a field by key, or default when it is not set."""
+        return getattr(self, key) if key in self else default
+
+    def keys(self) -> List[str]:
+        """Get the keys that are set."""
+        return [key for key in self.KEYS if key in self]
+
+    def __eq__(self, other) -> bool:
+        """Compare with a task record or a task dict."""
+        if isinstance(other, (Task, dict)):
+            return self.to_dict() == (
+                other.to_dict() if isinstance(other, Task) else other
+            )
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        """Get the representation of the task dict it replaces."""
+        return repr(self.to_dict())
+
+
+class TaskStore:
+    """
+    The pending tasks, in priority order, exposing the subset of the deque
+    interface used by the actions (popleft, append, remove, iteration, len
+    and indexing) plus lookups by id and in-place replacement.
+
+    The tasks are kept in a list whose head moves forward as tasks are
+    popped, so popleft is O(1) and the list is only compacted once in a
+    while. An index by id makes get O(1).
+    """
+
+    def __init__(self, tasks: Iterable[Union[dict, Task]] = ()) -> None:
+        """
+        Initialise the store.
+
+        Args:
+            tasks (Iterable[Union[dict, Task]]): initial tasks, in priority order
+        """
+        self._tasks: List[Optional[Task]] = []
+        self._head = 0
+        self._by_id: Dict[int, Task] = {}
+        self.extend(tasks)
+
+    def __len__(self) -> int:
+        """Get the number of tasks."""
+        return len(self._tasks) - self._head
+
+    def __iter__(self) -> Iterator[Task]:
+        """Iterate over the tasks in priority order."""
+        return iter(self._tasks[self._head :])
+
+    def __getitem__(self, index: int) -> Task:
+        """Get a task by its position in priority order."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("task store index out of range")
+        return self._tasks[self._head + index]
+
+    def __copy__(self) -> "TaskStore":
+        """Get a shallow copy of the store, sharing the task records."""
+        store = TaskStore()
+        store._tasks = self._tasks[self._head :]
+        store._by_id = dict(self._by_id)
+        return store
+
+    def __repr__(self) -> str:
+        """Get the representation of the store, like the one of a deque."""
+        return f"TaskStore({list(self)!r})"
+
+    def append(self, task: Union[dict, Task]) -> None:
+        """Add a task at the end of the list."""
+        task = Task.from_dict(task)
+        self._tasks.append(task)
+        self._by_id[task.id] = task
+
+    def extend(self, tasks: Iterable[Union[dict, Task]]) -> None:
+        """Add tasks at the end of the list, in order."""
+        for task in tasks:
+            self.append(task)
+
+    def popleft(self) -> Task:
+        """Remove and return the first task."""
+        if not len(self):
+            raise IndexError("pop from an empty task store")
+        task = self._tasks[self._head]
+        self._tasks[self._head] = None
+        self._head += 1
+        if self._head >= _COMPACT_AT and self._head * 2 >= len(self._tasks):
+            del self._tasks[: self._head]
+            self._head = 0
+        self._forget(task)
+        return task
+
+    def remove(self, task: Task) -> None:
+        """Remove a task."""
+        for index in range(self._head, len(self._tasks)):
+            if self._tasks[index] is task:
+                del self._tasks[index]
+                self._forget(task)
+                return
+        raise ValueError("task is not in the task store")
+
+    def _forget(self, task: Task) -> None:
+        """Drop a removed task from the index by id."""
+        if self._by_id.get(task.id) is task:
+            del self._by_id[task.id]
+
+    def get(self, id_: int) -> Optional[Task]:
+        """Get a task by id."""
+        return self._by_id.get(id_)
+
+    def truncate(self, size: int) -> None:
+        """Drop the tasks after the first size ones."""
+        for task in self._tasks[self._head + size :]:
+            self._forget(task)
+        del self._tasks[self._head + size :]
+
+    def replace(self, tasks: Iterable[Union[dict, Task]]) -> None:
+        """
+        Replace the tasks in place, with the new tasks in priority order, as
+        the task creation and prioritization handlers do every loop.
+
+        Args:
+            tasks (Iterable[Union[dict, Task]]): the new tasks
+        """
+        self._tasks[:] = [Task.from_dict(task) for task in tasks]
+        self._head = 0
+        self._by_id.clear()
+        for task in self._tasks:
+            self._by_id[task.id] = task
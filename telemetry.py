@@ -0,0 +1,354 @@
+"""
+Telemetry: per-action timings (prompt build, LLM wait, handler), token
+usage and cost, aggregated into counters served in the Prometheus text
+format and optionally traced, one JSON line per action, to a file.
+"""
+
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional
+
+from context_packer import ContextPacker
+
+# JSONL trace file, empty to disable tracing
+TELEMETRY_TRACE_PATH = os.getenv("TELEMETRY_TRACE_PATH", "")
+# port of the Prometheus metrics endpoint, 0 to disable it
+TELEMETRY_PORT = int(os.getenv("TELEMETRY_PORT", "0"))
+# interface of the metrics endpoint, local only by default since the counters
+# expose usage and cost, "0.0.0.0" to let a remote Prometheus scrape them
+TELEMETRY_HOST = os.getenv("TELEMETRY_HOST", "127.0.0.1")
+
+# USD per 1000 prompt and completion tokens
+COST_PER_1K_TOKENS = {
+    "text-davinci-003": (0.02, 0.02),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+}
+
+PHASES = ("build", "llm", "handler")
+
+
+class ActionRecord:
+    """The timings and token usage of one run of an action."""
+
+    __slots__ = (
+        "action",
+        "start",
+        "seconds",
+        "phases",
+        "requests",
+        "cached",
+        "prompt_tokens",
+        "completion_tokens",
+        "cost",
+        "routes",
+        "event",
+    )
+
+    def __init__(self, action: str) -> None:
+        """
+        Initialise the record.
+
+        Args:
+            action (str): the action type name
+        """
+        self.action = action
+        self.start = time.time()
+        self.seconds = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.requests = 0
+        self.cached = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.routes: List[dict] = []
+        self.event: Optional[str] = None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a phase of the action, adding to its total."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def to_dict(self) -> dict:
+        """Get the record as a trace line."""
+        return {
+            "ts": self.start,
+            "action": self.action,
+            "seconds": self.seconds,
+            **{f"{name}_seconds": value for name, value in self.phases.items()},
+            "requests": self.requests,
+            "cached": self.cached,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost_usd": self.cost,
+            "routes": self.routes,
+            "event": self.event,
+        }
+
+
+# the record of the action running in the current thread or task
+_current: contextvars.ContextVar = contextvars.ContextVar("action", default=None)
+
+
+class Telemetry:
+    """
+    Collects the action records of every runner in the process.
+
+    An action is recorded with `with telemetry.action(name) as record`; the
+    LLM client attributes the usage of each request to the action running
+    in the calling context, counting tokens with tiktoken when the API
+    response carries no `usage` (streamed responses).
+    """
+
+    def __init__(self, trace_path: Optional[str] = None) -> None:
+        """
+        Initialise the telemetry.
+
+        Args:
+            trace_path (Optional[str]): the JSONL trace file, None to disable
+        """
+        self.trace_path = trace_path
+        self._trace = None
+        self._lock = threading.Lock()
+        self._counters: Dict[tuple, float] = defaultdict(float)
+        self._packer = ContextPacker(max_cached_items=0)
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @contextmanager
+    def action(self, name: str) -> Iterator[ActionRecord]:
+        """
+        Record a run of an action, timed from enter to exit.
+
+        Args:
+            name (str): the action type name
+
+        Yields:
+            ActionRecord: the record, to time phases and set the event on
+        """
+        record = ActionRecord(name)
+        token = _current.set(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            _current.reset(token)
+            self._commit(record)
+
+    def _commit(self, record: ActionRecord) -> None:
+        """Add a finished record to the counters and the trace."""
+        action = record.action
+        with self._lock:
+            self._counters[("calls", action)] += 1
+            self._counters[("seconds", action)] += record.seconds
+            for phase, seconds in record.phases.items():
+                self._counters[("phase_seconds", action, phase)] += seconds
+            if self.trace_path:
+                if self._trace is None:
+                    self._trace = open(self.trace_path, "a", buffering=1)
+                self._trace.write(json.dumps(record.to_dict()) + "\n")
+
+    def current_action(self) -> str:
+        """Get the name of the action running in the calling context."""
+        record = _current.get()
+        if record is None:
+            return "none"
+        # task_execution_1/2 of the FSM are the same action
+        return re.sub(r"_\d$", "", record.action)
+
+    def record_hedge(self, action: str, won: bool) -> None:
+        """
+        Count a hedged request of an action.
+
+        Args:
+            action (str): the action of the request
+            won (bool): whether the hedge answered before the first request
+        """
+        with self._lock:
+            self._counters[("hedges", action, str(won).lower())] += 1
+
+    def record_speculation(self, kept: bool) -> None:
+        """
+        Count a speculative execution of the pipelined loop.
+
+        Args:
+            kept (bool): whether its result was kept, or discarded and the
+                task list head executed again
+        """
+        with self._lock:
+            self._counters[("speculations", str(kept).lower())] += 1
+
+    def record_route(self, model: str, reason: str, seconds: float) -> None:
+        """
+        Count the routing decision of an LLM request of the current action,
+        with the latency it led to.
+
+        Args:
+            model (str): the model the request was routed to
+            reason (str): why, see model_router.Decision
+            seconds (float): the latency of the request
+        """
+        record = _current.get()
+        # labelled like the usage, to join the decisions with their cost
+        action = record.action if record is not None else "none"
+        with self._lock:
+            if record is not None:
+                record.routes.append(
+                    {"model": model, "reason": reason, "seconds": seconds}
+                )
+            self._counters[("routes", action, model, reason)] += 1
+            self._counters[("route_seconds", action, model)] += seconds
+
+    def record_usage(
+        self,
+        model: str,
+        prompt: str,
+        text: str,
+        usage: Optional[dict] = None,
+        cached: bool = False,
+    ) -> None:
+        """
+        Attribute the usage of an LLM request to the current action.
+
+        Args:
+            model (str): the model of the request
+            prompt (str): the prompt
+            text (str): the completion text
+            usage (Optional[dict]): the `usage` field of the API response
+            cached (bool): whether the response came from the response cache
+        """
+        record = _current.get()
+        action = record.action if record is not None else "none"
+        if cached:
+            prompt_tokens = completion_tokens = 0
+        elif usage:
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+        else:
+            encoding = self._packer.encoding
+            prompt_tokens = len(encoding.encode(prompt))
+            completion_tokens = len(encoding.encode(text))
+        prompt_price, completion_price = COST_PER_1K_TOKENS.get(model, (0.0, 0.0))
+        cost = (
+            prompt_tokens * prompt_price + completion_tokens * completion_price
+        ) / 1000
+        with self._lock:
+            if record is not None:
+                record.requests += 1
+                record.cached += cached
+                record.prompt_tokens += prompt_tokens
+                record.completion_tokens += completion_tokens
+                record.cost += cost
+            self._counters[("requests", action, model, str(cached).lower())] += 1
+            self._counters[("tokens", action, model, "prompt")] += prompt_tokens
+            self._counters[("tokens", action, model, "completion")] += completion_tokens
+            self._counters[("cost", action, model)] += cost
+
+    def counters(self) -> Dict[tuple, float]:
+        """Get a copy of the counters, to report them to another process."""
+        with self._lock:
+            return dict(self._counters)
+
+    def merge(self, counters: Dict[tuple, float]) -> None:
+        """
+        Add counters to these ones, to aggregate the telemetry of several
+        processes.
+
+        Args:
+            counters (Dict[tuple, float]): the counters to add
+        """
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] += value
+
+    def render_prometheus(self) -> str:
+        """Get the counters in the Prometheus text exposition format."""
+        metrics = {
+            "calls": ("babyagi_action_calls_total", ("action",)),
+            "seconds": ("babyagi_action_seconds_total", ("action",)),
+            "phase_seconds": (
+                "babyagi_action_phase_seconds_total",
+                ("action", "phase"),
+            ),
+            "requests": (
+                "babyagi_llm_requests_total",
+                ("action", "model", "cached"),
+            ),
+            "tokens": ("babyagi_llm_tokens_total", ("action", "model", "kind")),
+            "cost": ("babyagi_llm_cost_usd_total", ("action", "model")),
+            "hedges": ("babyagi_llm_hedges_total", ("action", "won")),
+            "speculations": ("babyagi_pipeline_speculations_total", ("kept",)),
+            "routes": ("babyagi_llm_routes_total", ("action", "model", "reason")),
+            "route_seconds": (
+                "babyagi_llm_route_seconds_total",
+                ("action", "model"),
+            ),
+        }
+        with self._lock:
+            counters = sorted(self._counters.items())
+        lines = []
+        for kind, (metric, label_names) in metrics.items():
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in counters:
+                if key[0] != kind:
+                    continue
+                labels = ",".join(
+                    f'{name}="{label}"' for name, label in zip(label_names, key[1:])
+                )
+                lines.append(f"{metric}{{{labels}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = TELEMETRY_PORT, host: str = TELEMETRY_HOST) -> None:
+        """
+        Serve the counters on http://host:port/metrics, in a background thread.
+
+        Args:
+            port (int): the port to listen on
+            host (str): the host to bind to
+        """
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # pylint: disable=invalid-name
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                data = telemetry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        """Stop the metrics endpoint and close the trace file."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
+
+
+# the telemetry shared by every runner in the process
+telemetry = Telemetry(TELEMETRY_TRACE_PATH or None)
@@ -0,0 +1,192 @@
+"""
+Vector store: an in-process replacement for the Pinecone index used by the
+actions to store and retrieve task results, with no network round trips.
+"""
+
+import threading
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+class Match(NamedTuple):
+    """A single query match, mirroring the fields of a Pinecone match."""
+
+    id: str
+    score: float
+    metadata: Dict[str, Any]
+
+
+class QueryResponse(NamedTuple):
+    """The response of a query, mirroring the Pinecone query response."""
+
+    matches: List[Match]
+
+
+class LocalVectorStore:
+    """
+    A local vector index backed by a contiguous float32 matrix.
+
+    Rows are L2-normalized on upsert so that the cosine similarity of a query
+    against every stored vector is a single matrix-vector product, and the
+    top-k selection is done with `argpartition` instead of a full sort. The
+    matrix grows by amortized doubling, while ids and metadata are kept in
+    arrays parallel to the matrix rows.
+
+    Like a Pinecone index, the store is partitioned into namespaces, each
+    held in its own matrix, so agents sharing the store only see their own
+    results. Each namespace has a write version, incremented by every upsert,
+    that tells readers whether what they retrieved before is still current.
+    """
+
+    def __init__(self, dimension: int, initial_capacity: int = 1024) -> None:
+        """
+        Initialise the store.
+
+        Args:
+            dimension (int): the dimension of the stored vectors
+            initial_capacity (int): the number of rows to preallocate
+        """
+        self.dimension = dimension
+        self._vectors = np.zeros((max(initial_capacity, 1), dimension), np.float32)
+        self._ids: List[str] = []
+        self._metadata: List[Dict[str, Any]] = []
+        self._positions: Dict[str, int] = {}
+        self._namespaces: Dict[str, "LocalVectorStore"] = {}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def __len__(self) -> int:
+        """Get the number of stored vectors."""
+        return len(self._ids)
+
+    def get_version(self, namespace: str = "") -> int:
+        """Get the write version of a namespace, 0 if it was never written."""
+        partition = self._namespace(namespace, create=False)
+        return partition.version if partition is not None else 0
+
+    def _grow(self, min_capacity: int) -> None:
+        """Double the capacity of the matrix until it fits min_capacity rows."""
+        capacity = self._vectors.shape[0]
+        if min_capacity <= capacity:
+            return
+        while capacity < min_capacity:
+            capacity *= 2
+        vectors = np.zeros((capacity, self.dimension), np.float32)
+        vectors[: len(self)] = self._vectors[: len(self)]
+        self._vectors = vectors
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        """L2-normalize the rows of a matrix, leaving zero rows untouched."""
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _namespace(self, namespace: str, create: bool) -> Optional["LocalVectorStore"]:
+        """Get the partition of a namespace, the default one being this store."""
+        if not namespace:
+            return self
+        with self._lock:
+            partition = self._namespaces.get(namespace)
+            if partition is None and create:
+                partition = LocalVectorStore(self.dimension, initial_capacity=16)
+                self._namespaces[namespace] = partition
+        return partition
+
+    def upsert(
+        self,
+        vectors: Iterable[Tuple[str, List[float], Optional[Dict[str, Any]]]],
+        namespace: str = "",
+    ) -> Dict[str, int]:
+        """
+        Insert or update vectors, using the same surface as `pinecone.Index`.
+
+        Args:
+            vectors: an iterable of (id, values, metadata) tuples
+            namespace (str): the namespace to write to
+
+        Returns:
+            Dict[str, int]: the number of upserted vectors, and the write
+            version of the namespace after the upsert
+        """
+        if namespace:
+            return self._namespace(namespace, create=True).upsert(vectors)
+        records = list(vectors)
+        if not records:
+            return {"upserted_count": 0, "version": self.version}
+        values = np.asarray([record[1] for record in records], dtype=np.float32)
+        if values.shape[1] != self.dimension:
+            raise ValueError(
+                f"expected vectors of dimension {self.dimension}, got {values.shape[1]}"
+            )
+        values = self._normalize(values)
+        with self._lock:
+            self._write(records, values)
+            self.version += 1
+            version = self.version
+        return {"upserted_count": len(records), "version": version}
+
+    def _write(self, records: list, values: np.ndarray) -> None:
+        """Write normalized rows, with the store lock held."""
+        self._grow(len(self) + len(records))
+        for record, row in zip(records, values):
+            id_ = record[0]
+            metadata = record[2] if len(record) > 2 and record[2] is not None else {}
+            position = self._positions.get(id_)
+            if position is None:
+                position = len(self._ids)
+                self._positions[id_] = position
+                self._ids.append(id_)
+                self._metadata.append(metadata)
+            else:
+                self._metadata[position] = metadata
+            self._vectors[position] = row
+
+    def query(
+        self,
+        vector: List[float],
+        top_k: int = 10,
+        include_metadata: bool = False,
+        namespace: str = "",
+    ) -> QueryResponse:
+        """
+        Get the top_k stored vectors by cosine similarity to the query vector.
+
+        Args:
+            vector (List[float]): the query vector
+            top_k (int): the number of matches to return
+            include_metadata (bool): whether to return the match metadata
+            namespace (str): the namespace to search
+
+        Returns:
+            QueryResponse: the matches, sorted by descending score
+        """
+        if namespace:
+            partition = self._namespace(namespace, create=False)
+            if partition is None:
+                return QueryResponse(matches=[])
+            return partition.query(vector, top_k, include_metadata)
+        with self._lock:
+            size = len(self)
+            vectors = self._vectors
+        if size == 0 or top_k <= 0:
+            return QueryResponse(matches=[])
+        query = self._normalize(np.asarray(vector, dtype=np.float32))
+        scores = vectors[:size] @ query
+        k = min(top_k, size)
+        if k < size:
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(size)
+        top = top[np.argsort(scores[top])[::-1]]
+        return QueryResponse(
+            matches=[
+                Match(
+                    id=self._ids[i],
+                    score=float(scores[i]),
+                    metadata=self._metadata[i] if include_metadata else {},
+                )
+                for i in top
+            ]
+        )
@@ -0,0 +1,161 @@
+"""
+Write-behind buffer: takes the task results to store in the vector store off
+the critical path, embedding and upserting them in batches in a background
+worker, while the records still pending stay readable.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+# a record to store: its id, the text to embed and its metadata
+Record = Tuple[str, str, Dict[str, Any]]
+
+# stores a batch of records of a namespace
+WriteFn = Callable[[List[Record], str], None]
+
+
+def coalesce(records: Iterable[Record]) -> List[Record]:
+    """Keep the last record of each id, in the order the ids first appear."""
+    return list({record[0]: record for record in records}.values())
+
+
+class WriteBehindBuffer:
+    """
+    A queue of records written by a background worker in batches.
+
+    The worker writes a batch once max_batch_size records are queued, once
+    the oldest one has waited max_age seconds, or on flush. Records are
+    visible through pending until their batch is written. Records with
+    the same id are coalesced, the last one wins. A batch that fails is
+    retried up to max_attempts times, then dropped with an error.
+    """
+
+    def __init__(
+        self,
+        write: WriteFn,
+        max_batch_size: int = 32,
+        max_age: float = 1.0,
+        max_attempts: int = 3,
+    ) -> None:
+        """
+        Initialise the buffer.
+
+        Args:
+            write (WriteFn): embeds and upserts a batch of a namespace
+            max_batch_size (int): the maximum number of records per batch
+            max_age (float): the seconds a record waits at most
+            max_attempts (int): the number of attempts to write a batch
+        """
+        self.write = write
+        self.max_batch_size = max_batch_size
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        # queued (namespace, record, enqueue time), and the batch being written
+        self._queue: Deque[Tuple[str, Record, float]] = deque()
+        self._writing: List[Tuple[str, Record, float]] = []
+        self._condition = threading.Condition()
+        self._flushing = False
+        self._worker: Optional[threading.Thread] = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+
+    def add(self, record: Record, namespace: str = "") -> None:
+        """
+        Queue a record, starting the worker on first use.
+
+        Args:
+            record (Record): the record
+            namespace (str): the namespace to write it to
+        """
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="write-behind", daemon=True
+                )
+                self._worker.start()
+            self._queue.append((namespace, record, time.monotonic()))
+            # wake the worker to time the first record, or to write a full batch
+            if len(self._queue) in (1, self.max_batch_size):
+                self._condition.notify_all()
+
+    def pending(self, namespace: str = "") -> List[Record]:
+        """Get the records of a namespace that are not written yet."""
+        with self._condition:
+            return coalesce(
+                record
+                for ns, record, _ in self._writing + list(self._queue)
+                if ns == namespace
+            )
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Write every queued record now and wait until they are written.
+
+        Args:
+            timeout (Optional[float]): the maximum seconds to wait
+
+        Returns:
+            bool: whether every record was written in time
+        """
+        with self._condition:
+            if self._worker is None:
+                return True
+            self._flushing = True
+            self._condition.notify_all()
+            written = self._condition.wait_for(
+                lambda: not self._queue and not self._writing, timeout
+            )
+            self._flushing = False
+            return written
+
+    def _due(self) -> bool:
+        """Check whether a batch should be written now, with the lock held."""
+        if not self._queue:
+            return False
+        if self._flushing or len(self._queue) >= self.max_batch_size:
+            return True
+        return time.monotonic() - self._queue[0][2] >= self.max_age
+
+    def _run(self) -> None:
+        """Write batches as they are due, forever."""
+        while True:
+            with self._condition:
+                while not self._due():
+                    timeout = None
+                    if self._queue:
+                        age = time.monotonic() - self._queue[0][2]
+                        timeout = max(self.max_age - age, 0)
+                    self._condition.wait(timeout)
+                count = min(self.max_batch_size, len(self._queue))
+                self._writing = [self._queue.popleft() for _ in range(count)]
+            self._write_batch(self._writing)
+            with self._condition:
+                self._writing = []
+                self._condition.notify_all()
+
+    def _write_batch(self, batch: List[Tuple[str, Record, float]]) -> None:
+        """Write a batch, one call per namespace, retrying failed calls."""
+        namespaces: Dict[str, List[Record]] = {}
+        for namespace, record, _ in batch:
+            namespaces.setdefault(namespace, []).append(record)
+        for namespace, records in namespaces.items():
+            records = coalesce(records)
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    self.write(records, namespace)
+                    self.written += len(records)
+                    self.batches += 1
+                    break
+                except Exception as e:  # pylint: disable=broad-except
+                    if attempt == self.max_attempts:
+                        self.dropped += len(records)
+                        print(
+                            "\033[91m\033[1m"
+                            + f"\n*** {len(records)} results not stored: {e!r} ***"
+                            + "\033[0m"
+                        )
+                    else:
+                        time.sleep(attempt)